@@ -0,0 +1,100 @@
+"""
+Validated vs trusted hydration of stored records.
+
+    python -m benchmarks.hydration --users 20000
+
+Records read back from our own store were validated when they were written,
+so the read paths build domain objects with the _trusted() constructors.
+This times both constructors over the same records, per entity type, with
+the parents already resolved so that only construction is measured, and
+then times a cold get_all_devices() (interned objects dropped first) on the
+same fleet.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+from generate import generate_fleet, load_fleet
+from user import User, PrivilegeLevel, PRIVILEGE_LEVELS, USERS_JSON_FILE
+from house import House, HOUSES_JSON_FILE
+from room import Room, ROOMS_JSON_FILE
+from device import Device, DeviceType, DEVICE_TYPES, DEVICES_JSON_FILE, get_all_devices
+
+REPEATS = 5
+
+def best_of(fn: Callable[[], object], repeats: int = REPEATS) -> float:
+    """Fastest of `repeats` runs, in seconds."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def constructors(records: dict) -> dict:
+    """(validated, trusted) builders per entity type, over `records`."""
+    owner = User("u", "Owner", "owner@example.com", PrivilegeLevel.OWNER)
+    house = House("h", "1 Main St", owner, (40.0, -70.0), 1, 1)
+    room = Room("r", 1, house)
+    users, houses = records[USERS_JSON_FILE], records[HOUSES_JSON_FILE]
+    rooms, devices = records[ROOMS_JSON_FILE], records[DEVICES_JSON_FILE]
+    return {
+        "users": (
+            lambda: [User(r["user_id"], r["name"], r["email"], PrivilegeLevel(r["privilege"])) for r in users],
+            lambda: [User._trusted(r["user_id"], r["name"], r["email"], PRIVILEGE_LEVELS[r["privilege"]]) for r in users],
+        ),
+        "houses": (
+            lambda: [House(r["house_id"], r["address"], owner, tuple(r["gps_location"]),
+                           r["num_rooms"], r["num_baths"]) for r in houses],
+            lambda: [House._trusted(r["house_id"], r["address"], owner, tuple(r["gps_location"]),
+                                    r["num_rooms"], r["num_baths"]) for r in houses],
+        ),
+        "rooms": (
+            lambda: [Room(r["name"], r["floor"], house) for r in rooms],
+            lambda: [Room._trusted(r["name"], r["floor"], house) for r in rooms],
+        ),
+        "devices": (
+            lambda: [Device(DeviceType(r["type"]), r["device_id"], room) for r in devices],
+            lambda: [Device._trusted(DEVICE_TYPES[r["type"]], r["device_id"], room) for r in devices],
+        ),
+    }
+
+def cold_listing() -> None:
+    for path in (USERS_JSON_FILE, HOUSES_JSON_FILE, ROOMS_JSON_FILE):
+        storage.get_store(path)._interned = {}
+    get_all_devices()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000, help="fleet size, in users (default 20000)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="smart-home-bench-") as scratch:
+        os.chdir(scratch)
+        storage.STORAGE_BACKEND = "json"
+        storage._stores.clear()
+        try:
+            load_fleet(generate_fleet(users=args.users, seed=args.seed))
+            records = {
+                path: list(storage.get_store(path).load().values())
+                for path in (USERS_JSON_FILE, HOUSES_JSON_FILE, ROOMS_JSON_FILE, DEVICES_JSON_FILE)
+            }
+            for kind, (validated, trusted) in constructors(records).items():
+                slow, fast = best_of(validated), best_of(trusted)
+                print(f"{kind:8} {len(records[kind + '.json']):>9,}  validated {slow * 1000:8.1f} ms  "
+                      f"trusted {fast * 1000:8.1f} ms  {slow / fast:5.2f}x")
+            print(f"cold get_all_devices(): {best_of(cold_listing) * 1000:.1f} ms")
+        finally:
+            os.chdir(cwd)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+"""
+Storage and API benchmarks at realistic scale.
+
+    python -m benchmarks.run --sizes 1000,10000 --output results.json
+    python -m benchmarks.run --sizes 1000,10000 --baseline benchmarks/baseline.json
+
+For every size a synthetic fleet (users -> houses -> rooms -> devices) with
+roughly that many entities is written to the configured backend in a
+scratch directory. Then each CRUD function and each main.py route (through
+TestClient), the /<entity>:batch routes included, is timed. Results are
+latency percentiles and throughput per operation plus the peak memory of a
+cold load. They are written as JSON and, with --baseline, compared against
+a saved run. The exit status is 1 if anything regressed by more than
+--tolerance.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+import sqlite_store
+from user import (
+    USERS_JSON_FILE, PrivilegeLevel, User, create_user, get_user, get_all_users,
+    update_user, delete_user,
+)
+from house import (
+    HOUSES_JSON_FILE, House, create_house, get_house, get_all_houses,
+    update_house, delete_house,
+)
+from room import (
+    ROOMS_JSON_FILE, Room, create_room, get_room, get_all_rooms, update_room, delete_room,
+)
+from generate import generate_fleet, load_fleet
+from device import (
+    DEVICES_JSON_FILE, DeviceType, create_device, get_device, get_all_devices,
+    update_device, delete_device, find_devices, Device,
+)
+
+DEFAULT_SIZES = "1000,10000,100000"
+# samples per single-record operation, and the work budget for operations
+# whose cost grows with the store (full listings, whole-file writes)
+POINT_SAMPLES = 200
+SCALED_BUDGET = 20_000
+# items per request for the /<entity>:batch routes
+BATCH_ITEMS = 50
+# latency metrics compared against the baseline
+COMPARED_METRICS = ("p50_ms", "p95_ms")
+
+# ---------- dataset ----------
+
+def build_dataset(size: int, seed: int = 0) -> Dict[str, int]:
+    """
+    Bulk-load the first `size` entities of generate.py's fleet (1-2 houses
+    per user, 1-3 floors of 1-3 rooms each, 2-6 devices per room). Parents
+    come before children, so any prefix of the fleet is consistent.
+    """
+    counts = load_fleet(itertools.islice(generate_fleet(users=size, seed=seed), size))
+    return {os.path.splitext(path)[0]: count for path, count in counts.items()}
+
+# ---------- measurement ----------
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(fn: Callable[[int], object], samples: int) -> dict:
+    """Call fn(i) `samples` times and summarize the latencies."""
+    timings = []
+    for i in range(samples):
+        start = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    total = sum(timings)
+    return {
+        "samples": samples,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "ops_per_sec": samples / total if total else float("inf"),
+    }
+
+# memory figures compared against the baseline
+MEMORY_METRICS = ("peak_load_mb", "cached_bytes_per_device")
+
+def load_memory() -> dict:
+    """
+    Peak MB allocated by a cold load of every store plus get_all_devices(),
+    and the bytes still held per device once the fleet is cached and hydrated.
+    """
+    storage.clear_cache()
+    tracemalloc.start()
+    try:
+        devices = get_all_devices()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "peak_load_mb": peak / 2**20,
+        "cached_bytes_per_device": current / max(len(devices), 1),
+    }
+
+def run_size(size: int, seed: int) -> dict:
+    counts = build_dataset(size, seed)
+    rng = random.Random(seed + 1)
+    pick = lambda path: rng.choices(list(storage.get_store(path).load()), k=POINT_SAMPLES)
+    user_ids, house_ids = pick(USERS_JSON_FILE), pick(HOUSES_JSON_FILE)
+    rooms = [storage.get_store(ROOMS_JSON_FILE).get(key) for key in pick(ROOMS_JSON_FILE)]
+    room_ids = [(r["house_id"], r["name"]) for r in rooms]
+    device_ids = pick(DEVICES_JSON_FILE)
+    scaled = max(3, min(POINT_SAMPLES // 4, SCALED_BUDGET // max(size, 1)))
+    room = get_room(room_ids[0][1], house_id=room_ids[0][0])
+
+    from fastapi.testclient import TestClient
+    from main import app
+    client = TestClient(app)
+    room_body = client.get(f"/houses/{room.house.house_id}/rooms/{room.name}").json()
+
+    ops = {}
+    ops["get_user"] = measure(lambda i: get_user(user_ids[i]), POINT_SAMPLES)
+    ops["get_house"] = measure(lambda i: get_house(house_ids[i]), POINT_SAMPLES)
+    ops["get_room"] = measure(lambda i: get_room(room_ids[i][1], house_id=room_ids[i][0]), POINT_SAMPLES)
+    ops["get_device"] = measure(lambda i: get_device(device_ids[i]), POINT_SAMPLES)
+    ops["get_all_users"] = measure(lambda i: get_all_users(), scaled)
+    ops["get_all_houses"] = measure(lambda i: get_all_houses(), scaled)
+    ops["get_all_rooms"] = measure(lambda i: get_all_rooms(), scaled)
+    ops["get_all_devices"] = measure(lambda i: get_all_devices(), scaled)
+    ops["find_devices_page"] = measure(lambda i: find_devices(limit=100), POINT_SAMPLES)
+    ops["find_devices_by_room"] = measure(
+        lambda i: find_devices(house_id=room_ids[i][0], room_name=room_ids[i][1]), POINT_SAMPLES
+    )
+    owner = get_user(user_ids[0])
+    ops["create_user"] = measure(
+        lambda i: create_user(User(f"bench-u{i}", "Bench", f"bench-u{i}@example.com", PrivilegeLevel.OWNER)),
+        scaled,
+    )
+    ops["update_user"] = measure(
+        lambda i: update_user(User(f"bench-u{i}", "Bench", f"bench-u{i}@example.org", PrivilegeLevel.RESIDENT)),
+        scaled,
+    )
+    ops["delete_user"] = measure(lambda i: delete_user(f"bench-u{i}"), scaled)
+    ops["create_house"] = measure(
+        lambda i: create_house(House(f"bench-h{i}", "1 Bench St", owner, (52.5, 13.4), 3, 1)), scaled
+    )
+    ops["update_house"] = measure(
+        lambda i: update_house(House(f"bench-h{i}", "2 Bench St", owner, (52.5, 13.4), 4, 2)), scaled
+    )
+    ops["delete_house"] = measure(lambda i: delete_house(f"bench-h{i}"), scaled)
+    ops["create_room"] = measure(lambda i: create_room(Room(f"bench-r{i}", 1, room.house)), scaled)
+    ops["update_room"] = measure(
+        lambda i: update_room(Room(f"bench-r{i}", 1, room.house), f"bench-r{i}-renamed"), scaled
+    )
+    ops["delete_room"] = measure(
+        lambda i: delete_room(f"bench-r{i}-renamed", house_id=room.house.house_id), scaled
+    )
+    ops["create_device"] = measure(
+        lambda i: create_device(Device(DeviceType.LIGHT, f"bench-{i}", room)), scaled
+    )
+    ops["update_device"] = measure(
+        lambda i: update_device(Device(DeviceType.SENSOR, f"bench-{i}", room)), scaled
+    )
+    ops["delete_device"] = measure(lambda i: delete_device(f"bench-{i}"), scaled)
+
+    ops["GET /devices/{id}"] = measure(lambda i: client.get(f"/devices/{device_ids[i]}"), POINT_SAMPLES)
+    ops["GET /devices?limit=100"] = measure(lambda i: client.get("/devices", params={"limit": 100}), POINT_SAMPLES)
+    ops["GET /devices"] = measure(lambda i: client.get("/devices"), scaled)
+    ops["GET /users"] = measure(lambda i: client.get("/users"), scaled)
+    ops["GET /houses?limit=100"] = measure(lambda i: client.get("/houses", params={"limit": 100}), POINT_SAMPLES)
+    ops["GET /houses"] = measure(lambda i: client.get("/houses"), scaled)
+    ops["GET /rooms?limit=100"] = measure(lambda i: client.get("/rooms", params={"limit": 100}), POINT_SAMPLES)
+    ops["GET /rooms"] = measure(lambda i: client.get("/rooms"), scaled)
+    ops["GET /houses/{id}/rooms/{name}/devices"] = measure(
+        lambda i: client.get(f"/houses/{room_ids[i][0]}/rooms/{room_ids[i][1]}/devices"), POINT_SAMPLES
+    )
+    ops["GET /houses/{id}/rooms"] = measure(
+        lambda i: client.get(f"/houses/{room_ids[i][0]}/rooms"), POINT_SAMPLES
+    )
+    ops["POST /devices"] = measure(
+        lambda i: client.post("/devices", json={"device_id": f"api-{i}", "type": "light", "room": room_body}),
+        scaled,
+    )
+    for i in range(scaled):
+        delete_device(f"api-{i}")
+    ops.update(measure_batches(client, room_body, scaled))
+
+    return {"entities": counts, **load_memory(), "ops": ops}
+
+def measure_batches(client, room_body: dict, samples: int) -> dict:
+    """
+    Time each /<entity>:batch route with BATCH_ITEMS items per request.
+    Request i creates its own set of entities; the update (for rooms, a
+    rename) and delete requests then work through those same sets.
+    """
+    house_body = room_body["house"]
+    house_id = house_body["house_id"]
+    ids = lambda prefix, i: [f"{prefix}-{i}-{n}" for n in range(BATCH_ITEMS)]
+    user = lambda u, privilege: dict(house_body["owner"], user_id=u, email=f"{u}@example.com", privilege=privilege)
+    device = lambda d, dev_type: {"device_id": d, "type": dev_type, "room": room_body}
+    # route -> step -> the body of request i
+    bodies = {
+        "/users:batch": {
+            "create": lambda i: {"create": [user(u, "owner") for u in ids("bu", i)]},
+            "update": lambda i: {"update": [user(u, "resident") for u in ids("bu", i)]},
+            "delete": lambda i: {"delete": ids("bu", i)},
+        },
+        "/houses:batch": {
+            "create": lambda i: {"create": [dict(house_body, house_id=h, num_baths=1) for h in ids("bh", i)]},
+            "update": lambda i: {"update": [dict(house_body, house_id=h, num_baths=2) for h in ids("bh", i)]},
+            "delete": lambda i: {"delete": ids("bh", i)},
+        },
+        "/rooms:batch": {
+            "create": lambda i: {"create": [dict(room_body, name=r) for r in ids("br", i)]},
+            "rename": lambda i: {"rename": [
+                {"name": r, "new_name": f"{r}-renamed", "house_id": house_id} for r in ids("br", i)
+            ]},
+            "delete": lambda i: {"delete": [f"{r}-renamed" for r in ids("br", i)]},
+        },
+        "/devices:batch": {
+            "create": lambda i: {"create": [device(d, "light") for d in ids("bd", i)]},
+            "update": lambda i: {"update": [device(d, "sensor") for d in ids("bd", i)]},
+            "delete": lambda i: {"delete": ids("bd", i)},
+        },
+    }
+
+    ops = {}
+    for route, steps in bodies.items():
+        for step, body in steps.items():
+            ops[f"POST {route} {step} x{BATCH_ITEMS}"] = measure(
+                lambda i, body=body: client.post(route, json=body(i)), samples
+            )
+    return ops
+
+def run(sizes: List[int], backend: str, seed: int) -> dict:
+    results = {
+        "meta": {
+            "backend": backend,
+            "seed": seed,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "sizes": {},
+    }
+    cwd = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix="smart-home-bench-") as scratch:
+            os.chdir(scratch)
+            storage.STORAGE_BACKEND = backend
+            storage._stores.clear()
+            sqlite_store.SQLITE_PATH = os.path.join(scratch, "smart_home.db")
+            sqlite_store._pools.clear()
+            try:
+                print(f"size {size} ...", file=sys.stderr)
+                results["sizes"][str(size)] = run_size(size, seed)
+            finally:
+                for pool in sqlite_store._pools.values():
+                    pool.close()
+                os.chdir(cwd)
+    return results
+
+# ---------- baseline comparison ----------
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Regressions of `results` against `baseline`: every compared latency that
+    grew by more than `tolerance` (0.25 = 25%), and any peak memory growth
+    beyond it. Sizes or operations missing from either side are ignored.
+    """
+    regressions = []
+    for size, current in results["sizes"].items():
+        previous = baseline.get("sizes", {}).get(size)
+        if previous is None:
+            continue
+        for op, stats in current["ops"].items():
+            old = previous["ops"].get(op)
+            if old is None:
+                continue
+            for metric in COMPARED_METRICS:
+                if old[metric] > 0 and stats[metric] > old[metric] * (1 + tolerance):
+                    regressions.append(
+                        f"{size} {op} {metric}: {old[metric]:.3f} -> {stats[metric]:.3f}"
+                    )
+        for metric in MEMORY_METRICS:
+            old, new = previous.get(metric), current.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{size} {metric}: {old:.1f} -> {new:.1f}")
+    return regressions
+
+def summary(results: dict) -> str:
+    lines = []
+    for size, current in results["sizes"].items():
+        lines.append(
+            f"== {size} entities ({current['entities']}), peak load {current['peak_load_mb']:.1f} MB, "
+            f"{current['cached_bytes_per_device']:.0f} bytes/device cached"
+        )
+        for op, stats in current["ops"].items():
+            lines.append(
+                f"  {op:38} p50 {stats['p50_ms']:9.3f} ms  p95 {stats['p95_ms']:9.3f} ms  "
+                f"p99 {stats['p99_ms']:9.3f} ms  {stats['ops_per_sec']:10.1f} ops/s"
+            )
+    return "\n".join(lines)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help=f"comma-separated entity counts (default {DEFAULT_SIZES}; 1000000 works too, slowly)")
+    parser.add_argument("--backend", default=storage.STORAGE_BACKEND, choices=sorted(storage.BACKENDS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before a metric counts as a regression (default 0.25)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    results = run(sizes, args.backend, args.seed)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(summary(results))
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONS:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"no regressions against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
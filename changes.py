@@ -0,0 +1,167 @@
+import itertools
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from storage import CursorError, decode_cursor, encode_cursor, get_store
+
+# ========== CHANGE LOG ==========
+#
+# Every create, update and delete in the users, houses, rooms and devices
+# stores gets the next sequence number, so a client can ask for what
+# changed since the last number it saw instead of downloading the fleet.
+# The log keeps one entry per changed record, under its sequence number:
+#   "00000000000000000042": {"kind": "device", "key": "d1"}
+# When a record changes again its old entry is dropped, so the log holds at
+# most one entry per record, and a sync returns each changed record once,
+# as it is now (or a tombstone if it's gone).
+#
+# Numbers are handed out inside one batch on the log store, which holds the
+# store's file lock throughout: numbering and writing the entries is atomic
+# across processes, and entries never show up out of order. That's why the
+# log always uses the log backend, whatever SMART_HOME_STORAGE says (a
+# SQLite batch only locks when it commits).
+#
+# The log keeps the newest MAX_HISTORY entries. Trimming older ones raises
+# the "floor": a client whose last number is below it has missed changes
+# that are no longer listed, and gets a full snapshot instead.
+
+CHANGES_JSON_FILE = "changes.json"
+# changed records the log remembers before the oldest are trimmed
+MAX_HISTORY = int(os.environ.get("SMART_HOME_CHANGE_HISTORY", "100000"))
+
+SYNCED_KINDS = ("user", "house", "room", "device")
+
+# sorts after every entry key; holds {"seq": newest, "floor": ..., "count": entries}
+HEAD_KEY = "head"
+
+def _changes_store():
+    store = get_store(CHANGES_JSON_FILE, "log")
+    store.ensure_index("key")
+    return store
+
+def _entity_stores() -> Dict[str, object]:
+    # parents first, so a client applying a snapshot in order never sees a
+    # device before its room
+    from user import USERS_JSON_FILE  # avoid circular import
+    from house import HOUSES_JSON_FILE
+    from room import ROOMS_JSON_FILE
+    from device import DEVICES_JSON_FILE
+    return {
+        "user": get_store(USERS_JSON_FILE),
+        "house": get_store(HOUSES_JSON_FILE),
+        "room": get_store(ROOMS_JSON_FILE),
+        "device": get_store(DEVICES_JSON_FILE),
+    }
+
+def _entry_key(seq: int) -> str:
+    return f"{seq:020d}"
+
+def _head(store) -> dict:
+    return store.get(HEAD_KEY) or {"seq": 0, "floor": 0, "count": 0}
+
+def record(changed: Iterable[Tuple[str, str]]) -> List[int]:
+    """
+    Number the given (kind, key) changes, in order, in one write. Called by
+    events.publish() once the records' own writes have landed. Returns the
+    sequence number of each.
+    """
+    changed = list(changed)
+    if not changed:
+        return []
+    store = _changes_store()
+    seqs = []
+    with store.batch():
+        head = dict(_head(store))
+        for kind, key in changed:
+            for old in store.find("key", key):
+                if store.get(old)["kind"] == kind:
+                    store.delete(old)
+                    head["count"] -= 1
+            head["seq"] += 1
+            head["count"] += 1
+            store.put(_entry_key(head["seq"]), {"kind": kind, "key": key})
+            seqs.append(head["seq"])
+        # trim in steps of a tenth, so a full log isn't scanned on every write
+        if head["count"] > MAX_HISTORY + MAX_HISTORY // 10:
+            for entry_key, _ in store.page(limit=head["count"] - MAX_HISTORY):
+                store.delete(entry_key)
+                head["floor"] = int(entry_key)
+            head["count"] = MAX_HISTORY
+        store.put(HEAD_KEY, head)
+    return seqs
+
+def reset_history() -> None:
+    """
+    Forget the history: every client gets a snapshot on its next sync. For
+    writes that bypass the CRUD functions, like generate.py's bulk loads.
+    """
+    store = _changes_store()
+    with store.batch():
+        head = _head(store)
+        for entry_key, _ in store.page(limit=head["count"]):
+            store.delete(entry_key)
+        seq = head["seq"] + 1
+        store.put(HEAD_KEY, {"seq": seq, "floor": seq, "count": 0})
+
+def _change(kind: str, key: str, record: Optional[dict]) -> dict:
+    return {"kind": kind, "key": key, "op": "delete" if record is None else "put", "data": record}
+
+def _snapshot_from(stores: Dict[str, object], kind: Optional[str], after: Optional[str]) -> Iterator[dict]:
+    kinds = list(stores)
+    start = kinds.index(kind) if kind is not None else 0
+    for i, name in enumerate(kinds[start:]):
+        for key, record in stores[name].scan(None, after if i == 0 else None):
+            yield _change(name, key, record)
+
+def _snapshot(seq: int, kind: Optional[str], after: Optional[str], limit: int) -> dict:
+    stores = _entity_stores()
+    if kind is not None and kind not in stores:
+        raise CursorError(f"Invalid cursor kind: {kind}")
+    items = list(itertools.islice(_snapshot_from(stores, kind, after), limit + 1))
+    more = len(items) > limit
+    items = items[:limit]
+    cursor = None
+    if more:
+        last = items[-1]
+        cursor = encode_cursor(f"{seq}/{last['kind']}/{last['key']}")
+    return {"seq": seq, "snapshot": True, "more": more, "cursor": cursor, "changes": items}
+
+def get_changes(since: int = 0, limit: int = 1000, cursor: Optional[str] = None) -> dict:
+    """
+    What changed after sequence number `since`, oldest first, at most
+    `limit` records:
+      {"seq": 57, "snapshot": false, "more": false, "cursor": null,
+       "changes": [{"kind": "device", "key": "d1", "op": "put", "data": {...}},
+                   {"kind": "room", "key": "h1/Den", "op": "delete", "data": null}]}
+    Pass "seq" back as `since` next time; "more" means call again right away.
+    With since=0, a number below the floor, or one this log never handed
+    out, the answer is a snapshot instead: every record, "snapshot": true,
+    paged with `cursor` until "more" is false. Its "seq" was read before the
+    snapshot started, so changes made while it is paged come again on the
+    next sync.
+    """
+    if cursor is not None:
+        seq, kind, after = (decode_cursor(cursor).split("/", 2) + [None, None])[:3]
+        if after is None or not seq.isdigit():
+            raise CursorError(f"Invalid cursor: {cursor}")
+        return _snapshot(int(seq), kind, after, limit)
+
+    store = _changes_store()
+    head = _head(store)
+    if since <= 0 or since < head["floor"] or since > head["seq"]:
+        return _snapshot(head["seq"], None, None, limit)
+
+    entries = []
+    for entry_key, entry in store.scan(None, _entry_key(since)):
+        if entry_key == HEAD_KEY or len(entries) > limit:
+            break
+        entries.append((int(entry_key), entry))
+    more = len(entries) > limit
+    entries = entries[:limit]
+    stores = _entity_stores()
+    changes = [
+        _change(entry["kind"], entry["key"], stores[entry["kind"]].get(entry["key"]))
+        for _, entry in entries
+    ]
+    seq = entries[-1][0] if entries else head["seq"]
+    return {"seq": seq, "snapshot": False, "more": more, "cursor": None, "changes": changes}
@@ -0,0 +1,61 @@
+import json
+import os
+from typing import IO, Any, Union
+
+# ========== JSON CODEC ==========
+#
+# Every JSON file, log line, SQLite record column and API response goes
+# through these functions, so the encoder is chosen in one place:
+#   SMART_HOME_JSON_CODEC=auto    - (default) orjson if it is installed, else stdlib
+#   SMART_HOME_JSON_CODEC=orjson  - require orjson
+#   SMART_HOME_JSON_CODEC=stdlib  - always use the json module
+# Store files are written compact; set SMART_HOME_JSON_PRETTY=1 to get the
+# old indent=2 files back (they are about 30% larger and slower to parse).
+# Either way the output is plain JSON that both codecs read.
+
+CODEC = os.environ.get("SMART_HOME_JSON_CODEC", "auto")
+PRETTY = os.environ.get("SMART_HOME_JSON_PRETTY", "0") == "1"
+
+orjson = None
+if CODEC in ("auto", "orjson"):
+    try:
+        import orjson
+    except ImportError:
+        if CODEC == "orjson":
+            raise
+elif CODEC != "stdlib":
+    raise ValueError(f"Unknown JSON codec: {CODEC}")
+
+NAME = "orjson" if orjson is not None else "stdlib"
+
+_compact = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode
+
+def dumps(obj: Any) -> str:
+    """Compact JSON text."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return _compact(obj)
+
+def dumps_bytes(obj: Any) -> bytes:
+    """Compact JSON, UTF-8 encoded, as an HTTP body."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _compact(obj).encode("utf-8")
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dump_file(obj: Any, f: IO[bytes]) -> None:
+    """Write `obj` to a file opened in binary mode, compact unless PRETTY."""
+    if orjson is not None:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 if PRETTY else 0))
+    elif PRETTY:
+        f.write(json.dumps(obj, indent=2).encode("utf-8"))
+    else:
+        f.write(_compact(obj).encode("utf-8"))
+
+def load_file(f: IO[bytes]) -> Any:
+    """Parse a whole file opened in binary mode."""
+    return loads(f.read())
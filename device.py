@@ -1,22 +1,18 @@
-import json
-import os
 from enum import Enum
-from typing import Optional
-from room import Room, room_from_dict
-from house import House
-from user import User, PrivilegeLevel
+from functools import partial
+from typing import Iterable, Iterator, Optional, Tuple
+from room import Room, RoomNotFoundError, get_room, room_exists, room_from_dict, room_key
+from house import get_house_ids_by_owner
+from events import after_commit, batch_with_events, publish
+from storage import IdentityMap, decode_cursor, get_store, paginate
 
 DEVICES_JSON_FILE = "devices.json"
 
 def load_devices_from_json() -> dict:
-    if not os.path.exists(DEVICES_JSON_FILE):
-        return {}
-    with open(DEVICES_JSON_FILE, "r") as f:
-        return json.load(f)
+    return get_store(DEVICES_JSON_FILE).load()
 
 def save_devices_to_json(devices_data: dict) -> None:
-    with open(DEVICES_JSON_FILE, "w") as f:
-        json.dump(devices_data, f, indent=2)
+    get_store(DEVICES_JSON_FILE).save(devices_data)
 
 class DeviceType(Enum):
     LIGHT = "light"
@@ -25,6 +21,10 @@ class DeviceType(Enum):
     LOCK = "lock"
     SENSOR = "sensor"
 
+# value -> member, for hydration; a plain dict lookup is several times
+# cheaper than calling DeviceType(value)
+DEVICE_TYPES = {t.value: t for t in DeviceType}
+
 class DeviceNotFoundError(Exception):
     pass
 
@@ -35,6 +35,8 @@ class ConflictError(Exception):
     pass
 
 class Device:
+    __slots__ = ("type", "device_id", "room")
+
     def __init__(self, type: DeviceType, device_id: str, room: Room):
         if not isinstance(type, DeviceType):
             raise ValidationError(f"Invalid device type: {type}")
@@ -47,80 +49,260 @@ class Device:
         self.device_id = device_id
         self.room = room
 
+    @classmethod
+    def _trusted(cls, type: DeviceType, device_id: str, room: Room) -> "Device":
+        """Build a Device from already-validated data, skipping __init__'s checks."""
+        device = object.__new__(cls)
+        device.type = type
+        device.device_id = device_id
+        device.room = room
+        return device
+
     def __eq__(self, other):
+        if not isinstance(other, Device):
+            return NotImplemented
         return (
             self.device_id == other.device_id
             and self.type == other.type
             and self.room == other.room
         )
 
+    def __hash__(self):
+        return hash(self.device_id)
+
 def device_to_dict(device: Device) -> dict:
+    # the room is stored by reference: its name plus house_id make up the
+    # room's key (names are only unique within a house)
     return {
         "device_id": device.device_id,
         "type": device.type.value,
-        "room": {
-            "name": device.room.name,
-            "floor": device.room.floor,
-            "house": {
-                "house_id": device.room.house.house_id,
-                "address": device.room.house.address,
-                "owner": {
-                    "user_id": device.room.house.owner.user_id,
-                    "name": device.room.house.owner.name,
-                    "email": device.room.house.owner.email,
-                    "privilege": device.room.house.owner.privilege.value
-                },
-                "gps_location": device.room.house.gps_location,
-                "num_rooms": device.room.house.num_rooms,
-                "num_baths": device.room.house.num_baths
-            }
-        }
+        "room_name": device.room.name,
+        "house_id": device.room.house.house_id
     }
 
-def device_from_dict(data: dict) -> Device:
-    from room import room_from_dict
+def _room_from_record(data: dict, identity_map: Optional[IdentityMap]) -> Room:
+    if "room" in data:
+        # records written before rooms were stored by reference
+        return room_from_dict(data["room"], identity_map)
+    room_name, house_id = data["room_name"], data.get("house_id")
+    try:
+        if identity_map is None:
+            return get_room(room_name, house_id=house_id)
+        return identity_map.get(
+            "room", room_key(house_id, room_name),
+            lambda: get_room(room_name, identity_map, house_id=house_id),
+        )
+    except RoomNotFoundError:
+        raise DeviceNotFoundError(
+            f"Room '{room_name}' of device {data['device_id']} not found"
+        )
+
+def device_from_dict(data: dict, identity_map: Optional[IdentityMap] = None) -> Device:
     device_type = DeviceType(data["type"])
-    room_data = data["room"]
-    # Reuse existing logic
-    room_obj = room_from_dict(room_data)
+    room_obj = _room_from_record(data, identity_map)
     return Device(type=device_type, device_id=data["device_id"], room=room_obj)
 
+def _load_device(record: dict, identity_map: Optional[IdentityMap] = None) -> Device:
+    # a record read from the store was validated when it was written
+    room_obj = _room_from_record(record, identity_map)
+    return Device._trusted(DEVICE_TYPES[record["type"]], record["device_id"], room_obj)
+
+# secondary indexes on the device store, kept up to date by every put/delete
+# in create_device/update_device/delete_device; a device's owner is reached
+# through the owner index on houses
+DEVICE_INDEXES = ("room_name", "house_id", "type")
+
+def _device_store():
+    store = get_store(DEVICES_JSON_FILE)
+    for name in DEVICE_INDEXES:
+        store.ensure_index(name)
+    return store
+
+def _check_room_exists(device: Device) -> None:
+    house_id = device.room.house.house_id
+    if not room_exists(device.room.name, house_id):
+        raise ValidationError(f"Room '{device.room.name}' does not exist in house {house_id}")
+
+def _publish_device(op: str, record: dict, previous: Optional[dict] = None) -> None:
+    # a device that moved also goes to the subscribers of the room it left
+    where = None if previous is None else (previous.get("house_id"), previous["room_name"])
+    publish(
+        "device", op, record["device_id"], None if op == "delete" else record,
+        record.get("house_id"), record["room_name"], where
+    )
+
 # ========== CRUD OPERATIONS ==========
 
 def create_device(device: Device) -> Device:
-    devices_data = load_devices_from_json()
-    if device.device_id in devices_data:
+    store = _device_store()
+    if device.device_id in store:
         raise ConflictError(f"Device ID {device.device_id} already exists")
+    _check_room_exists(device)
     
-    devices_data[device.device_id] = device_to_dict(device)
-    save_devices_to_json(devices_data)
+    record = device_to_dict(device)
+    # the check above fails fast; this one is atomic with the write
+    if not store.put_if_absent(device.device_id, record):
+        raise ConflictError(f"Device ID {device.device_id} already exists")
+    _publish_device("create", record)
     return device
 
 def get_device(device_id: str) -> Device:
-    devices_data = load_devices_from_json()
-    if device_id not in devices_data:
+    record = _device_store().get(device_id)
+    if record is None:
         raise DeviceNotFoundError(f"Device {device_id} not found")
-    return device_from_dict(devices_data[device_id])
+    return _load_device(record)
+
+def device_exists(device_id: str) -> bool:
+    return device_id in _device_store()
+
+def device_location(device_id: str) -> Tuple[Optional[str], str]:
+    """(house_id, room_name) of a device, read off its record without hydrating it."""
+    record = _device_store().get(device_id)
+    if record is None:
+        raise DeviceNotFoundError(f"Device {device_id} not found")
+    return record.get("house_id"), record["room_name"]
+
+def get_device_type(device_id: str) -> DeviceType:
+    """A device's type, read from its record without hydrating its room."""
+    record = _device_store().get(device_id)
+    if record is None:
+        raise DeviceNotFoundError(f"Device {device_id} not found")
+    return DEVICE_TYPES[record["type"]]
 
 def get_all_devices() -> list[Device]:
     devices_data = load_devices_from_json()
-    device_list = []
-    for dev_id, dev_dict in devices_data.items():
-        device_list.append(device_from_dict(dev_dict))
-    return device_list
+    return list(_hydrate_devices(devices_data.values()))
+
+def _device_filter(
+    type: Optional[DeviceType],
+    room_name: Optional[str],
+    house_id: Optional[str],
+    owner_id: Optional[str],
+) -> dict:
+    where = {}
+    if type is not None:
+        where["type"] = type.value
+    if room_name is not None:
+        where["room_name"] = room_name
+    if house_id is not None:
+        where["house_id"] = house_id
+    if owner_id is not None:
+        owned = set(get_house_ids_by_owner(owner_id))
+        if house_id is not None:
+            owned &= {house_id}
+        where["house_id"] = owned
+    return where
+
+def _hydrate_devices(records: Iterable[dict]) -> Iterator[Device]:
+    identity_map = IdentityMap()
+    for record in records:
+        try:
+            yield _load_device(record, identity_map)
+        except DeviceNotFoundError:
+            # orphaned by a deleted room, house or owner
+            continue
+
+def find_devices(
+    type: Optional[DeviceType] = None,
+    room_name: Optional[str] = None,
+    house_id: Optional[str] = None,
+    owner_id: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[list[Device], Optional[str]]:
+    """
+    One page of devices in device_id order matching every given filter,
+    plus the cursor for the next page.
+    """
+    where = _device_filter(type, room_name, house_id, owner_id)
+    records, next_cursor = paginate(_device_store(), where, limit, cursor)
+    return list(_hydrate_devices(records)), next_cursor
+
+def iter_devices(
+    type: Optional[DeviceType] = None,
+    room_name: Optional[str] = None,
+    house_id: Optional[str] = None,
+    owner_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+) -> Iterator[Device]:
+    """
+    Lazily yield the devices find_devices() would return, without paging.
+    Records are decoded and hydrated one at a time as the caller consumes
+    them, so memory stays flat however many devices match.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    where = _device_filter(type, room_name, house_id, owner_id)
+    records = (r for _, r in _device_store().scan(where, after))
+    return _hydrate_devices(records)
+
+def device_batch():
+    """
+    Context manager grouping the create_device/update_device/delete_device calls made
+    inside it into a single write. If the block raises, none of them land.
+    """
+    return batch_with_events(_device_store())
 
 def update_device(updated_device: Device) -> Device:
-    devices_data = load_devices_from_json()
-    if updated_device.device_id not in devices_data:
+    store = _device_store()
+    old = store.get(updated_device.device_id)
+    if old is None:
         raise DeviceNotFoundError(f"Device {updated_device.device_id} not found")
+    _check_room_exists(updated_device)
     
-    devices_data[updated_device.device_id] = device_to_dict(updated_device)
-    save_devices_to_json(devices_data)
+    record = device_to_dict(updated_device)
+    store.put(updated_device.device_id, record)
+    _publish_device("update", record, old)
     return updated_device
 
+def rename_device_room(house_id: str, old_room_name: str, new_room_name: str) -> None:
+    """Re-point the devices of a renamed room, only that house's, in one batched write."""
+    store = _device_store()
+    with batch_with_events(store):
+        for device_id in device_ids_in_room(house_id, old_room_name):
+            record = store.get(device_id)
+            moved = dict(record, room_name=new_room_name)
+            store.put(device_id, moved)
+            _publish_device("update", moved, record)
+
+def device_ids_in_houses(house_ids: Iterable[str]) -> list[str]:
+    """Ids of the devices in the given houses, via the house index."""
+    store = _device_store()
+    return [device_id for house_id in house_ids for device_id in store.find("house_id", house_id)]
+
+def device_ids_in_room(house_id: str, room_name: str) -> list[str]:
+    """Ids of the devices in one room; only that house's devices are looked at."""
+    where = {"house_id": house_id, "room_name": room_name}
+    return [device_id for device_id, _ in _device_store().scan(where)]
+
+def delete_devices(device_ids: Iterable[str]) -> None:
+    """Delete the given devices, then their state and telemetry; one batched write per store."""
+    from device_state import delete_states  # avoid circular import
+    from telemetry import delete_telemetry
+    device_ids = list(device_ids)
+    if not device_ids:
+        return
+    store = _device_store()
+    with batch_with_events(store):
+        for device_id in device_ids:
+            record = store.get(device_id)
+            store.delete(device_id)
+            if record is not None:
+                _publish_device("delete", record)
+        # not undone by a rollback, so they wait for the enclosing batch to commit
+        after_commit(partial(delete_states, device_ids))
+        after_commit(partial(delete_telemetry, device_ids))
+
 def delete_device(device_id: str) -> None:
-    devices_data = load_devices_from_json()
-    if device_id not in devices_data:
+    from device_state import delete_states  # avoid circular import
+    from telemetry import delete_telemetry
+    store = _device_store()
+    record = store.get(device_id)
+    if record is None:
         raise DeviceNotFoundError(f"Device {device_id} not found")
-    del devices_data[device_id]
-    save_devices_to_json(devices_data)
\ No newline at end of file
+    store.delete(device_id)
+    _publish_device("delete", record)
+    # state and readings are kept apart from the registry (see
+    # device_state.py and telemetry.py); dropping them waits for the
+    # enclosing batch to commit
+    after_commit(partial(delete_states, [device_id]))
+    after_commit(partial(delete_telemetry, [device_id]))
\ No newline at end of file
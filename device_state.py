@@ -0,0 +1,196 @@
+import os
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import codec
+from device import DeviceNotFoundError, device_exists, device_location
+from events import publish
+from storage import get_store
+
+# ========== DEVICE STATE ==========
+#
+# What a device is (devices.json) changes rarely; what it is doing changes
+# all the time. State lives in its own store so a light switching on never
+# rewrites the device registry. Each device has one record:
+#   {"device_id": ..., "version": 3,
+#    "reported": {"on": true, "brightness": 80},   # last state the device sent
+#    "desired": {"brightness": 40}}                # what clients asked for
+# Updates are JSON merge patches (RFC 7386): fields are set, nested objects
+# are merged, and null removes a field. Every update that changes something
+# bumps the version by one.
+#
+# The store defaults to the log backend whatever SMART_HOME_STORAGE says: an
+# update appends one line instead of rewriting a file, and with group commit
+# on, a burst of updates shares one fsync. SMART_HOME_STATE_STORAGE picks
+# another backend (json, log or sqlite).
+
+DEVICE_STATE_JSON_FILE = "device_state.json"
+STATE_STORAGE = os.environ.get("SMART_HOME_STATE_STORAGE", "log")
+# largest encoded reported + desired document a device may keep
+MAX_STATE_BYTES = int(os.environ.get("SMART_HOME_MAX_STATE_BYTES", "8192"))
+
+class ValidationError(Exception):
+    pass
+
+class ConflictError(Exception):
+    pass
+
+class DeviceState:
+    __slots__ = ("device_id", "version", "reported", "desired")
+
+    def __init__(self, device_id: str, version: int, reported: dict, desired: dict):
+        self.device_id = device_id
+        self.version = version
+        self.reported = reported
+        self.desired = desired
+
+    @property
+    def delta(self) -> dict:
+        """The desired fields the device hasn't reported yet."""
+        return _delta(self.desired, self.reported)
+
+    def __eq__(self, other):
+        if not isinstance(other, DeviceState):
+            return False
+        return (
+            self.device_id == other.device_id and
+            self.version == other.version and
+            self.reported == other.reported and
+            self.desired == other.desired
+        )
+
+def _state_store():
+    return get_store(DEVICE_STATE_JSON_FILE, STATE_STORAGE)
+
+def state_to_dict(state: DeviceState) -> dict:
+    return {
+        "device_id": state.device_id,
+        "version": state.version,
+        "reported": state.reported,
+        "desired": state.desired
+    }
+
+def state_from_dict(data: dict) -> DeviceState:
+    return DeviceState(data["device_id"], data["version"], data["reported"], data["desired"])
+
+def _same(a: Any, b: Any) -> bool:
+    # True == 1 in Python, but a light that reports true instead of 1 changed
+    return type(a) is type(b) and a == b
+
+def _merge(current: dict, patch: dict) -> Tuple[dict, dict]:
+    """
+    Apply merge patch `patch` to `current`. Returns the merged dict (a new
+    one; stored records are never mutated) and the part of the patch that
+    actually changed something, itself a merge patch.
+    """
+    merged, changed = dict(current), {}
+    for field, value in patch.items():
+        if value is None:
+            if field in merged:
+                del merged[field]
+                changed[field] = None
+        elif isinstance(value, dict) and isinstance(merged.get(field), dict):
+            merged[field], inner = _merge(merged[field], value)
+            if inner:
+                changed[field] = inner
+        else:
+            if isinstance(value, dict):
+                value = _merge({}, value)[0]  # nulls inside a new object mean nothing
+            if field not in merged or not _same(merged[field], value):
+                merged[field] = value
+                changed[field] = value
+    return merged, changed
+
+def _delta(desired: dict, reported: dict) -> dict:
+    delta = {}
+    for field, wanted in desired.items():
+        actual = reported.get(field)
+        if isinstance(wanted, dict) and isinstance(actual, dict):
+            inner = _delta(wanted, actual)
+            if inner:
+                delta[field] = inner
+        elif not _same(wanted, actual):
+            delta[field] = wanted
+    return delta
+
+def _check_patch(name: str, patch: Optional[dict]) -> None:
+    if patch is None:
+        return
+    if not isinstance(patch, dict):
+        raise ValidationError(f"{name} must be an object")
+    for field, value in patch.items():
+        if not isinstance(field, str) or not field:
+            raise ValidationError(f"{name} field names must be non-empty strings")
+        if isinstance(value, dict):
+            _check_patch(name, value)
+
+# ========== STATE OPERATIONS ==========
+
+def get_state(device_id: str) -> DeviceState:
+    """
+    The state of a device. A registered device that never reported anything
+    has version 0 and empty documents.
+    """
+    record = _state_store().get(device_id)
+    if record is not None:
+        return state_from_dict(record)
+    if not device_exists(device_id):
+        raise DeviceNotFoundError(f"Device {device_id} not found")
+    return DeviceState(device_id, 0, {}, {})
+
+def update_state(
+    device_id: str,
+    reported: Optional[dict] = None,
+    desired: Optional[dict] = None,
+    expected_version: Optional[int] = None,
+) -> Tuple[DeviceState, Dict[str, dict]]:
+    """
+    Merge `reported` and/or `desired` into the device's state, atomically.
+    Returns the new state and what changed, as {"reported": patch,
+    "desired": patch} with only the sides and fields that changed. If
+    nothing changed, nothing is written and the version stays the same.
+    With `expected_version`, the update is refused (ConflictError) unless
+    the stored version still matches.
+    """
+    _check_patch("reported", reported)
+    _check_patch("desired", desired)
+    house_id, room_name = device_location(device_id)
+    changes: Dict[str, dict] = {}
+
+    def change(record: Optional[dict]) -> Optional[dict]:
+        state = record or {"device_id": device_id, "version": 0, "reported": {}, "desired": {}}
+        if expected_version is not None and state["version"] != expected_version:
+            raise ConflictError(
+                f"Device {device_id} state is at version {state['version']}, not {expected_version}"
+            )
+        new_state = dict(state)
+        for side, patch in (("reported", reported), ("desired", desired)):
+            if patch:
+                new_state[side], changed = _merge(state[side], patch)
+                if changed:
+                    changes[side] = changed
+        if not changes:
+            return None
+        size = len(codec.dumps(new_state["reported"])) + len(codec.dumps(new_state["desired"]))
+        if size > MAX_STATE_BYTES:
+            raise ValidationError(
+                f"Device {device_id} state would be {size} bytes; the limit is {MAX_STATE_BYTES}"
+            )
+        new_state["version"] = state["version"] + 1
+        return new_state
+
+    record = _state_store().update(device_id, change)
+    if record is None:
+        return get_state(device_id), {}
+    publish("device_state", "update", device_id, {"version": record["version"], **changes},
+            house_id, room_name)
+    return state_from_dict(record), changes
+
+def delete_states(device_ids: Iterable[str]) -> None:
+    """Drop the state of the given devices in one batched write."""
+    store = _state_store()
+    device_ids = [device_id for device_id in device_ids if device_id in store]
+    if not device_ids:
+        return
+    with store.batch():
+        for device_id in device_ids:
+            store.delete(device_id)
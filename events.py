@@ -0,0 +1,296 @@
+import asyncio
+import itertools
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+import changes
+import codec
+
+# ========== CHANGE FEED ==========
+#
+# The CRUD functions publish an event for every record they create, update
+# or delete, and GET /events streams them to clients as Server-Sent Events,
+# so nobody has to poll a list to notice that something changed. An event:
+#   {"id": 42, "kind": "device", "op": "update", "key": "d1",
+#    "house_id": "house456", "room_name": "Kitchen", "seq": 1234, "data": {...}}
+# `data` is the record as stored (null on deletes). Device state events
+# carry the change update_state() returned, plus the new version. `seq` is
+# the change's number in the change log (see changes.py), null for device
+# state, which isn't logged.
+#
+# Every subscriber has a bounded queue. Publishing never waits for a slow
+# client: a subscriber more than QUEUE_SIZE events behind has its queue
+# dropped and gets a single "resync" event once it catches up, meaning "you
+# missed changes": GET /changes?since=<last seq seen> catches it up.
+#
+# Subscribers are filed under the house they filter on, so an event only
+# looks at the subscribers that could want it. A waiting subscriber is an
+# empty deque and a suspended coroutine; nothing runs for it until an event
+# arrives or a heartbeat is due.
+#
+# The feed is per process: with several workers, each one streams the
+# changes made through it.
+
+# events a subscriber may fall behind by before it's dropped to a resync
+QUEUE_SIZE = int(os.environ.get("SMART_HOME_EVENT_QUEUE_SIZE", "1000"))
+# seconds between keep-alive comments on an idle stream
+HEARTBEAT = float(os.environ.get("SMART_HOME_EVENT_HEARTBEAT", "15"))
+# how long clients wait before reconnecting, in milliseconds
+RETRY_MS = 3000
+
+KINDS = ("user", "house", "room", "device", "device_state")
+
+RESYNC_FRAME = "event: resync\ndata: {}\n\n"
+KEEPALIVE_FRAME = ": keep-alive\n\n"
+
+class ValidationError(Exception):
+    pass
+
+class Event:
+    __slots__ = (
+        "id", "seq", "kind", "op", "key", "data", "house_id", "room_name", "previous", "_frame"
+    )
+
+    def __init__(
+        self,
+        kind: str,
+        op: str,
+        key: str,
+        data: Optional[dict],
+        house_id: Optional[str],
+        room_name: Optional[str],
+        previous: Optional[Tuple[Optional[str], Optional[str]]],
+    ):
+        self.id = 0  # numbered on delivery
+        self.seq = None
+        self.kind = kind
+        self.op = op
+        self.key = key
+        self.data = data
+        self.house_id = house_id
+        self.room_name = room_name
+        # (house_id, room_name) a device was in before this update, if it moved
+        self.previous = previous
+        self._frame = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "op": self.op,
+            "key": self.key,
+            "house_id": self.house_id,
+            "room_name": self.room_name,
+            "seq": self.seq,
+            "data": self.data
+        }
+
+    def frame(self) -> str:
+        # encoded once, however many subscribers it goes to
+        if self._frame is None:
+            self._frame = (
+                f"id: {self.id}\nevent: {self.kind}.{self.op}\n"
+                f"data: {codec.dumps(self.to_dict())}\n\n"
+            )
+        return self._frame
+
+class Subscription:
+    __slots__ = ("house_id", "room_name", "kinds", "queue", "lagged", "_loop", "_wakeup")
+
+    def __init__(
+        self,
+        house_id: Optional[str],
+        room_name: Optional[str],
+        kinds: Optional[FrozenSet[str]],
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.house_id = house_id
+        self.room_name = room_name
+        self.kinds = kinds
+        self.queue: deque = deque()
+        self.lagged = False
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+
+    def wants(self, event: Event) -> bool:
+        if self.kinds is not None and event.kind not in self.kinds:
+            return False
+        if self.room_name is None:
+            return True
+        place = (self.house_id, self.room_name)
+        return (event.house_id, event.room_name) == place or event.previous == place
+
+    def _push(self, event: Event) -> None:
+        # under _lock, on the publishing thread
+        if self.lagged:
+            return  # the pending resync covers this one too
+        if len(self.queue) >= QUEUE_SIZE:
+            self.queue.clear()
+            self.lagged = True  # a wakeup is already pending: the queue wasn't empty
+            return
+        self.queue.append(event)
+        if len(self.queue) == 1:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass  # its loop is closed; it's being unsubscribed
+
+    def _drain(self) -> Tuple[List[Event], bool]:
+        # on the subscriber's loop. Clearing the wakeup before taking the
+        # queue means an event pushed in between sets it again.
+        self._wakeup.clear()
+        with _lock:
+            events, lagged = list(self.queue), self.lagged
+            self.queue.clear()
+            self.lagged = False
+        return events, lagged
+
+_lock = threading.Lock()
+# house_id filtered on -> its subscribers; None holds the unfiltered ones
+_subscribers: Dict[Optional[str], Set[Subscription]] = {}
+_ids = itertools.count(1)
+_pending = threading.local()
+
+def parse_kinds(value: Optional[str]) -> Optional[FrozenSet[str]]:
+    """A comma-separated list of event kinds, or None for all of them."""
+    if value is None:
+        return None
+    kinds = frozenset(kind.strip() for kind in value.split(",") if kind.strip())
+    unknown = kinds.difference(KINDS)
+    if unknown:
+        raise ValidationError(f"Unknown event kind(s): {', '.join(sorted(unknown))}")
+    return kinds
+
+def publish(
+    kind: str,
+    op: str,
+    key: str,
+    data: Optional[dict] = None,
+    house_id: Optional[str] = None,
+    room_name: Optional[str] = None,
+    previous: Optional[Tuple[Optional[str], Optional[str]]] = None,
+) -> None:
+    """
+    Announce that a record was created, updated or deleted: it is numbered
+    in the change log and sent to subscribers. Called by the CRUD functions
+    once the write has landed; inside deferred(), the event waits for the
+    block to finish.
+    """
+    if not _subscribers and kind not in changes.SYNCED_KINDS:
+        return  # nobody is listening, and there's nothing to log
+    if previous == (house_id, room_name):
+        previous = None
+    event = Event(kind, op, key, data, house_id, room_name, previous)
+    held = getattr(_pending, "events", None)
+    if held is not None:
+        held.append(event)
+    else:
+        _deliver([event])
+
+def _deliver(events: List[Event]) -> None:
+    logged = [event for event in events if event.kind in changes.SYNCED_KINDS]
+    seqs = changes.record((event.kind, event.key) for event in logged)
+    for event, seq in zip(logged, seqs):
+        event.seq = seq
+    if not _subscribers:
+        return
+    with _lock:
+        for event in events:
+            event.id = next(_ids)
+            houses = {None, event.house_id}
+            if event.previous is not None:
+                houses.add(event.previous[0])
+            for house_id in houses:
+                for subscription in _subscribers.get(house_id, ()):
+                    if subscription.wants(event):
+                        subscription._push(event)
+
+@contextmanager
+def deferred():
+    """
+    Hold the events published inside the block until it exits, then log
+    and send them together (one change log write); drop them if it
+    raises. Wraps store batches, whose writes only land when the batch
+    commits. Nested blocks leave it to the outermost one.
+    """
+    if getattr(_pending, "events", None) is not None:
+        yield
+        return
+    _pending.events, _pending.actions = held, actions = [], []
+    try:
+        yield
+    finally:
+        _pending.events = _pending.actions = None
+    if held:
+        _deliver(held)
+    for action in actions:
+        action()
+
+def after_commit(action: Callable[[], None]) -> None:
+    """
+    Run `action` once the writes made so far have landed: right away, or
+    when the enclosing deferred() block exits normally. If the block raises
+    (a rolled-back batch), it never runs. For side effects that can't be
+    undone, like dropping a deleted device's state.
+    """
+    actions = getattr(_pending, "actions", None)
+    if actions is None:
+        action()
+    else:
+        actions.append(action)
+
+@contextmanager
+def batch_with_events(store):
+    """store.batch(), with the events published inside it held until it commits."""
+    with deferred(), store.batch() as batch:
+        yield batch
+
+def _subscribe(
+    house_id: Optional[str], room_name: Optional[str], kinds: Optional[FrozenSet[str]]
+) -> Subscription:
+    subscription = Subscription(house_id, room_name, kinds, asyncio.get_running_loop())
+    with _lock:
+        _subscribers.setdefault(house_id, set()).add(subscription)
+    return subscription
+
+def _unsubscribe(subscription: Subscription) -> None:
+    with _lock:
+        bucket = _subscribers.get(subscription.house_id)
+        if bucket is not None:
+            bucket.discard(subscription)
+            if not bucket:
+                del _subscribers[subscription.house_id]
+
+async def stream(
+    house_id: Optional[str] = None,
+    room_name: Optional[str] = None,
+    kinds: Optional[FrozenSet[str]] = None,
+    resync: bool = False,
+) -> AsyncIterator[str]:
+    """
+    The text/event-stream of the events matching the filters: a room filter
+    needs its house. The subscription starts when the stream is first read
+    and ends when it is closed. With `resync` (a client reconnecting with
+    Last-Event-ID), it opens with a resync event: whatever happened while
+    the client was away is gone.
+    """
+    subscription = _subscribe(house_id, room_name, kinds)
+    try:
+        yield f"retry: {RETRY_MS}\n\n" + (RESYNC_FRAME if resync else "")
+        while True:
+            events, lagged = subscription._drain()
+            if lagged:
+                yield RESYNC_FRAME
+            if events:
+                yield "".join(event.frame() for event in events)
+            if lagged or events:
+                continue
+            try:
+                await asyncio.wait_for(subscription._wakeup.wait(), HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield KEEPALIVE_FRAME
+    finally:
+        _unsubscribe(subscription)
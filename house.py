@@ -1,9 +1,20 @@
-import json
+import bisect
+import heapq
+import math
 import os
-from typing import Tuple
-from user import User, PrivilegeLevel, ValidationError as UserValidationError
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+from user import (
+    OnDelete, User, USERS_JSON_FILE, NotFoundError as UserNotFoundError,
+    get_user, user_from_dict
+)
+from events import batch_with_events, deferred, publish
+from storage import IdentityMap, decode_cursor, encode_cursor, get_store, paginate
 
 HOUSES_JSON_FILE = "houses.json"
+# side, in degrees, of the square grid cells the geo index buckets houses into
+GEO_CELL_DEGREES = float(os.environ.get("SMART_HOME_GEO_CELL_DEGREES", "0.05"))
+EARTH_RADIUS_KM = 6371.0088
 
 class HouseNotFoundError(Exception):
     pass
@@ -15,6 +26,8 @@ class ConflictError(Exception):
     pass
 
 class House:
+    __slots__ = ("house_id", "address", "owner", "gps_location", "num_rooms", "num_baths")
+
     def __init__(
         self,
         house_id: str,
@@ -26,6 +39,10 @@ class House:
     ):
         if not isinstance(owner, User):
             raise ValidationError("Owner must be a valid User")
+
+        if "/" in house_id:
+            # it separates the house from the room name in room keys
+            raise ValidationError("House ID cannot contain '/'")
             
         if not (-90 <= gps_location[0] <= 90) or not (-180 <= gps_location[1] <= 180):
             raise ValidationError("Invalid GPS coordinates")
@@ -40,7 +57,29 @@ class House:
         self.num_rooms = num_rooms
         self.num_baths = num_baths
 
+    @classmethod
+    def _trusted(
+        cls,
+        house_id: str,
+        address: str,
+        owner: User,
+        gps_location: Tuple[float, float],
+        num_rooms: int,
+        num_baths: int
+    ) -> "House":
+        """Build a House from already-validated data, skipping __init__'s checks."""
+        house = object.__new__(cls)
+        house.house_id = house_id
+        house.address = address
+        house.owner = owner
+        house.gps_location = gps_location
+        house.num_rooms = num_rooms
+        house.num_baths = num_baths
+        return house
+
     def __eq__(self, other):
+        if not isinstance(other, House):
+            return NotImplemented
         return (
             self.house_id == other.house_id and 
             self.address == other.address and 
@@ -50,85 +89,444 @@ class House:
             self.num_baths == other.num_baths
         )
 
+    def __hash__(self):
+        return hash(self.house_id)
+
 def load_houses_from_json() -> dict:
-    if not os.path.exists(HOUSES_JSON_FILE):
-        return {}
-    with open(HOUSES_JSON_FILE, "r") as f:
-        return json.load(f)
+    return get_store(HOUSES_JSON_FILE).load()
 
 def save_houses_to_json(houses_data: dict) -> None:
-    with open(HOUSES_JSON_FILE, "w") as f:
-        json.dump(houses_data, f, indent=2)
+    get_store(HOUSES_JSON_FILE).save(houses_data)
 
 def house_to_dict(house: House) -> dict:
+    # the owner is stored by reference; users.json is the only copy of the user
     return {
         "house_id": house.house_id,
         "address": house.address,
-        "owner": {
-            "user_id": house.owner.user_id,
-            "name": house.owner.name,
-            "email": house.owner.email,
-            "privilege": house.owner.privilege.value
-        },
+        "owner_id": house.owner.user_id,
         "gps_location": house.gps_location,
         "num_rooms": house.num_rooms,
         "num_baths": house.num_baths
     }
 
-def house_from_dict(data: dict) -> House:
-    from user import User  # avoid circular import
-    owner_data = data["owner"]
-    owner = User(
-        user_id=owner_data["user_id"],
-        name=owner_data["name"],
-        email=owner_data["email"],
-        privilege=PrivilegeLevel(owner_data["privilege"])
-    )
+def _owner_from_record(data: dict, identity_map: Optional[IdentityMap]) -> User:
+    if "owner" in data:
+        # records written before owners were stored by reference
+        return user_from_dict(data["owner"])
+    owner_id = data["owner_id"]
+    try:
+        if identity_map is None:
+            return get_user(owner_id)
+        return identity_map.get("user", owner_id, lambda: get_user(owner_id))
+    except UserNotFoundError:
+        raise HouseNotFoundError(
+            f"Owner {owner_id} of house {data['house_id']} not found"
+        )
+
+def house_from_dict(data: dict, identity_map: Optional[IdentityMap] = None) -> House:
     return House(
         house_id=data["house_id"],
         address=data["address"],
-        owner=owner,
+        owner=_owner_from_record(data, identity_map),
         gps_location=tuple(data["gps_location"]),
         num_rooms=data["num_rooms"],
         num_baths=data["num_baths"]
     )
 
+def _load_house(record: dict, identity_map: Optional[IdentityMap] = None) -> House:
+    # a record read from the store: built without re-validation (it was
+    # checked on write) and shared by every reader until it or its owner changes
+    owner = _owner_from_record(record, identity_map)
+    return _house_store().intern(
+        record["house_id"], record,
+        lambda: House._trusted(
+            record["house_id"], record["address"], owner,
+            tuple(record["gps_location"]), record["num_rooms"], record["num_baths"]
+        ),
+        owner,
+    )
+
+def _house_store():
+    store = get_store(HOUSES_JSON_FILE)
+    # reverse index: which houses does a user own
+    store.ensure_index("owner_id")
+    # spatial index: which houses are near a point or inside a box
+    store.attach_index("geo", GeoIndex)
+    return store
+
+def _check_owner_exists(house: House) -> None:
+    if house.owner.user_id not in get_store(USERS_JSON_FILE):
+        raise ValidationError(f"Owner {house.owner.user_id} does not exist")
+
+# ========== GEO INDEX ==========
+
+class _Cell:
+    __slots__ = ("keys", "lats", "lons")
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.lats = array("d")
+        self.lons = array("d")
+
+def _distances_km(lat: float, lon: float, lats, lons):
+    """Great-circle (haversine) distances from (lat, lon) to every point."""
+    phi, lam = math.radians(lat), math.radians(lon)
+    cos_phi, sin, cos, radians = math.cos(phi), math.sin, math.cos, math.radians
+    distances = []
+    for other_lat, other_lon in zip(lats, lons):
+        other_phi = radians(other_lat)
+        a = (sin((other_phi - phi) / 2) ** 2
+             + cos_phi * cos(other_phi) * sin((radians(other_lon) - lam) / 2) ** 2)
+        distances.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0))))
+    return distances
+
+class GeoIndex:
+    """
+    Houses bucketed by location into square cells of `cell_degrees`. Each
+    cell keeps its house ids next to array('d') columns of latitudes and
+    longitudes, so a query only visits the cells its area overlaps and then
+    filters them in one pass over those columns. The houses store keeps it
+    current on every put and delete (see storage.JsonStore.attach_index).
+    """
+
+    def __init__(self, cell_degrees: float = GEO_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        # (row, col) -> _Cell, for occupied cells only
+        self._cells: dict = {}
+        # house_id -> ((row, col), position in the cell's columns)
+        self._slots: dict = {}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _cell_id(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    def add(self, key: str, record: dict) -> None:
+        lat, lon = record["gps_location"]
+        cell_id = self._cell_id(lat, lon)
+        cell = self._cells.get(cell_id)
+        if cell is None:
+            cell = self._cells[cell_id] = _Cell()
+        self._slots[key] = (cell_id, len(cell.keys))
+        cell.keys.append(key)
+        cell.lats.append(lat)
+        cell.lons.append(lon)
+
+    def discard(self, key: str, record: Optional[dict] = None) -> None:
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        cell_id, i = slot
+        cell = self._cells[cell_id]
+        # move the cell's last house into the hole, so removal is O(1)
+        last = len(cell.keys) - 1
+        if i != last:
+            moved = cell.keys[i] = cell.keys[last]
+            cell.lats[i] = cell.lats[last]
+            cell.lons[i] = cell.lons[last]
+            self._slots[moved] = (cell_id, i)
+        cell.keys.pop()
+        cell.lats.pop()
+        cell.lons.pop()
+        if not cell.keys:
+            del self._cells[cell_id]
+
+    def _cells_in(self, south: float, west: float, north: float, east: float) -> dict:
+        """Occupied cells overlapping the box, by id; west > east crosses the antimeridian."""
+        size = self.cell_degrees
+        rows = range(math.floor(south / size), math.floor(north / size) + 1)
+        spans = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+        found = {}
+        for span_west, span_east in spans:
+            cols = range(math.floor(span_west / size), math.floor(span_east / size) + 1)
+            if len(rows) * len(cols) > len(self._cells):
+                # a large area over a sparse grid: check the occupied cells instead
+                for (row, col), cell in self._cells.items():
+                    if row in rows and col in cols:
+                        found[row, col] = cell
+            else:
+                for row in rows:
+                    for col in cols:
+                        cell = self._cells.get((row, col))
+                        if cell is not None:
+                            found[row, col] = cell
+        return found
+
+    @staticmethod
+    def _circle_box(lat: float, lon: float, radius_km: float) -> Tuple[float, float, float, float]:
+        """(south, west, north, east) of a box holding the circle."""
+        angle = radius_km / EARTH_RADIUS_KM
+        south, north = lat - math.degrees(angle), lat + math.degrees(angle)
+        west, east = -180.0, 180.0
+        if south > -90 and north < 90:
+            # the circle misses both poles, so it spans a limited longitude range
+            ratio = math.sin(angle) / math.cos(math.radians(lat))
+            if ratio < 1:
+                half_width = math.degrees(math.asin(ratio))
+                west, east = lon - half_width, lon + half_width
+                if west < -180:
+                    west += 360
+                if east > 180:
+                    east -= 360
+        return max(south, -90.0), west, min(north, 90.0), east
+
+    def _cell_bound_km(self, lat: float, lon: float, cell_id: Tuple[int, int]) -> float:
+        """Lower bound on the distance from (lat, lon) to any point in the cell."""
+        size = self.cell_degrees
+        south, west = cell_id[0] * size, cell_id[1] * size
+        north, east = south + size, west + size
+        dlat = 0.0 if south <= lat <= north else min(abs(lat - south), abs(lat - north))
+        if (lon - west) % 360 <= size:
+            dlon = 0.0
+        else:
+            dlon = min((west - lon) % 360, (lon - east) % 360)
+        # haversine grows with both gaps, and shrinks with the cosine of the
+        # cell's latitude, which is smallest at its poleward edge
+        cos_cell = max(0.0, min(math.cos(math.radians(south)), math.cos(math.radians(north))))
+        a = (math.sin(math.radians(dlat) / 2) ** 2
+             + math.cos(math.radians(lat)) * cos_cell * math.sin(math.radians(min(dlon, 180.0)) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+    @staticmethod
+    def _columns(cells: List[_Cell]) -> tuple:
+        keys = [key for cell in cells for key in cell.keys]
+        return (
+            keys,
+            [lat for cell in cells for lat in cell.lats],
+            [lon for cell in cells for lon in cell.lons],
+        )
+
+    def _measure(self, lat: float, lon: float, cells: List[_Cell], radius_km: float) -> List[Tuple[float, str]]:
+        """(distance in km, house id) of the houses in `cells` within `radius_km`."""
+        keys, lats, lons = self._columns(cells)
+        distances = _distances_km(lat, lon, lats, lons)
+        return [(km, key) for key, km in zip(keys, distances) if km <= radius_km]
+
+    def in_box(self, south: float, west: float, north: float, east: float) -> List[str]:
+        """Ids of the houses inside the box, in id order."""
+        keys, lats, lons = self._columns(list(self._cells_in(south, west, north, east).values()))
+        wraps = west > east
+        return sorted(
+            key for key, lat, lon in zip(keys, lats, lons)
+            if south <= lat <= north
+            and ((lon >= west or lon <= east) if wraps else west <= lon <= east)
+        )
+
+    def within(self, lat: float, lon: float, radius_km: float) -> List[Tuple[str, float]]:
+        """(house id, distance in km) of every house within `radius_km`, nearest first."""
+        cells = [
+            cell for cell_id, cell in self._cells_in(*self._circle_box(lat, lon, radius_km)).items()
+            if self._cell_bound_km(lat, lon, cell_id) <= radius_km
+        ]
+        return [(key, km) for km, key in sorted(self._measure(lat, lon, cells, radius_km))]
+
+    def nearest(self, lat: float, lon: float, k: int) -> List[Tuple[str, float]]:
+        """The `k` houses closest to (lat, lon) as (house id, distance in km), nearest first."""
+        farthest = math.pi * EARTH_RADIUS_KM
+        # grow a circle, from about one cell, until its box holds k houses;
+        # the k-th nearest of those bounds how far the answer can be
+        radius = farthest if k >= len(self) else self.cell_degrees * 111.2 / 2
+        while True:
+            cells = self._cells_in(*self._circle_box(lat, lon, radius))
+            if sum(len(cell.keys) for cell in cells.values()) >= k or radius >= farthest:
+                break
+            radius = min(radius * 2, farthest)
+        best = self._nearest_in(lat, lon, cells, k)
+        if len(best) == k and best[-1][0] > radius:
+            # houses just outside the box can beat the ones in its corners
+            best = self._nearest_in(lat, lon, self._cells_in(*self._circle_box(lat, lon, best[-1][0])), k)
+        return [(key, km) for km, key in best]
+
+    def _nearest_in(self, lat: float, lon: float, cells: dict, k: int) -> List[Tuple[float, str]]:
+        # best-first: visit cells by their distance bound, stop once no
+        # unvisited cell can hold anything closer than the current k-th house
+        bounded = sorted((self._cell_bound_km(lat, lon, cell_id), cell_id) for cell_id in cells)
+        best: List[Tuple[float, str]] = []
+        for bound, cell_id in bounded:
+            if len(best) == k and bound > best[-1][0]:
+                break
+            best = heapq.nsmallest(k, best + self._measure(lat, lon, [cells[cell_id]], math.inf))
+        return best
+
 # ========== CRUD OPERATIONS ==========
 
 def create_house(house: House) -> House:
-    houses_data = load_houses_from_json()
-    if house.house_id in houses_data:
+    store = _house_store()
+    if house.house_id in store:
         raise ConflictError(f"House ID {house.house_id} already exists")
+    _check_owner_exists(house)
     
-    houses_data[house.house_id] = house_to_dict(house)
-    save_houses_to_json(houses_data)
+    record = house_to_dict(house)
+    # the check above fails fast; this one is atomic with the write
+    if not store.put_if_absent(house.house_id, record):
+        raise ConflictError(f"House ID {house.house_id} already exists")
+    publish("house", "create", house.house_id, record, house.house_id)
     return house
 
-def get_house(house_id: str) -> House:
-    houses_data = load_houses_from_json()
-    if house_id not in houses_data:
+def get_house(house_id: str, identity_map: Optional[IdentityMap] = None) -> House:
+    record = _house_store().get(house_id)
+    if record is None:
         raise HouseNotFoundError(f"House {house_id} not found")
-    return house_from_dict(houses_data[house_id])
+    return _load_house(record, identity_map)
 
 def get_all_houses() -> list[House]:
     houses_data = load_houses_from_json()
-    house_list = []
-    for house_id, house_dict in houses_data.items():
-        house_list.append(house_from_dict(house_dict))
-    return house_list
+    return list(_hydrate_houses(houses_data.values()))
+
+def _owner_filter(owner_id: Optional[str]) -> Optional[dict]:
+    return {"owner_id": owner_id} if owner_id is not None else None
+
+def _hydrate_houses(records: Iterable[dict]) -> Iterator[House]:
+    identity_map = IdentityMap()
+    for record in records:
+        try:
+            yield _load_house(record, identity_map)
+        except HouseNotFoundError:
+            # orphaned by a deleted owner
+            continue
+
+def find_houses(
+    owner_id: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[list[House], Optional[str]]:
+    """
+    One page of houses in house_id order, optionally only those owned by
+    `owner_id`, plus the cursor for the next page.
+    """
+    records, next_cursor = paginate(_house_store(), _owner_filter(owner_id), limit, cursor)
+    return list(_hydrate_houses(records)), next_cursor
+
+def iter_houses(
+    owner_id: Optional[str] = None, cursor: Optional[str] = None
+) -> Iterator[House]:
+    """Lazily yield the houses find_houses() would return, without paging."""
+    after = decode_cursor(cursor) if cursor else None
+    records = (r for _, r in _house_store().scan(_owner_filter(owner_id), after))
+    return _hydrate_houses(records)
+
+def get_house_ids_by_owner(owner_id: str) -> list[str]:
+    """Ids of the houses owned by `owner_id`, via the owner index."""
+    return _house_store().find("owner_id", owner_id)
+
+def _check_point(lat: float, lon: float) -> None:
+    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        raise ValidationError("Invalid GPS coordinates")
+
+def _hydrate_found(found: List[Tuple[str, float]]) -> List[Tuple[House, float]]:
+    store, identity_map = _house_store(), IdentityMap()
+    houses = []
+    for house_id, km in found:
+        record = store.get(house_id)
+        if record is None:
+            continue  # deleted since the index was queried
+        try:
+            houses.append((_load_house(record, identity_map), km))
+        except HouseNotFoundError:
+            continue  # orphaned by a deleted owner
+    return houses
+
+def find_houses_in_box(
+    south: float,
+    west: float,
+    north: float,
+    east: float,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[list[House], Optional[str]]:
+    """
+    One page of the houses inside the bounding box, in house_id order, plus
+    the cursor for the next page. A box with west > east crosses the
+    antimeridian.
+    """
+    _check_point(south, west)
+    _check_point(north, east)
+    if south > north:
+        raise ValidationError("South edge of the box is north of its north edge")
+    after = decode_cursor(cursor) if cursor else None
+    store = _house_store()
+    house_ids = store.query_index("geo", lambda index: index.in_box(south, west, north, east))
+    if after is not None:
+        house_ids = house_ids[bisect.bisect_right(house_ids, after):]
+    if limit is not None:
+        house_ids = house_ids[:limit]
+    next_cursor = None
+    if limit is not None and len(house_ids) == limit:
+        next_cursor = encode_cursor(house_ids[-1])
+    records = (store.get(house_id) for house_id in house_ids)
+    return list(_hydrate_houses(r for r in records if r is not None)), next_cursor
+
+def find_houses_near(
+    lat: float, lon: float, radius_km: float, limit: Optional[int] = None
+) -> List[Tuple[House, float]]:
+    """(house, distance in km) for every house within `radius_km` of (lat, lon), nearest first."""
+    _check_point(lat, lon)
+    if radius_km < 0:
+        raise ValidationError("Radius must be non-negative")
+    found = _house_store().query_index("geo", lambda index: index.within(lat, lon, radius_km))
+    return _hydrate_found(found[:limit])
+
+def find_nearest_houses(lat: float, lon: float, k: int) -> List[Tuple[House, float]]:
+    """The `k` houses closest to (lat, lon) with their distances in km, nearest first."""
+    _check_point(lat, lon)
+    if k < 1:
+        raise ValidationError("k must be at least 1")
+    return _hydrate_found(_house_store().query_index("geo", lambda index: index.nearest(lat, lon, k)))
+
+def house_batch():
+    """
+    Context manager grouping the create_house/update_house/delete_house calls made
+    inside it into a single write. If the block raises, none of them land.
+    """
+    return batch_with_events(_house_store())
 
 def update_house(updated_house: House) -> House:
-    houses_data = load_houses_from_json()
-    if updated_house.house_id not in houses_data:
+    store = _house_store()
+    if updated_house.house_id not in store:
         raise HouseNotFoundError(f"House {updated_house.house_id} not found")
+    _check_owner_exists(updated_house)
     
-    houses_data[updated_house.house_id] = house_to_dict(updated_house)
-    save_houses_to_json(houses_data)
+    record = house_to_dict(updated_house)
+    store.put(updated_house.house_id, record)
+    publish("house", "update", updated_house.house_id, record, updated_house.house_id)
     return updated_house
 
-def delete_house(house_id: str) -> None:
-    houses_data = load_houses_from_json()
-    if house_id not in houses_data:
+def purge_houses(house_ids: List[str]) -> None:
+    """
+    Delete the given houses together with their rooms and devices. Each
+    store gets one batched write, children first, so an interrupted purge
+    never leaves a room or device behind without its house. Dependents are
+    looked up through the house_id indexes on rooms and devices: the cost
+    follows the number of dependents, not the size of the stores. The events
+    of the whole purge go to the change log in one write.
+    """
+    from room import delete_rooms, room_keys_in_houses  # avoid circular import
+    from device import delete_devices, device_ids_in_houses
+    with deferred():
+        delete_devices(device_ids_in_houses(house_ids))
+        delete_rooms(room_keys_in_houses(house_ids))
+        if house_ids:
+            with batch_with_events(_house_store()) as store:
+                for house_id in house_ids:
+                    store.delete(house_id)
+                    publish("house", "delete", house_id, house_id=house_id)
+
+def delete_house(house_id: str, on_delete: OnDelete = OnDelete.ORPHAN) -> None:
+    from room import room_keys_in_houses  # avoid circular import
+    from device import device_ids_in_houses
+    store = _house_store()
+    if house_id not in store:
         raise HouseNotFoundError(f"House {house_id} not found")
-    del houses_data[house_id]
-    save_houses_to_json(houses_data)
\ No newline at end of file
+    if on_delete is OnDelete.CASCADE:
+        purge_houses([house_id])
+        return
+    if on_delete is OnDelete.RESTRICT:
+        rooms = len(room_keys_in_houses([house_id]))
+        devices = len(device_ids_in_houses([house_id]))
+        if rooms or devices:
+            raise ConflictError(
+                f"House {house_id} still has {rooms} room(s) and {devices} device(s)"
+            )
+    store.delete(house_id)
+    publish("house", "delete", house_id, house_id=house_id)
@@ -1,35 +1,89 @@
 # main.py
-from fastapi import FastAPI, HTTPException
-from typing import List
-from pydantic import BaseModel, EmailStr
+import json
+from itertools import islice
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from pydantic import BaseModel, EmailStr, ValidationError as SchemaValidationError
+
+import codec
+import events
+from changes import get_changes
+from storage import CursorError
 
 from user import (
-    User as UserDomain, PrivilegeLevel, ValidationError as UserValidationError,
+    User as UserDomain, PrivilegeLevel, OnDelete, ValidationError as UserValidationError,
     NotFoundError as UserNotFoundError, ConflictError as UserConflictError,
-    create_user, get_user, get_all_users, update_user, delete_user
+    create_user, get_user, find_users, iter_users, update_user, delete_user,
+    user_batch
 )
 from house import (
     House as HouseDomain, HouseNotFoundError, ValidationError as HouseValidationError,
     ConflictError as HouseConflictError, create_house, get_house,
-    get_all_houses, update_house, delete_house
+    find_houses, iter_houses, update_house, delete_house, house_batch,
+    find_houses_in_box, find_houses_near, find_nearest_houses
 )
 from room import (
     Room as RoomDomain, RoomNotFoundError, ValidationError as RoomValidationError,
     ConflictError as RoomConflictError, create_room, get_room,
-    get_all_rooms, update_room, delete_room
+    find_rooms, iter_rooms, get_rooms_by_floor, update_room, delete_room, room_batch
+)
+from telemetry import (
+    ValidationError as TelemetryValidationError, ingest, get_readings, get_metrics,
+    get_rollup, get_house_rollup, get_room_rollup
+)
+from device_state import (
+    ValidationError as StateValidationError, ConflictError as StateConflictError,
+    get_state, update_state
 )
 from device import (
     Device as DeviceDomain, DeviceType, DeviceNotFoundError,
     ValidationError as DeviceValidationError, ConflictError as DeviceConflictError,
-    create_device, get_device, get_all_devices, update_device, delete_device
+    create_device, get_device, find_devices, iter_devices, update_device, delete_device,
+    device_batch
 )
 
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered through codec: orjson when it is installed, else
+    the same compact stdlib output JSONResponse produces.
+    """
+
+    def render(self, content) -> bytes:
+        return codec.dumps_bytes(content)
+
 app = FastAPI(
     title="Smart Home API",
     description="API for a smart home (nest-type) system, with separate implementations for Users, Houses, Rooms, and Devices",
     version="1.0.0",
+    default_response_class=FastJSONResponse,
 )
 
+# largest page a client can ask for; omit `limit` to get everything
+MAX_PAGE_SIZE = 1000
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]) -> None:
+    """The cursor for the next page goes in a header so list bodies stay plain lists."""
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def wants_stream(request: Request, stream: bool) -> bool:
+    """Stream a list as NDJSON on `?stream=true` or `Accept: application/x-ndjson`."""
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def ndjson_response(items: Iterable, encode: Callable[[object], str]) -> StreamingResponse:
+    """
+    One JSON object per line, produced as `items` is consumed, so the whole
+    list is never held in memory and the first record goes out immediately.
+    """
+    def lines():
+        for item in items:
+            yield encode(item) + "\n"
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
 # --------------------------
 # Pydantic Schemas
 # --------------------------
@@ -47,16 +101,85 @@ class HouseSchema(BaseModel):
     num_rooms: int
     num_baths: int
 
+class NearbyHouseSchema(BaseModel):
+    house: HouseSchema
+    distance_km: float
+
 class RoomSchema(BaseModel):
     name: str
     floor: int
     house: HouseSchema
 
+class FloorSchema(BaseModel):
+    floor: int
+    rooms: List[RoomSchema]
+
 class DeviceSchema(BaseModel):
     device_id: str
     type: str
     room: RoomSchema
 
+class DeviceStateSchema(BaseModel):
+    device_id: str
+    version: int
+    reported: Dict[str, Any]
+    desired: Dict[str, Any]
+    delta: Dict[str, Any]
+
+class DeviceStatePatch(BaseModel):
+    # JSON merge patches: null removes a field
+    reported: Optional[Dict[str, Any]] = None
+    desired: Optional[Dict[str, Any]] = None
+    version: Optional[int] = None  # refuse the update unless the state is at this version
+
+class DeviceStateChange(BaseModel):
+    device_id: str
+    version: int
+    reported: Optional[Dict[str, Any]] = None
+    desired: Optional[Dict[str, Any]] = None
+
+class TelemetryBatch(BaseModel):
+    # columnar, like the storage: ts[i] (seconds since the epoch) goes with values[i]
+    metric: str = "value"
+    ts: List[float]
+    values: List[float]
+
+class TelemetryAccepted(BaseModel):
+    device_id: str
+    metric: str
+    accepted: int
+
+class TelemetrySeries(BaseModel):
+    device_id: str
+    metric: str
+    ts: List[float]
+    values: List[float]
+
+class TelemetryRollup(BaseModel):
+    # one entry per bucket that has readings, in every list
+    device_id: str
+    metric: str
+    bucket: str
+    start: List[float]
+    count: List[int]
+    min: List[float]
+    max: List[float]
+    mean: List[float]
+    p50: List[float]
+    p90: List[float]
+    p99: List[float]
+
+class GroupTelemetryRollup(BaseModel):
+    # percentiles don't combine across devices, so a group rollup has none
+    metric: str
+    bucket: str
+    devices: int
+    start: List[float]
+    count: List[int]
+    min: List[float]
+    max: List[float]
+    mean: List[float]
+
 
 # --------------------------
 # these convert Pydantic -> domain classes
@@ -92,32 +215,126 @@ def pydantic_device_to_domain(d: DeviceSchema) -> DeviceDomain:
         room=room_domain
     )
 
+# --------------------------
+# and these convert domain -> Pydantic
+# --------------------------
+def domain_user_to_pydantic(u: UserDomain) -> UserSchema:
+    return UserSchema(
+        user_id=u.user_id,
+        name=u.name,
+        email=u.email,
+        privilege=u.privilege.value
+    )
+
+def domain_house_to_pydantic(h: HouseDomain) -> HouseSchema:
+    return HouseSchema(
+        house_id=h.house_id,
+        address=h.address,
+        owner=domain_user_to_pydantic(h.owner),
+        gps_location=h.gps_location,
+        num_rooms=h.num_rooms,
+        num_baths=h.num_baths
+    )
+
+def domain_room_to_pydantic(r: RoomDomain) -> RoomSchema:
+    return RoomSchema(name=r.name, floor=r.floor, house=domain_house_to_pydantic(r.house))
+
+def domain_device_to_pydantic(d: DeviceDomain) -> DeviceSchema:
+    return DeviceSchema(
+        device_id=d.device_id,
+        type=d.type.value,
+        room=domain_room_to_pydantic(d.room)
+    )
+
+# --------------------------
+# domain -> JSON, for the read routes
+# --------------------------
+# Read routes skip the Schema models: ResponseEncoder writes a domain object
+# straight to the JSON text FastAPI would have produced from its Schema (same
+# fields, order and compact separators as JSONResponse), so a record is
+# converted once instead of domain -> Schema -> validated -> dict -> JSON.
+# The Schemas stay as response_model for the docs.
+
+dumps = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode
+
+class ResponseEncoder:
+    """
+    Per-response encoder. Users, houses and rooms are shared by many
+    children, so each one is encoded once and its JSON text is reused.
+    """
+
+    def __init__(self):
+        # id(obj) -> (obj, json); holding obj keeps its id from being reused
+        self._encoded: dict = {}
+
+    def _cached(self, obj, encode: Callable[[object], str]) -> str:
+        entry = self._encoded.get(id(obj))
+        if entry is None:
+            entry = self._encoded[id(obj)] = (obj, encode(obj))
+        return entry[1]
+
+    def user(self, u: UserDomain) -> str:
+        return self._cached(u, lambda u: (
+            f'{{"user_id":{dumps(u.user_id)},"name":{dumps(u.name)},'
+            f'"email":{dumps(u.email)},"privilege":{dumps(u.privilege.value)}}}'
+        ))
+
+    def house(self, h: HouseDomain) -> str:
+        return self._cached(h, lambda h: (
+            f'{{"house_id":{dumps(h.house_id)},"address":{dumps(h.address)},'
+            f'"owner":{self.user(h.owner)},'
+            f'"gps_location":[{dumps(float(h.gps_location[0]))},{dumps(float(h.gps_location[1]))}],'
+            f'"num_rooms":{dumps(h.num_rooms)},"num_baths":{dumps(h.num_baths)}}}'
+        ))
+
+    def nearby_house(self, found: tuple) -> str:
+        house, distance_km = found
+        return f'{{"house":{self.house(house)},"distance_km":{dumps(float(distance_km))}}}'
+
+    def room(self, r: RoomDomain) -> str:
+        return self._cached(r, lambda r: (
+            f'{{"name":{dumps(r.name)},"floor":{dumps(r.floor)},"house":{self.house(r.house)}}}'
+        ))
+
+    def device(self, d: DeviceDomain) -> str:
+        return (
+            f'{{"device_id":{dumps(d.device_id)},"type":{dumps(d.type.value)},'
+            f'"room":{self.room(d.room)}}}'
+        )
+
+def json_response(body: str, next_cursor: Optional[str] = None) -> Response:
+    # when a route returns a Response itself, FastAPI ignores headers set on
+    # the injected `response`, so the cursor header goes on this one
+    response = Response(content=body.encode("utf-8"), media_type="application/json")
+    set_next_cursor(response, next_cursor)
+    return response
+
+def list_response(items: Iterable, encode: Callable[[object], str], next_cursor: Optional[str] = None) -> Response:
+    return json_response("[" + ",".join(map(encode, items)) + "]", next_cursor)
+
 # --------------------------
 # Users
 # --------------------------
 @app.get("/users", response_model=List[UserSchema])
-def list_users():
-    users = get_all_users()
-    return [
-        UserSchema(
-            user_id=u.user_id,
-            name=u.name,
-            email=u.email,
-            privilege=u.privilege.value
-        )
-        for u in users
-    ]
+def list_users(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        if wants_stream(request, stream):
+            users = islice(iter_users(cursor=cursor), limit)
+            return ndjson_response(users, ResponseEncoder().user)
+        users, next_cursor = find_users(limit=limit, cursor=cursor)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return list_response(users, ResponseEncoder().user, next_cursor)
 
 @app.get("/users/{user_id}", response_model=UserSchema)
 def retrieve_user(user_id: str):
     try:
-        user_obj = get_user(user_id)
-        return UserSchema(
-            user_id=user_obj.user_id,
-            name=user_obj.name,
-            email=user_obj.email,
-            privilege=user_obj.privilege.value
-        )
+        return json_response(ResponseEncoder().user(get_user(user_id)))
     except UserNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
@@ -164,54 +381,84 @@ def update_existing_user(user_id: str, user_update: UserSchema):
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.delete("/users/{user_id}")
-def remove_user(user_id: str):
+def remove_user(user_id: str, on_delete: OnDelete = OnDelete.ORPHAN):
     try:
-        delete_user(user_id)
+        delete_user(user_id, on_delete)
         return {"detail": f"User {user_id} deleted successfully."}
     except UserNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except UserConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 # --------------------------
 # Houses 
 # --------------------------
 @app.get("/houses", response_model=List[HouseSchema])
-def list_houses():
-    houses = get_all_houses()
-    return [
-        HouseSchema(
-            house_id=h.house_id,
-            address=h.address,
-            owner=UserSchema(
-                user_id=h.owner.user_id,
-                name=h.owner.name,
-                email=h.owner.email,
-                privilege=h.owner.privilege.value
-            ),
-            gps_location=h.gps_location,
-            num_rooms=h.num_rooms,
-            num_baths=h.num_baths
-        )
-        for h in houses
-    ]
+def list_houses(
+    request: Request,
+    owner_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        if wants_stream(request, stream):
+            houses = islice(iter_houses(owner_id=owner_id, cursor=cursor), limit)
+            return ndjson_response(houses, ResponseEncoder().house)
+        houses, next_cursor = find_houses(owner_id=owner_id, limit=limit, cursor=cursor)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return list_response(houses, ResponseEncoder().house, next_cursor)
+
+# declared before /houses/{house_id} so these paths aren't taken for house ids
+@app.get("/houses/within", response_model=List[HouseSchema])
+def list_houses_in_box(
+    south: float = Query(..., ge=-90, le=90),
+    west: float = Query(..., ge=-180, le=180),
+    north: float = Query(..., ge=-90, le=90),
+    east: float = Query(..., ge=-180, le=180),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    """Houses inside a bounding box, in house_id order. west > east crosses the antimeridian."""
+    try:
+        houses, next_cursor = find_houses_in_box(south, west, north, east, limit=limit, cursor=cursor)
+    except (HouseValidationError, CursorError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return list_response(houses, ResponseEncoder().house, next_cursor)
+
+@app.get("/houses/near", response_model=List[NearbyHouseSchema])
+def list_houses_near(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(..., ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+):
+    """Houses within radius_km of (lat, lon), nearest first, with their distances."""
+    try:
+        found = find_houses_near(lat, lon, radius_km, limit=limit)
+    except HouseValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return list_response(found, ResponseEncoder().nearby_house)
+
+@app.get("/houses/nearest", response_model=List[NearbyHouseSchema])
+def list_nearest_houses(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    k: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+):
+    """The k houses closest to (lat, lon), nearest first, with their distances."""
+    try:
+        found = find_nearest_houses(lat, lon, k)
+    except HouseValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return list_response(found, ResponseEncoder().nearby_house)
 
 @app.get("/houses/{house_id}", response_model=HouseSchema)
 def retrieve_house(house_id: str):
     try:
-        house_obj = get_house(house_id)
-        return HouseSchema(
-            house_id=house_obj.house_id,
-            address=house_obj.address,
-            owner=UserSchema(
-                user_id=house_obj.owner.user_id,
-                name=house_obj.owner.name,
-                email=house_obj.owner.email,
-                privilege=house_obj.owner.privilege.value
-            ),
-            gps_location=house_obj.gps_location,
-            num_rooms=house_obj.num_rooms,
-            num_baths=house_obj.num_baths
-        )
+        return json_response(ResponseEncoder().house(get_house(house_id)))
     except HouseNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
@@ -244,64 +491,50 @@ def update_existing_house(house_id: str, house_update: HouseSchema):
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.delete("/houses/{house_id}")
-def remove_house(house_id: str):
+def remove_house(house_id: str, on_delete: OnDelete = OnDelete.ORPHAN):
     try:
-        delete_house(house_id)
+        delete_house(house_id, on_delete)
         return {"detail": f"House {house_id} deleted successfully."}
     except HouseNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except HouseConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 # --------------------------
 # Rooms 
 # --------------------------
 @app.get("/rooms", response_model=List[RoomSchema])
-def list_rooms():
-    rooms = get_all_rooms()
-    return [
-        RoomSchema(
-            name=r.name,
-            floor=r.floor,
-            house=HouseSchema(
-                house_id=r.house.house_id,
-                address=r.house.address,
-                owner=UserSchema(
-                    user_id=r.house.owner.user_id,
-                    name=r.house.owner.name,
-                    email=r.house.owner.email,
-                    privilege=r.house.owner.privilege.value
-                ),
-                gps_location=r.house.gps_location,
-                num_rooms=r.house.num_rooms,
-                num_baths=r.house.num_baths
-            )
+def list_rooms(
+    request: Request,
+    house_id: Optional[str] = None,
+    floor: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        if wants_stream(request, stream):
+            rooms = islice(iter_rooms(house_id=house_id, floor=floor, cursor=cursor), limit)
+            return ndjson_response(rooms, ResponseEncoder().room)
+        rooms, next_cursor = find_rooms(
+            house_id=house_id, floor=floor, limit=limit, cursor=cursor
         )
-        for r in rooms
-    ]
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return list_response(rooms, ResponseEncoder().room, next_cursor)
 
+# /rooms/{room_name} finds a room by name alone, which only works while no
+# other house has a room by that name (409 otherwise); the routes under
+# /houses/{house_id}/rooms are always unambiguous
 @app.get("/rooms/{room_name}", response_model=RoomSchema)
 def retrieve_room(room_name: str):
     try:
-        room_obj = get_room(room_name)
-        return RoomSchema(
-            name=room_obj.name,
-            floor=room_obj.floor,
-            house=HouseSchema(
-                house_id=room_obj.house.house_id,
-                address=room_obj.house.address,
-                owner=UserSchema(
-                    user_id=room_obj.house.owner.user_id,
-                    name=room_obj.house.owner.name,
-                    email=room_obj.house.owner.email,
-                    privilege=room_obj.house.owner.privilege.value
-                ),
-                gps_location=room_obj.house.gps_location,
-                num_rooms=room_obj.house.num_rooms,
-                num_baths=room_obj.house.num_baths
-            )
-        )
+        return json_response(ResponseEncoder().room(get_room(room_name)))
     except RoomNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except RoomConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 @app.post("/rooms", response_model=RoomSchema, status_code=201)
 def create_new_room(room: RoomSchema):
@@ -348,72 +581,195 @@ def rename_room(room_name: str, new_room_data: RoomSchema):
         raise HTTPException(status_code=404, detail=str(e))
     except RoomValidationError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except RoomConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 @app.delete("/rooms/{room_name}")
-def remove_room(room_name: str):
+def remove_room(room_name: str, on_delete: OnDelete = OnDelete.ORPHAN):
     try:
-        delete_room(room_name)
+        delete_room(room_name, on_delete=on_delete)
         return {"detail": f"Room '{room_name}' deleted successfully."}
     except RoomNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except RoomConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+# house-scoped: rooms are keyed by (house_id, name), and these only visit the
+# rooms of one house
+@app.get("/houses/{house_id}/rooms", response_model=List[RoomSchema])
+def list_house_rooms(
+    house_id: str,
+    request: Request,
+    floor: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        get_house(house_id)
+    except HouseNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return list_rooms(request, house_id=house_id, floor=floor, limit=limit, cursor=cursor, stream=stream)
+
+@app.get("/houses/{house_id}/floors", response_model=List[FloorSchema])
+def list_house_floors(house_id: str):
+    """A house's rooms grouped by floor, lowest floor first."""
+    try:
+        get_house(house_id)
+    except HouseNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    encoder = ResponseEncoder()
+    floors = get_rooms_by_floor(house_id).items()
+    return list_response(
+        floors,
+        lambda floor: f'{{"floor":{dumps(floor[0])},"rooms":[{",".join(map(encoder.room, floor[1]))}]}}',
+    )
+
+@app.get("/houses/{house_id}/rooms/{room_name}", response_model=RoomSchema)
+def retrieve_house_room(house_id: str, room_name: str):
+    try:
+        return json_response(ResponseEncoder().room(get_room(room_name, house_id=house_id)))
+    except RoomNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.put("/houses/{house_id}/rooms/{room_name}", response_model=RoomSchema)
+def rename_house_room(house_id: str, room_name: str, new_room_data: RoomSchema):
+    try:
+        updated = update_room(get_room(room_name, house_id=house_id), new_room_data.name)
+        return domain_room_to_pydantic(updated)
+    except RoomNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RoomValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RoomConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.delete("/houses/{house_id}/rooms/{room_name}")
+def remove_house_room(house_id: str, room_name: str, on_delete: OnDelete = OnDelete.ORPHAN):
+    try:
+        delete_room(room_name, house_id=house_id, on_delete=on_delete)
+        return {"detail": f"Room '{room_name}' of house {house_id} deleted successfully."}
+    except RoomNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RoomConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 # --------------------------
 # Devices 
 # --------------------------
 @app.get("/devices", response_model=List[DeviceSchema])
-def list_devices():
-    devices = get_all_devices()
-    return [
-        DeviceSchema(
-            device_id=d.device_id,
-            type=d.type.value,
-            room=RoomSchema(
-                name=d.room.name,
-                floor=d.room.floor,
-                house=HouseSchema(
-                    house_id=d.room.house.house_id,
-                    address=d.room.house.address,
-                    owner=UserSchema(
-                        user_id=d.room.house.owner.user_id,
-                        name=d.room.house.owner.name,
-                        email=d.room.house.owner.email,
-                        privilege=d.room.house.owner.privilege.value
-                    ),
-                    gps_location=d.room.house.gps_location,
-                    num_rooms=d.room.house.num_rooms,
-                    num_baths=d.room.house.num_baths
-                )
-            )
-        )
-        for d in devices
-    ]
+def list_devices(
+    request: Request,
+    type: Optional[str] = None,
+    room: Optional[str] = None,
+    house_id: Optional[str] = None,
+    owner_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        device_type = DeviceType(type) if type is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid device type: {type}")
+    return device_page(
+        request, limit, cursor, stream,
+        type=device_type, room_name=room, house_id=house_id, owner_id=owner_id
+    )
+
+def device_page(
+    request: Request,
+    limit: Optional[int],
+    cursor: Optional[str],
+    stream: bool,
+    **filters
+):
+    try:
+        if wants_stream(request, stream):
+            devices = islice(iter_devices(cursor=cursor, **filters), limit)
+            return ndjson_response(devices, ResponseEncoder().device)
+        devices, next_cursor = find_devices(limit=limit, cursor=cursor, **filters)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return list_response(devices, ResponseEncoder().device, next_cursor)
+
+# index-backed lookups: each costs O(devices returned), not a scan of the store
+@app.get("/devices/by-type/{device_type}", response_model=List[DeviceSchema])
+def list_devices_by_type(
+    device_type: DeviceType,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    return device_page(request, limit, cursor, stream, type=device_type)
+
+@app.get("/rooms/{room_name}/devices", response_model=List[DeviceSchema])
+def list_room_devices(
+    room_name: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        room = get_room(room_name)
+    except RoomNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RoomConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return device_page(
+        request, limit, cursor, stream, room_name=room_name, house_id=room.house.house_id
+    )
+
+@app.get("/houses/{house_id}/rooms/{room_name}/devices", response_model=List[DeviceSchema])
+def list_house_room_devices(
+    house_id: str,
+    room_name: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        get_room(room_name, house_id=house_id)
+    except RoomNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return device_page(request, limit, cursor, stream, room_name=room_name, house_id=house_id)
+
+@app.get("/houses/{house_id}/devices", response_model=List[DeviceSchema])
+def list_house_devices(
+    house_id: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        get_house(house_id)
+    except HouseNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return device_page(request, limit, cursor, stream, house_id=house_id)
+
+@app.get("/users/{user_id}/devices", response_model=List[DeviceSchema])
+def list_user_devices(
+    user_id: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    try:
+        get_user(user_id)
+    except UserNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return device_page(request, limit, cursor, stream, owner_id=user_id)
 
 @app.get("/devices/{device_id}", response_model=DeviceSchema)
 def retrieve_device(device_id: str):
     try:
-        dev_obj = get_device(device_id)
-        return DeviceSchema(
-            device_id=dev_obj.device_id,
-            type=dev_obj.type.value,
-            room=RoomSchema(
-                name=dev_obj.room.name,
-                floor=dev_obj.room.floor,
-                house=HouseSchema(
-                    house_id=dev_obj.room.house.house_id,
-                    address=dev_obj.room.house.address,
-                    owner=UserSchema(
-                        user_id=dev_obj.room.house.owner.user_id,
-                        name=dev_obj.room.house.owner.name,
-                        email=dev_obj.room.house.owner.email,
-                        privilege=dev_obj.room.house.owner.privilege.value
-                    ),
-                    gps_location=dev_obj.room.house.gps_location,
-                    num_rooms=dev_obj.room.house.num_rooms,
-                    num_baths=dev_obj.room.house.num_baths
-                )
-            )
-        )
+        return json_response(ResponseEncoder().device(get_device(device_id)))
     except DeviceNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
@@ -453,4 +809,351 @@ def remove_device(device_id: str):
         delete_device(device_id)
         return {"detail": f"Device '{device_id}' deleted successfully."}
     except DeviceNotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=404, detail=str(e))
+
+# --------------------------
+# Device state
+# --------------------------
+@app.get("/devices/{device_id}/state", response_model=DeviceStateSchema)
+def retrieve_device_state(device_id: str):
+    try:
+        state = get_state(device_id)
+    except DeviceNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {
+        "device_id": state.device_id,
+        "version": state.version,
+        "reported": state.reported,
+        "desired": state.desired,
+        "delta": state.delta,
+    }
+
+@app.patch("/devices/{device_id}/state", response_model=DeviceStateChange)
+def patch_device_state(device_id: str, patch: DeviceStatePatch):
+    """
+    Merge the given reported/desired fields into the device's state. The
+    response carries the new version and only the fields that changed.
+    """
+    try:
+        state, changes = update_state(device_id, patch.reported, patch.desired, patch.version)
+    except DeviceNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except StateValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except StateConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    # returned as is: a null in a change means "removed" and must survive,
+    # so this doesn't go through response_model's None handling
+    return FastJSONResponse({"device_id": device_id, "version": state.version, **changes})
+
+# --------------------------
+# Telemetry
+# --------------------------
+@app.post("/devices/{device_id}/telemetry", response_model=TelemetryAccepted, status_code=201)
+def ingest_telemetry(device_id: str, batch: TelemetryBatch):
+    """Store a batch of readings from a sensor or thermostat: one appended block, no JSON rewrite."""
+    try:
+        accepted = ingest(device_id, batch.metric, batch.ts, batch.values)
+    except DeviceNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TelemetryValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"device_id": device_id, "metric": batch.metric, "accepted": accepted}
+
+@app.get("/devices/{device_id}/telemetry", response_model=TelemetrySeries)
+def read_telemetry(
+    device_id: str,
+    metric: str = "value",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    limit: Optional[int] = Query(None, ge=1),
+):
+    """Raw readings with start <= ts < end, oldest first, as two parallel lists."""
+    try:
+        ts, values = get_readings(device_id, metric, start, end, limit)
+    except DeviceNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TelemetryValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # a series can be long; skip re-validating every float against the model
+    return FastJSONResponse(
+        {"device_id": device_id, "metric": metric, "ts": ts.tolist(), "values": values.tolist()}
+    )
+
+@app.get("/devices/{device_id}/telemetry/rollup", response_model=TelemetryRollup)
+def read_telemetry_rollup(
+    device_id: str,
+    metric: str = "value",
+    bucket: str = "1h",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+):
+    """count/min/max/mean/percentiles per 1m, 1h or 1d bucket overlapping [start, end)."""
+    try:
+        rollup = get_rollup(device_id, metric, bucket, start, end)
+    except DeviceNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TelemetryValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse({"device_id": device_id, "metric": metric, "bucket": bucket, **rollup})
+
+@app.get("/houses/{house_id}/telemetry/rollup", response_model=GroupTelemetryRollup)
+def read_house_telemetry_rollup(
+    house_id: str,
+    metric: str = "value",
+    bucket: str = "1h",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+):
+    """The rollup of every sensor and thermostat in the house, bucket by bucket."""
+    try:
+        get_house(house_id)
+        rollup = get_house_rollup(house_id, metric, bucket, start, end)
+    except HouseNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TelemetryValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse({"metric": metric, "bucket": bucket, **rollup})
+
+@app.get("/houses/{house_id}/rooms/{room_name}/telemetry/rollup", response_model=GroupTelemetryRollup)
+def read_room_telemetry_rollup(
+    house_id: str,
+    room_name: str,
+    metric: str = "value",
+    bucket: str = "1h",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+):
+    try:
+        get_room(room_name, house_id=house_id)
+        rollup = get_room_rollup(house_id, room_name, metric, bucket, start, end)
+    except RoomNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TelemetryValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse({"metric": metric, "bucket": bucket, **rollup})
+
+@app.get("/devices/{device_id}/telemetry/metrics", response_model=List[str])
+def list_telemetry_metrics(device_id: str):
+    try:
+        return get_metrics(device_id)
+    except DeviceNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except TelemetryValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# --------------------------
+# Change feed
+# --------------------------
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.get("/events")
+def stream_events(
+    request: Request,
+    house_id: Optional[str] = None,
+    room_name: Optional[str] = None,
+    kinds: Optional[str] = Query(None, description="comma-separated: " + ",".join(events.KINDS)),
+):
+    """
+    Server-Sent Events for every create, update and delete from now on,
+    optionally only those of one house or one room of a house. A "resync"
+    event means changes were missed: re-read what you care about.
+    """
+    if room_name is not None and house_id is None:
+        raise HTTPException(status_code=400, detail="room_name needs a house_id")
+    try:
+        wanted = events.parse_kinds(kinds)
+        if room_name is not None:
+            get_room(room_name, house_id=house_id)
+        elif house_id is not None:
+            get_house(house_id)
+    except events.ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except (HouseNotFoundError, RoomNotFoundError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    # a reconnecting client sends the last id it saw; what it missed is gone
+    resync = "last-event-id" in request.headers
+    return StreamingResponse(
+        events.stream(house_id, room_name, wanted, resync),
+        media_type="text/event-stream", headers=SSE_HEADERS,
+    )
+
+# --------------------------
+# Incremental sync
+# --------------------------
+@app.get("/changes")
+def list_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    """
+    Users, houses, rooms and devices changed after sequence number `since`,
+    as they are now, with tombstones for deleted ones. Pass the returned
+    `seq` as `since` next time. A client that is too far behind (or has no
+    `since` yet) gets a snapshot of everything, paged with `cursor`.
+    """
+    try:
+        page = get_changes(since, limit, cursor)
+    except CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # returned as is: tombstones carry "data": null
+    return FastJSONResponse(page)
+
+
+# --------------------------
+# Batches
+# --------------------------
+# Each batch endpoint validates and applies every item through the normal
+# create/update/delete functions inside one store batch, so the whole request
+# costs a single load and a single write. Items that fail are reported
+# individually. With "atomic": true any failure rolls the whole batch back
+# (409, nothing written); otherwise the successful items are committed.
+
+class BatchItemError(BaseModel):
+    op: str
+    index: int
+    id: Optional[str]
+    status: int
+    detail: str
+
+class BatchResult(BaseModel):
+    committed: bool
+    applied: int
+    errors: List[BatchItemError]
+
+class UserBatch(BaseModel):
+    create: List[dict] = []
+    update: List[dict] = []
+    delete: List[str] = []
+    atomic: bool = False
+
+class HouseBatch(BaseModel):
+    create: List[dict] = []
+    update: List[dict] = []
+    delete: List[str] = []
+    atomic: bool = False
+
+class RoomBatch(BaseModel):
+    create: List[dict] = []
+    rename: List[dict] = []  # {"name": old name, "new_name": new name}
+    delete: List[str] = []
+    atomic: bool = False
+
+class DeviceBatch(BaseModel):
+    create: List[dict] = []
+    update: List[dict] = []
+    delete: List[str] = []
+    atomic: bool = False
+
+class RoomRename(BaseModel):
+    name: str
+    new_name: str
+    # needed once several houses have a room called `name`
+    house_id: Optional[str] = None
+
+BATCH_ERROR_STATUS = [
+    (SchemaValidationError, 422),
+    ((UserNotFoundError, HouseNotFoundError, RoomNotFoundError, DeviceNotFoundError), 404),
+    ((UserConflictError, HouseConflictError, RoomConflictError, DeviceConflictError), 409),
+    ((UserValidationError, HouseValidationError, RoomValidationError,
+      DeviceValidationError, ValueError), 400),
+]
+BATCH_ERRORS = tuple(
+    error
+    for errors, _ in BATCH_ERROR_STATUS
+    for error in (errors if isinstance(errors, tuple) else (errors,))
+)
+
+class BatchAborted(Exception):
+    pass
+
+def run_batch(batch, operations: list, atomic: bool):
+    """
+    `operations` is a list of (op, index, id, apply) tuples; `batch` is the
+    store batch context they are applied in.
+    """
+    errors = []
+    applied = 0
+    try:
+        with batch:
+            for op, index, item_id, apply in operations:
+                try:
+                    apply()
+                    applied += 1
+                except BATCH_ERRORS as e:
+                    status = next(code for error, code in BATCH_ERROR_STATUS if isinstance(e, error))
+                    errors.append(BatchItemError(
+                        op=op, index=index, id=item_id, status=status, detail=str(e)
+                    ))
+            if atomic and errors:
+                raise BatchAborted()
+    except BatchAborted:
+        result = BatchResult(committed=False, applied=0, errors=errors)
+        return FastJSONResponse(status_code=409, content=result.dict())
+    return BatchResult(committed=True, applied=applied, errors=errors)
+
+def item_id(item: dict, field: str) -> Optional[str]:
+    value = item.get(field) if isinstance(item, dict) else None
+    return None if value is None else str(value)
+
+def apply_user_create(item: dict) -> None:
+    create_user(pydantic_user_to_domain(UserSchema.parse_obj(item)))
+
+def apply_user_update(item: dict) -> None:
+    update_user(pydantic_user_to_domain(UserSchema.parse_obj(item)))
+
+def apply_house_create(item: dict) -> None:
+    create_house(pydantic_house_to_domain(HouseSchema.parse_obj(item)))
+
+def apply_house_update(item: dict) -> None:
+    update_house(pydantic_house_to_domain(HouseSchema.parse_obj(item)))
+
+def apply_room_create(item: dict) -> None:
+    create_room(pydantic_room_to_domain(RoomSchema.parse_obj(item)))
+
+def apply_room_rename(item: dict) -> None:
+    rename = RoomRename.parse_obj(item)
+    update_room(get_room(rename.name, house_id=rename.house_id), rename.new_name)
+
+def apply_device_create(item: dict) -> None:
+    create_device(pydantic_device_to_domain(DeviceSchema.parse_obj(item)))
+
+def apply_device_update(item: dict) -> None:
+    update_device(pydantic_device_to_domain(DeviceSchema.parse_obj(item)))
+
+@app.post("/users:batch", response_model=BatchResult)
+def batch_users(body: UserBatch):
+    operations = (
+        [("create", i, item_id(x, "user_id"), partial(apply_user_create, x)) for i, x in enumerate(body.create)]
+        + [("update", i, item_id(x, "user_id"), partial(apply_user_update, x)) for i, x in enumerate(body.update)]
+        + [("delete", i, x, partial(delete_user, x)) for i, x in enumerate(body.delete)]
+    )
+    return run_batch(user_batch(), operations, body.atomic)
+
+@app.post("/houses:batch", response_model=BatchResult)
+def batch_houses(body: HouseBatch):
+    operations = (
+        [("create", i, item_id(x, "house_id"), partial(apply_house_create, x)) for i, x in enumerate(body.create)]
+        + [("update", i, item_id(x, "house_id"), partial(apply_house_update, x)) for i, x in enumerate(body.update)]
+        + [("delete", i, x, partial(delete_house, x)) for i, x in enumerate(body.delete)]
+    )
+    return run_batch(house_batch(), operations, body.atomic)
+
+@app.post("/rooms:batch", response_model=BatchResult)
+def batch_rooms(body: RoomBatch):
+    operations = (
+        [("create", i, item_id(x, "name"), partial(apply_room_create, x)) for i, x in enumerate(body.create)]
+        + [("rename", i, item_id(x, "name"), partial(apply_room_rename, x)) for i, x in enumerate(body.rename)]
+        + [("delete", i, x, partial(delete_room, x)) for i, x in enumerate(body.delete)]
+    )
+    return run_batch(room_batch(), operations, body.atomic)
+
+@app.post("/devices:batch", response_model=BatchResult)
+def batch_devices(body: DeviceBatch):
+    operations = (
+        [("create", i, item_id(x, "device_id"), partial(apply_device_create, x)) for i, x in enumerate(body.create)]
+        + [("update", i, item_id(x, "device_id"), partial(apply_device_update, x)) for i, x in enumerate(body.update)]
+        + [("delete", i, x, partial(delete_device, x)) for i, x in enumerate(body.delete)]
+    )
+    return run_batch(device_batch(), operations, body.atomic)
@@ -1,8 +1,9 @@
-import json
-import os
-from typing import Optional
-from house import House
-from user import User, PrivilegeLevel
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from house import House, HOUSES_JSON_FILE, HouseNotFoundError, get_house, house_from_dict
+from user import OnDelete
+from events import batch_with_events, deferred, publish
+from storage import IdentityMap, decode_cursor, get_store, paginate
 
 ROOMS_JSON_FILE = "rooms.json"
 
@@ -16,6 +17,8 @@ class ConflictError(Exception):
     pass
 
 class Room:
+    __slots__ = ("name", "floor", "house")
+
     def __init__(self, name: str, floor: int, house: House):
         if not name.strip():
             raise ValidationError("Room name cannot be empty")
@@ -30,89 +33,273 @@ class Room:
         self.floor = floor
         self.house = house
 
+    @classmethod
+    def _trusted(cls, name: str, floor: int, house: House) -> "Room":
+        """Build a Room from already-validated data, skipping __init__'s checks."""
+        room = object.__new__(cls)
+        room.name = name
+        room.floor = floor
+        room.house = house
+        return room
+
     def __eq__(self, other):
+        if not isinstance(other, Room):
+            return NotImplemented
         return (
             self.name == other.name and 
             self.floor == other.floor and 
             self.house == other.house
         )
 
+    def __hash__(self):
+        return hash((self.house.house_id, self.name))
+
 def load_rooms_from_json() -> dict:
-    if not os.path.exists(ROOMS_JSON_FILE):
-        return {}
-    with open(ROOMS_JSON_FILE, "r") as f:
-        return json.load(f)
+    return get_store(ROOMS_JSON_FILE).load()
 
 def save_rooms_to_json(rooms_data: dict) -> None:
-    with open(ROOMS_JSON_FILE, "w") as f:
-        json.dump(rooms_data, f, indent=2)
+    get_store(ROOMS_JSON_FILE).save(rooms_data)
+
+def room_key(house_id: str, room_name: str) -> str:
+    """
+    Store key of a room: names are only unique within a house. House ids
+    can't contain "/", so the key is unambiguous.
+    """
+    return f"{house_id}/{room_name}"
 
 def room_to_dict(room: Room) -> dict:
     return {
         "name": room.name,
         "floor": room.floor,
-        "house": {
-            "house_id": room.house.house_id,
-            "address": room.house.address,
-            "owner": {
-                "user_id": room.house.owner.user_id,
-                "name": room.house.owner.name,
-                "email": room.house.owner.email,
-                "privilege": room.house.owner.privilege.value
-            },
-            "gps_location": room.house.gps_location,
-            "num_rooms": room.house.num_rooms,
-            "num_baths": room.house.num_baths
-        }
+        "house_id": room.house.house_id
     }
 
-def room_from_dict(data: dict) -> Room:
-    from house import House, house_from_dict
-    # Instead of re-implementing, just parse the house dict the same way
-    house_obj = house_from_dict(data["house"])
+def _record_house_id(record: dict) -> str:
+    if "house" in record:
+        # records written before houses were stored by reference
+        return record["house"]["house_id"]
+    return record["house_id"]
+
+def _room_store():
+    store = get_store(ROOMS_JSON_FILE)
+    # which rooms does a house have, and which rooms go by a name (for
+    # lookups without a house, and files keyed by name alone)
+    store.ensure_index("house_id", _record_house_id)
+    store.ensure_index("name")
+    return store
+
+def _house_from_record(data: dict, identity_map: Optional[IdentityMap]) -> House:
+    if "house" in data:
+        # records written before houses were stored by reference
+        return house_from_dict(data["house"], identity_map)
+    house_id = data["house_id"]
+    try:
+        if identity_map is None:
+            return get_house(house_id)
+        return identity_map.get("house", house_id, lambda: get_house(house_id, identity_map))
+    except HouseNotFoundError:
+        raise RoomNotFoundError(f"House {house_id} of room '{data['name']}' not found")
+
+def room_from_dict(data: dict, identity_map: Optional[IdentityMap] = None) -> Room:
+    house_obj = _house_from_record(data, identity_map)
     return Room(name=data["name"], floor=data["floor"], house=house_obj)
 
+def _load_room(record: dict, identity_map: Optional[IdentityMap] = None) -> Room:
+    # a record read from the store: built without re-validation (it was
+    # checked on write) and shared by every reader until it or its house changes
+    house_obj = _house_from_record(record, identity_map)
+    return _room_store().intern(
+        room_key(house_obj.house_id, record["name"]), record,
+        lambda: Room._trusted(record["name"], record["floor"], house_obj),
+        house_obj,
+    )
+
+def _find_key(room_name: str, house_id: Optional[str] = None) -> Optional[str]:
+    """
+    Store key of the room called `room_name` (in `house_id`, if given), or
+    None. Without a house the name must be unique across houses.
+    """
+    store = _room_store()
+    if house_id is not None:
+        key = room_key(house_id, room_name)
+        if key in store:
+            return key
+    keys = store.find("name", room_name)
+    if house_id is not None:
+        # a file written when rooms were keyed by name alone
+        keys = [k for k in keys if _record_house_id(store.get(k)) == house_id]
+    if len(keys) > 1:
+        raise ConflictError(
+            f"Room name '{room_name}' is used in several houses; look it up by house"
+        )
+    return keys[0] if keys else None
+
+def _not_found(room_name: str, house_id: Optional[str]) -> RoomNotFoundError:
+    where = f" in house {house_id}" if house_id is not None else ""
+    return RoomNotFoundError(f"Room '{room_name}'{where} not found")
+
 # ========== CRUD OPERATIONS ==========
 
 def create_room(room: Room) -> Room:
-    rooms_data = load_rooms_from_json()
-    if room.name in rooms_data:
-        raise ConflictError(f"Room '{room.name}' already exists")
-    rooms_data[room.name] = room_to_dict(room)
-    save_rooms_to_json(rooms_data)
+    store = _room_store()
+    if _find_key(room.name, room.house.house_id) is not None:
+        raise ConflictError(f"Room '{room.name}' already exists in house {room.house.house_id}")
+    if room.house.house_id not in get_store(HOUSES_JSON_FILE):
+        raise ValidationError(f"House {room.house.house_id} does not exist")
+    key, record = room_key(room.house.house_id, room.name), room_to_dict(room)
+    # the check above fails fast; this one is atomic with the write
+    if not store.put_if_absent(key, record):
+        raise ConflictError(f"Room '{room.name}' already exists in house {room.house.house_id}")
+    publish("room", "create", key, record, room.house.house_id, room.name)
     return room
 
-def get_room(room_name: str) -> Room:
-    rooms_data = load_rooms_from_json()
-    if room_name not in rooms_data:
-        raise RoomNotFoundError(f"Room '{room_name}' not found")
-    return room_from_dict(rooms_data[room_name])
+def room_exists(room_name: str, house_id: str) -> bool:
+    return _find_key(room_name, house_id) is not None
+
+def get_room(
+    room_name: str,
+    identity_map: Optional[IdentityMap] = None,
+    house_id: Optional[str] = None,
+) -> Room:
+    """
+    The room called `room_name` in house `house_id`. Without a house, the
+    name has to be unique (ConflictError otherwise).
+    """
+    key = _find_key(room_name, house_id)
+    record = _room_store().get(key) if key is not None else None
+    if record is None:
+        raise _not_found(room_name, house_id)
+    return _load_room(record, identity_map)
 
 def get_all_rooms() -> list[Room]:
     rooms_data = load_rooms_from_json()
-    room_list = []
-    for rname, rdict in rooms_data.items():
-        room_list.append(room_from_dict(rdict))
-    return room_list
+    return list(_hydrate_rooms(rooms_data.values()))
+
+def _room_filter(house_id: Optional[str], floor: Optional[int]) -> dict:
+    where = {}
+    if house_id is not None:
+        where["house_id"] = house_id
+    if floor is not None:
+        where["floor"] = floor
+    return where
+
+def _hydrate_rooms(records: Iterable[dict]) -> Iterator[Room]:
+    identity_map = IdentityMap()
+    for record in records:
+        try:
+            yield _load_room(record, identity_map)
+        except RoomNotFoundError:
+            # orphaned by a deleted house or owner
+            continue
+
+def find_rooms(
+    house_id: Optional[str] = None,
+    floor: Optional[int] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[list[Room], Optional[str]]:
+    """
+    One page of rooms in key order (by house, then name), optionally
+    filtered by house and/or floor, plus the cursor for the next page. With
+    a house, only that house's rooms are visited.
+    """
+    where = _room_filter(house_id, floor)
+    records, next_cursor = paginate(_room_store(), where, limit, cursor)
+    return list(_hydrate_rooms(records)), next_cursor
+
+def iter_rooms(
+    house_id: Optional[str] = None,
+    floor: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Iterator[Room]:
+    """Lazily yield the rooms find_rooms() would return, without paging."""
+    after = decode_cursor(cursor) if cursor else None
+    where = _room_filter(house_id, floor)
+    records = (r for _, r in _room_store().scan(where, after))
+    return _hydrate_rooms(records)
+
+def get_rooms_by_floor(house_id: str) -> Dict[int, list[Room]]:
+    """The rooms of a house grouped by floor, floors in ascending order."""
+    floors: Dict[int, list[Room]] = {}
+    for room in iter_rooms(house_id=house_id):
+        floors.setdefault(room.floor, []).append(room)
+    return dict(sorted(floors.items()))
+
+@contextmanager
+def room_batch():
+    """
+    Context manager grouping the create_room/update_room/delete_room calls made
+    inside it into a single write per store. Renames re-point devices and
+    cascading deletes remove them, so the devices store joins the batch: if
+    the block raises, none of the room or device writes land.
+    """
+    from device import device_batch  # avoid circular import
+    with device_batch(), batch_with_events(_room_store()) as store:
+        yield store
 
 def update_room(old_room: Room, new_room_name: str) -> Room:
-    rooms_data = load_rooms_from_json()
-    if old_room.name not in rooms_data:
-        raise RoomNotFoundError(f"Room '{old_room.name}' not found")
+    from device import rename_device_room  # avoid circular import
+    house_id = old_room.house.house_id
+    store = _room_store()
+    old_key = _find_key(old_room.name, house_id)
+    if old_key is None:
+        raise _not_found(old_room.name, house_id)
+    if not new_room_name.strip():
+        raise ValidationError("Room name cannot be empty")
+    new_key = room_key(house_id, new_room_name)
+    if new_key != old_key and _find_key(new_room_name, house_id) is not None:
+        raise ConflictError(f"Room '{new_room_name}' already exists in house {house_id}")
 
-    existing_room = room_from_dict(rooms_data[old_room.name])
-    del rooms_data[old_room.name]
+    # only the name changes: move the stored record to its new key as is, and
+    # the store moves it between index buckets. Room objects are shared between
+    # readers (see JsonStore.intern), so the renamed room is a new object.
+    record = dict(store.get(old_key), name=new_room_name)
+    # devices reference their room by name, so they are re-pointed in the
+    # same batch: a failure part way leaves neither the room nor its devices
+    # renamed
+    with room_batch():
+        store.delete(old_key)
+        store.put(new_key, record)
+        # the key changes with the name: to the feed, a rename is the old room
+        # going away and the new one appearing
+        publish("room", "delete", old_key, None, house_id, old_room.name)
+        publish("room", "create", new_key, record, house_id, new_room_name)
+        rename_device_room(house_id, old_room.name, new_room_name)
+    return _load_room(record)
 
-    # Update the name (and/or any other attributes) as needed
-    existing_room.name = new_room_name
+def room_keys_in_houses(house_ids: Iterable[str]) -> list[str]:
+    """Store keys of the rooms of the given houses, via the house index."""
+    store = _room_store()
+    return [key for house_id in house_ids for key in store.find("house_id", house_id)]
 
-    rooms_data[new_room_name] = room_to_dict(existing_room)
-    save_rooms_to_json(rooms_data)
-    return existing_room
+def delete_rooms(keys: Iterable[str]) -> None:
+    """Delete the rooms stored under `keys` in one batched write."""
+    keys = list(keys)
+    if not keys:
+        return
+    store = _room_store()
+    with batch_with_events(store):
+        for key in keys:
+            record = store.get(key)
+            store.delete(key)
+            if record is not None:
+                publish("room", "delete", key, None, _record_house_id(record), record["name"])
+
+def delete_room(
+    room_name: str, house_id: Optional[str] = None, on_delete: OnDelete = OnDelete.ORPHAN
+) -> None:
+    from device import delete_devices, device_ids_in_room  # avoid circular import
+    store = _room_store()
+    key = _find_key(room_name, house_id)
+    if key is None:
+        raise _not_found(room_name, house_id)
+    record = store.get(key)
+    with deferred():
+        if on_delete is not OnDelete.ORPHAN:
+            device_ids = device_ids_in_room(_record_house_id(record), record["name"])
+            if device_ids and on_delete is OnDelete.RESTRICT:
+                raise ConflictError(f"Room '{room_name}' still has {len(device_ids)} device(s)")
+            delete_devices(device_ids)
+        store.delete(key)
+        publish("room", "delete", key, None, _record_house_id(record), record["name"])
 
-def delete_room(room_name: str) -> None:
-    rooms_data = load_rooms_from_json()
-    if room_name not in rooms_data:
-        raise RoomNotFoundError(f"Room '{room_name}' not found")
-    del rooms_data[room_name]
-    save_rooms_to_json(rooms_data)
\ No newline at end of file
@@ -0,0 +1,581 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import codec
+
+# ========== SQLITE BACKEND ==========
+#
+# Selected with SMART_HOME_STORAGE=sqlite. All four entities live in one
+# database file, one table per entity. Besides the primary key, every table
+# has typed, indexed columns for the fields we query or join on (owner,
+# house, room, device type, ...) with foreign keys device -> room -> house ->
+# owner. Records reference their parents by id, so a table row never holds
+# a copy of another entity; the record is also kept whole in the `record`
+# column so the store hands back exactly what the CRUD functions put in.
+
+SQLITE_PATH = os.environ.get("SMART_HOME_SQLITE_PATH", "smart_home.db")
+# FastAPI runs sync handlers on anyio's default thread limiter (40 threads),
+# so that many connections means a handler never waits on the pool
+POOL_SIZE = int(os.environ.get("SMART_HOME_SQLITE_POOL_SIZE", "40"))
+# seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get("SMART_HOME_SQLITE_POOL_TIMEOUT", "30"))
+# rows fetched per query when streaming a table
+SCAN_CHUNK_SIZE = 500
+# hydrated objects kept per table by intern() before the cache is reset
+INTERN_CACHE_SIZE = 50_000
+# deleting a parent leaves its dependents behind (they are skipped on read),
+# which enforced foreign keys would refuse, so enforcement is opt-in
+ENFORCE_FOREIGN_KEYS = os.environ.get("SMART_HOME_SQLITE_FOREIGN_KEYS", "0") == "1"
+
+# table -> (key column, {column: (sql type, extractor)})
+TABLES = {
+    "users": ("user_id", {
+        "email": ("TEXT", lambda r: r["email"]),
+        "privilege": ("TEXT", lambda r: r["privilege"]),
+    }),
+    "houses": ("house_id", {
+        "owner_id": ("TEXT REFERENCES users(user_id)", lambda r: r["owner_id"]),
+        "latitude": ("REAL", lambda r: r["gps_location"][0]),
+        "longitude": ("REAL", lambda r: r["gps_location"][1]),
+    }),
+    # rooms are keyed by "<house_id>/<name>" (see room.room_key)
+    "rooms": ("room_key", {
+        "name": ("TEXT", lambda r: r["name"]),
+        "house_id": ("TEXT REFERENCES houses(house_id)", lambda r: r["house_id"]),
+        "floor": ("INTEGER", lambda r: r["floor"]),
+    }),
+    "devices": ("device_id", {
+        # a room name is only unique within its house, so there is no
+        # foreign key to reference; house_id is still checked
+        "room_name": ("TEXT", lambda r: r["room_name"]),
+        "house_id": ("TEXT REFERENCES houses(house_id)", lambda r: r["house_id"]),
+        "type": ("TEXT", lambda r: r["type"]),
+    }),
+    # reported/desired state, written far more often than the registry
+    # tables (see device_state.py); nothing to index besides the key
+    "device_state": ("device_id", {}),
+}
+
+def _table_schema(table: str) -> List[str]:
+    key, columns = TABLES[table]
+    column_defs = [f"{key} TEXT PRIMARY KEY"]
+    column_defs += [f"{name} {sql_type}" for name, (sql_type, _) in columns.items()]
+    column_defs.append("record TEXT NOT NULL")
+    statements = [f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(column_defs)});"]
+    for name in columns:
+        statements.append(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_{name} ON {table}({name});"
+        )
+    return statements
+
+def _schema() -> str:
+    statements = [statement for table in TABLES for statement in _table_schema(table)]
+    # write counters of the tables with custom indexes (see attach_index)
+    statements.append(
+        "CREATE TABLE IF NOT EXISTS table_versions "
+        "(name TEXT PRIMARY KEY, version INTEGER NOT NULL);"
+    )
+    return "\n".join(statements)
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """
+    Bring a database created before rooms were keyed by house up to date:
+    rooms get their "<house_id>/<name>" keys, and devices lose the foreign
+    key on the old, name-only room key. One transaction, once.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(rooms)")}
+        if not columns or "room_key" in columns:
+            conn.rollback()
+            return
+        for table in ("rooms", "devices"):
+            indexes = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE 'idx_%'",
+                (table,),
+            ).fetchall()
+            for (index,) in indexes:
+                conn.execute(f"DROP INDEX {index}")
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            for statement in _table_schema(table):
+                conn.execute(statement)
+        conn.execute(
+            "INSERT INTO rooms (room_key, name, house_id, floor, record) "
+            "SELECT house_id || '/' || name, name, house_id, floor, record FROM rooms_old"
+        )
+        conn.execute(
+            "INSERT INTO devices (device_id, room_name, house_id, type, record) "
+            "SELECT device_id, room_name, house_id, type, record FROM devices_old"
+        )
+        # children first, or enforced foreign keys would object
+        conn.execute("DROP TABLE devices_old")
+        conn.execute("DROP TABLE rooms_old")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Fixed-size pool of connections to one database file."""
+
+    def __init__(self, db_path: str, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA foreign_keys={'ON' if ENFORCE_FOREIGN_KEYS else 'OFF'}")
+        if self._created == 0:
+            _migrate(conn)
+            conn.executescript(_schema())
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._created < self.size:
+                    conn = self._connect()
+                    self._created += 1
+            if conn is None:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeoutError(
+                        f"No free connection to {self.db_path} after {self.timeout}s "
+                        f"(pool size {self.size})"
+                    ) from None
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+
+
+_pools: dict = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path: str = None) -> ConnectionPool:
+    db_path = db_path or SQLITE_PATH
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(db_path)
+        return pool
+
+
+class SqliteStore:
+    """
+    Store for one entity table. Mirrors the JsonStore API so the CRUD
+    functions don't care which backend they run on.
+    """
+
+    def __init__(self, path: str, db_path: str = None):
+        self.path = path
+        self.table = os.path.splitext(os.path.basename(path))[0]
+        if self.table not in TABLES:
+            raise ValueError(f"No SQLite table for store {path}")
+        self.key_column, self.columns = TABLES[self.table]
+        self.pool = get_pool(db_path)
+        # batch() stages writes per thread so other requests keep reading
+        # committed rows until the batch's single transaction lands
+        self._local = threading.local()
+        # key -> (record, parents, domain object), see intern()
+        self._interned: dict = {}
+        # custom indexes: name -> factory, and name -> (db signature, index)
+        self._index_factories: dict = {}
+        self._built_indexes: dict = {}
+        self._index_lock = threading.Lock()
+
+    def _staged(self) -> Optional[dict]:
+        return getattr(self._local, "staged", None)
+
+    def _row(self, key: str, record: dict) -> tuple:
+        values = [extract(record) for _, extract in self.columns.values()]
+        return (key, *values, codec.dumps(record))
+
+    def _insert_sql(self) -> str:
+        names = [self.key_column, *self.columns, "record"]
+        placeholders = ", ".join("?" for _ in names)
+        return f"INSERT INTO {self.table} ({', '.join(names)}) VALUES ({placeholders})"
+
+    def _upsert_sql(self) -> str:
+        names = [self.key_column, *self.columns, "record"]
+        updates = ", ".join(f"{name} = excluded.{name}" for name in names[1:])
+        return f"{self._insert_sql()} ON CONFLICT({self.key_column}) DO UPDATE SET {updates}"
+
+    def load(self) -> dict:
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {self.key_column}, record FROM {self.table} ORDER BY rowid"
+            ).fetchall()
+        return {key: codec.loads(record) for key, record in rows}
+
+    def save(self, data: dict) -> None:
+        with self.pool.connection() as conn, conn:
+            conn.execute(f"DELETE FROM {self.table}")
+            conn.executemany(
+                self._upsert_sql(), (self._row(k, r) for k, r in data.items())
+            )
+
+    # bulk_load() streams its input, so callers can feed it in bounded chunks
+    bulk_chunk_size: Optional[int] = 10_000
+
+    def bulk_load(self, records: Iterable[Tuple[str, dict]]) -> int:
+        """Same contract as JsonStore.bulk_load: one transaction, rows streamed in."""
+        count = 0
+
+        def rows():
+            nonlocal count
+            for key, record in records:
+                count += 1
+                yield self._row(key, record)
+
+        with self.pool.connection() as conn, conn:
+            conn.executemany(self._upsert_sql(), rows())
+        return count
+
+    def get(self, key: str) -> Optional[dict]:
+        staged = self._staged()
+        if staged is not None and key in staged:
+            return staged[key]
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                f"SELECT record FROM {self.table} WHERE {self.key_column} = ?", (key,)
+            ).fetchone()
+        return codec.loads(row[0]) if row else None
+
+    def __contains__(self, key: str) -> bool:
+        staged = self._staged()
+        if staged is not None and key in staged:
+            return staged[key] is not None
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                f"SELECT 1 FROM {self.table} WHERE {self.key_column} = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def put(self, key: str, record: dict) -> None:
+        staged = self._staged()
+        if staged is not None:
+            staged[key] = record
+            return
+        self._transaction(
+            [key], lambda conn: conn.execute(self._upsert_sql(), self._row(key, record))
+        )
+
+    def put_if_absent(self, key: str, record: dict) -> bool:
+        """
+        Same contract as JsonStore.put_if_absent: an insert that does nothing
+        if the row exists. Inside a batch the row goes in with a plain INSERT
+        when the batch commits, so a row another writer added in the meantime
+        fails the whole batch instead of being overwritten.
+        """
+        staged = self._staged()
+        if staged is not None:
+            if self.get(key) is not None:
+                return False
+            if key not in staged:
+                # (a row this batch deleted is simply overwritten)
+                self._local.inserts.add(key)
+            staged[key] = record
+            return True
+        sql = f"{self._insert_sql()} ON CONFLICT({self.key_column}) DO NOTHING"
+        cursor = self._transaction([key], lambda conn: conn.execute(sql, self._row(key, record)))
+        return cursor.rowcount == 1
+
+    def update(self, key: str, change) -> Optional[dict]:
+        """Same contract as JsonStore.update: the read and write share one transaction."""
+        staged = self._staged()
+        if staged is not None:
+            record = change(self.get(key))
+            if record is not None:
+                staged[key] = record
+            return record
+        def write(conn):
+            record = change(self._records(conn, [key])[key])
+            if record is not None:
+                conn.execute(self._upsert_sql(), self._row(key, record))
+            return record
+
+        return self._transaction([key], write)
+
+    def delete(self, key: str) -> None:
+        staged = self._staged()
+        if staged is not None:
+            staged[key] = None
+            return
+        sql = f"DELETE FROM {self.table} WHERE {self.key_column} = ?"
+        self._transaction([key], lambda conn: conn.execute(sql, (key,)))
+
+    @contextmanager
+    def batch(self):
+        """Same contract as JsonStore.batch: one transaction, or nothing."""
+        if self._staged() is not None:
+            yield self
+            return
+        self._local.staged, self._local.inserts = {}, set()
+        try:
+            yield self
+            staged, inserts = self._local.staged, self._local.inserts
+        finally:
+            self._local.staged = self._local.inserts = None
+        if not staged:
+            return
+        creates = [self._row(k, r) for k, r in staged.items() if r is not None and k in inserts]
+        puts = [self._row(k, r) for k, r in staged.items() if r is not None and k not in inserts]
+        deletes = [(k,) for k, r in staged.items() if r is None]
+
+        def write(conn):
+            if creates:
+                conn.executemany(self._insert_sql(), creates)
+            if puts:
+                conn.executemany(self._upsert_sql(), puts)
+            if deletes:
+                conn.executemany(
+                    f"DELETE FROM {self.table} WHERE {self.key_column} = ?", deletes
+                )
+
+        self._transaction(staged, write)
+
+    def _transaction(self, keys: Iterable[str], write):
+        """
+        Run write(conn) in one write transaction and return what it returns.
+        While this process has custom indexes built, the rows under `keys`
+        are read on both sides of the write, so the indexes follow it
+        instead of being rebuilt (see query_index).
+        """
+        track = bool(self._built_indexes)
+        keys = list(keys) if track else []
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if track:
+                    before, old = self._version(conn), self._records(conn, keys)
+                result = write(conn)
+                if track:
+                    after, new = self._version(conn), self._records(conn, keys)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        if track:
+            self._follow(before, after, old, new)
+        return result
+
+    def _records(self, conn: sqlite3.Connection, keys: List[str]) -> dict:
+        # key -> its stored record, or None
+        found = dict.fromkeys(keys)
+        for i in range(0, len(keys), SCAN_CHUNK_SIZE):
+            chunk = keys[i:i + SCAN_CHUNK_SIZE]
+            rows = conn.execute(
+                f"SELECT {self.key_column}, record FROM {self.table} "
+                f"WHERE {self.key_column} IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            for key, record in rows:
+                found[key] = codec.loads(record)
+        return found
+
+    def intern(self, key: str, record: dict, build, *parents) -> object:
+        """
+        Same contract as JsonStore.intern. Rows are decoded afresh on every
+        read, so a cached object is reused when its record is equal rather
+        than identical.
+        """
+        entry = self._interned.get(key)
+        if entry is not None and entry[0] == record and entry[1] == parents:
+            return entry[2]
+        obj = build()
+        if len(self._interned) >= INTERN_CACHE_SIZE:
+            self._interned = {}
+        self._interned[key] = (record, parents, obj)
+        return obj
+
+    def ensure_index(self, name: str, keyfunc=None) -> None:
+        # indexes are part of the schema; only the declared columns exist
+        if name not in self.columns:
+            raise ValueError(f"No indexed column {name} on {self.table}")
+
+    def attach_index(self, name: str, factory) -> None:
+        if name in self._index_factories:
+            return
+        # triggers count every write to the table, from any process and any
+        # code path, so a built index can tell when someone else wrote. They
+        # live in the database: once one process attaches an index, every
+        # writer keeps the count.
+        with self.pool.connection() as conn, conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, 0)", (self.table,)
+            )
+            for op in ("INSERT", "UPDATE", "DELETE"):
+                conn.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS {self.table}_{op.lower()}_version "
+                    f"AFTER {op} ON {self.table} BEGIN UPDATE table_versions "
+                    f"SET version = version + 1 WHERE name = '{self.table}'; END"
+                )
+        self._index_factories.setdefault(name, factory)
+
+    def _version(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute(
+            "SELECT version FROM table_versions WHERE name = ?", (self.table,)
+        ).fetchone()
+        return row[0]
+
+    def _follow(self, before: int, after: int, old: dict, new: dict) -> None:
+        # apply this process's own write to the built indexes
+        with self._index_lock:
+            for name, (version, index) in list(self._built_indexes.items()):
+                if version != before:
+                    continue  # another writer got in first: rebuilt on the next query
+                for key, record in old.items():
+                    if record is not None:
+                        index.discard(key, record)
+                    if new[key] is not None:
+                        index.add(key, new[key])
+                self._built_indexes[name] = (after, index)
+
+    def query_index(self, name: str, query):
+        """
+        Same contract as JsonStore.query_index. This process's own writes
+        update the index as they commit; nothing tells it which rows another
+        process changed, so the index is rebuilt from a full scan when the
+        table's write count moved past what the index has seen.
+        """
+        with self._index_lock:
+            with self.pool.connection() as conn:
+                version = self._version(conn)
+            built = self._built_indexes.get(name)
+            if built is None or built[0] != version:
+                index = self._index_factories[name]()
+                for key, record in self.scan():
+                    index.add(key, record)
+                built = self._built_indexes[name] = (version, index)
+            return query(built[1])
+
+    def find(self, name: str, value) -> List[str]:
+        self.ensure_index(name)
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {self.key_column} FROM {self.table} WHERE {name} = ? "
+                f"ORDER BY {self.key_column}",
+                (value,),
+            ).fetchall()
+        keys = [row[0] for row in rows]
+        staged = self._staged()
+        if not staged:
+            return keys
+        # this batch's writes aren't in the table yet; read them over it
+        keys = [key for key in keys if key not in staged]
+        keys += [key for key, record in staged.items() if self._matches(key, record, {name: value})]
+        return sorted(keys)
+
+    def _matches(self, key: str, record: Optional[dict], where: Optional[dict]) -> bool:
+        """Whether a staged record would pass the WHERE clause _select() builds."""
+        if record is None:
+            return False
+        for field, expected in (where or {}).items():
+            actual = key if field == self.key_column else self.columns[field][1](record)
+            if isinstance(expected, (set, frozenset, list, tuple)):
+                if actual not in expected:
+                    return False
+            elif actual != expected:
+                return False
+        return True
+
+    def _select(self, where: Optional[dict], after: Optional[str], limit: Optional[int]):
+        clauses, params = [], []
+        if after is not None:
+            clauses.append(f"{self.key_column} > ?")
+            params.append(after)
+        for field, expected in (where or {}).items():
+            if field not in self.columns and field != self.key_column:
+                raise ValueError(f"Cannot filter {self.table} by {field}")
+            if isinstance(expected, (set, frozenset, list, tuple)):
+                expected = list(expected)
+                clauses.append(f"{field} IN ({', '.join('?' for _ in expected)})")
+                params.extend(expected)
+            else:
+                clauses.append(f"{field} = ?")
+                params.append(expected)
+        sql = f"SELECT {self.key_column}, record FROM {self.table}"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += f" ORDER BY {self.key_column}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return sql, params
+
+    def scan(
+        self, where: Optional[dict] = None, after: Optional[str] = None
+    ) -> Iterator[Tuple[str, dict]]:
+        """
+        Same contract as JsonStore.scan. Rows are read in keyset chunks of
+        SCAN_CHUNK_SIZE, each its own query, so no connection is held while
+        the caller works through a chunk (hydrating a row takes one too).
+        """
+        while True:
+            rows = self.page(where, after, SCAN_CHUNK_SIZE)
+            yield from rows
+            if len(rows) < SCAN_CHUNK_SIZE:
+                return
+            after = rows[-1][0]
+
+    def page(
+        self,
+        where: Optional[dict] = None,
+        after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, dict]]:
+        """
+        Same contract as JsonStore.page, answered from the indexed columns.
+        Inside a batch, the rows this thread has staged are read over the
+        committed ones, so a batch sees its own writes.
+        """
+        staged = self._staged() or {}
+        # staged keys may displace committed rows, so fetch enough to refill
+        fetch = None if limit is None else limit + len(staged)
+        sql, params = self._select(where, after, fetch)
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        page = [(key, codec.loads(record)) for key, record in rows]
+        if not staged:
+            return page
+        page = [(key, record) for key, record in page if key not in staged]
+        page += [
+            (key, record)
+            for key, record in staged.items()
+            if (after is None or key > after) and self._matches(key, record, where)
+        ]
+        page.sort(key=lambda item: item[0])
+        return page if limit is None else page[:limit]
+
+    def invalidate(self) -> None:
+        # nothing is cached in-process; SQLite is always the source of truth
+        pass
@@ -0,0 +1,831 @@
+import base64
+import bisect
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import codec
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads within one process are serialized
+    fcntl = None
+
+# ========== STORAGE BACKENDS ==========
+#
+# Every module used to call json.load() on its whole file for every request
+# and json.dump() it back after every change. A store keeps the parsed dict
+# in memory, serves reads from it, and writes through to disk on every
+# mutation. The file's (mtime, size, inode) signature is checked on each
+# read so an external change (another worker, a test deleting the file, a
+# manual edit) is picked up instead of serving stale data.
+#
+# The backend is selected with SMART_HOME_STORAGE:
+#   json   - (default) the whole file is rewritten on every mutation
+#   log    - each mutation is appended to "<file>.log"; the log is replayed on
+#            top of the JSON snapshot at startup and periodically folded into
+#            it by a background compactor
+#   sqlite - one table per entity in a SQLite database (see sqlite_store.py)
+#
+# Concurrency: within a process every store serializes its mutations on a
+# lock, and each mutation re-checks the file before applying itself, so two
+# handler threads can no longer both load, modify and save and drop each
+# other's change. Across processes (several uvicorn workers) the same is done
+# with an flock() on "<file>.lock": writers hold it exclusively for the whole
+# read-modify-write, readers take it shared while they re-read the file.
+# Whole-file writes go to a temp file that is fsync'ed and renamed over the
+# original, so a reader sees either the old file or the new one, never half.
+#
+# Group commit (SMART_HOME_GROUP_COMMIT_MS > 0): a put/delete is applied to
+# the cached dict straight away but its write is queued. The first writer to
+# find no flush in progress becomes the leader: it waits out the window (or
+# until the batch is full) while other writers queue behind it, then writes
+# the whole queue as one commit - one file rewrite, or one appended and
+# fsync'ed run of log lines. Every writer returns only once the commit that
+# holds its change is on disk. The file lock is held from the first queued
+# change until that commit, so other processes never see or clobber a
+# half-flushed group.
+
+STORAGE_BACKEND = os.environ.get("SMART_HOME_STORAGE", "json")
+# fold a log into its snapshot once it holds this many records
+COMPACT_THRESHOLD = int(os.environ.get("SMART_HOME_COMPACT_THRESHOLD", "1000"))
+# seconds between background compactor passes
+COMPACT_INTERVAL = float(os.environ.get("SMART_HOME_COMPACT_INTERVAL", "30"))
+# group commit: hold mutations for up to this many milliseconds (0 = off) or
+# until this many are queued, then write them all in one commit
+GROUP_COMMIT_MS = float(os.environ.get("SMART_HOME_GROUP_COMMIT_MS", "0"))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("SMART_HOME_GROUP_COMMIT_MAX_BATCH", "256"))
+# keys a scan cuts from the sorted key list at a time
+SCAN_CHUNK_SIZE = 500
+
+Signature = Optional[Tuple[int, int, int]]
+T = TypeVar("T")
+
+class CursorError(ValueError):
+    pass
+
+def encode_cursor(key: str) -> str:
+    """Opaque pagination cursor pointing just past `key`."""
+    return base64.urlsafe_b64encode(json.dumps({"after": key}).encode()).decode()
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))["after"]
+    except (ValueError, TypeError, KeyError):
+        raise CursorError(f"Invalid cursor: {cursor}")
+
+def _start(keys: list, after: Optional[str]) -> int:
+    # position of the first key past `after` in sorted `keys`
+    return 0 if after is None else bisect.bisect_right(keys, after)
+
+def matches(record: dict, where: Optional[dict]) -> bool:
+    """
+    True if `record` satisfies every `field: value` in `where`. A set, list
+    or tuple value matches any of its members.
+    """
+    if not where:
+        return True
+    for field, expected in where.items():
+        value = record.get(field)
+        if isinstance(expected, (set, frozenset, list, tuple)):
+            if value not in expected:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+def _stat(path: str) -> Signature:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _fsync_dir(path: str) -> None:
+    # make the rename itself durable; not every platform can open a directory
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _write_json_atomic(path: str, data: dict) -> None:
+    """Write `data` to a temp file next to `path`, fsync it, then rename it over `path`."""
+    # unique per writer, and created with the usual permissions (unlike mkstemp's 0600)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            codec.dump_file(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _fsync_dir(path)
+
+
+class FileLock:
+    """
+    Reader/writer lock shared by every process that opens the same
+    `lock_path`, via flock(). It is not reentrant and not thread-safe on its
+    own: JsonStore only takes it while holding its thread lock.
+    """
+
+    def __init__(self, lock_path: str):
+        self.lock_path = lock_path
+        self._fd: Optional[int] = None
+
+    def acquire(self, exclusive: bool) -> None:
+        if fcntl is None:
+            return
+        if self._fd is None:
+            self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def release(self) -> None:
+        if fcntl is not None and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class JsonStore:
+    """Whole-file JSON store with a write-through in-memory cache."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data: Optional[dict] = None
+        self._signature = None
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(f"{path}.lock")
+        # nesting depth of _locked() in the thread holding self._lock
+        self._file_lock_depth = 0
+        # the file lock is held while this is > 0: one hold for the outermost
+        # _locked() and one for a queued group commit
+        self._file_lock_holds = 0
+        # group commit state; tickets number the queued mutations
+        self.group_commit_ms = GROUP_COMMIT_MS
+        self.group_commit_max_batch = GROUP_COMMIT_MAX_BATCH
+        self._flushed = threading.Condition(self._lock)
+        self._group_ops: list = []
+        self._group_ticket = 0
+        self._durable_ticket = 0
+        self._group_leader = False
+        # (first ticket, last ticket, exception) of the last failed flush
+        self._group_error: Optional[tuple] = None
+        # keys in sorted order for pagination, built on first use
+        self._order: Optional[list] = None
+        # secondary indexes: name -> keyfunc, and name -> {value: sorted keys}
+        # (the mapping is built on first use and dropped whenever the data is
+        # reloaded; in between, put/delete keep it up to date)
+        self._index_keyfuncs: dict = {}
+        self._indexes: dict = {}
+        # custom indexes (see attach_index): name -> factory; once built they
+        # live in self._indexes next to the keyfunc ones
+        self._index_factories: dict = {}
+        # key -> (record, parents, domain object), see intern()
+        self._interned: dict = {}
+        # while a batch() is open: the ops waiting to be written, and the
+        # pre-batch value of every key touched (None if it didn't exist)
+        self._pending: Optional[list] = None
+        self._undo: dict = {}
+
+    # ---------- backend hooks ----------
+    def _current_signature(self):
+        return _stat(self.path)
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "rb") as f:
+            return codec.load_file(f)
+
+    def _write(self, data: dict) -> None:
+        _write_json_atomic(self.path, data)
+
+    def _append(self, ops: Iterable[tuple]) -> None:
+        # a plain JSON file can only be rewritten as a whole
+        self._write(self._data)
+
+    # ---------- locking ----------
+    def _hold_file_lock(self, exclusive: bool) -> None:
+        # call with self._lock held; a queued group only ever exists under an
+        # exclusive hold, so piggybacking on it is always safe
+        if self._file_lock_holds == 0:
+            self._file_lock.acquire(exclusive)
+        self._file_lock_holds += 1
+
+    def _release_file_lock(self) -> None:
+        self._file_lock_holds -= 1
+        if self._file_lock_holds == 0:
+            self._file_lock.release()
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False):
+        """
+        Hold the thread lock plus the cross-process file lock. Nested calls
+        reuse the file lock already held by the outer one (writers always
+        take it exclusively at the outermost level).
+        """
+        with self._lock:
+            if self._file_lock_depth:
+                self._file_lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._file_lock_depth -= 1
+                return
+            self._hold_file_lock(exclusive)
+            self._file_lock_depth = 1
+            try:
+                yield
+            finally:
+                self._file_lock_depth = 0
+                self._release_file_lock()
+
+    # ---------- public API ----------
+    def load(self) -> dict:
+        """
+        Return the cached dict, re-reading the file only if it changed on disk.
+        The returned dict is the cache itself: callers that mutate it must
+        call save() afterwards.
+        """
+        with self._lock:
+            if self._pending is not None:
+                # mid-batch: our staged changes are the newest state
+                return self._data
+            if self._data is not None and self._current_signature() == self._signature:
+                return self._data
+            with self._locked():
+                # stat again under the lock: the signature must describe
+                # exactly what we read, not a write that landed in between
+                signature = self._current_signature()
+                self._data = self._read()
+                self._signature = signature
+                self._order = None
+                self._indexes = {}
+                self._interned = {}
+            return self._data
+
+    def save(self, data: dict) -> None:
+        """Replace the whole store with `data`."""
+        with self._locked(exclusive=True):
+            self._flush_group()
+            self._write(data)
+            self._data = data
+            self._signature = self._current_signature()
+            self._order = None
+            self._indexes = {}
+            self._interned = {}
+
+    # records handed to bulk_load() per call; None = everything in one call,
+    # since this store holds the whole dict in memory anyway
+    bulk_chunk_size: Optional[int] = None
+
+    def bulk_load(self, records: Iterable[Tuple[str, dict]]) -> int:
+        """
+        Insert or replace many records with a single write and none of the
+        per-put bookkeeping (ordering, indexes and undo are rebuilt lazily).
+        The log backend writes them straight into a new snapshot. Returns
+        the number of records loaded.
+        """
+        with self._locked(exclusive=True):
+            self._flush_group()
+            data = self.load()
+            count = 0
+            for key, record in records:
+                data[key] = record
+                count += 1
+            self._write(data)
+            self._signature = self._current_signature()
+            self._order = None
+            self._indexes = {}
+            self._interned = {}
+            return count
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.load().get(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.load()
+
+    def put(self, key: str, record: dict) -> None:
+        self.update(key, lambda old: record)
+
+    def put_if_absent(self, key: str, record: dict) -> bool:
+        """
+        put() unless `key` already exists, checked under the write lock, so of
+        two concurrent creates of one key exactly one succeeds. Returns
+        whether the record was stored.
+        """
+        return self.update(key, lambda old: record if old is None else None) is not None
+
+    def update(self, key: str, change: Callable[[Optional[dict]], Optional[dict]]) -> Optional[dict]:
+        """
+        Atomic read-modify-write of one record: change(current record, or None)
+        returns the record to store, or None to leave it alone. No other
+        thread or process writes in between. Commits like put(), group commit
+        included. Returns what change() returned.
+        """
+        with self._locked(exclusive=True):
+            data = self.load()
+            old = data.get(key)
+            record = change(old)
+            if record is None:
+                return None
+            if old is None and self._order is not None:
+                bisect.insort(self._order, key)
+            self._reindex(key, old, record)
+            data[key] = record
+            ticket = self._commit(("put", key, record), old)
+        self._wait_durable(ticket)
+        return record
+
+    def delete(self, key: str) -> None:
+        with self._locked(exclusive=True):
+            data = self.load()
+            old = data[key]
+            self._reindex(key, old, None)
+            self._interned.pop(key, None)
+            del data[key]
+            if self._order is not None:
+                del self._order[bisect.bisect_left(self._order, key)]
+            ticket = self._commit(("del", key, None), old)
+        self._wait_durable(ticket)
+
+    def _commit(self, op: tuple, old: Optional[dict]) -> Optional[int]:
+        """
+        Write `op`, stage it in the open batch, or queue it for group commit.
+        Returns the group commit ticket to wait for, if it was queued.
+        """
+        if self._pending is not None:
+            self._undo.setdefault(op[1], old)
+            self._pending.append(op)
+            return None
+        if self.group_commit_ms > 0:
+            return self._enqueue([op])
+        self._append([op])
+        self._signature = self._current_signature()
+        return None
+
+    def _enqueue(self, ops: list) -> int:
+        """
+        Queue `ops` for the next group commit, which writes them together.
+        Call with self._lock held; returns the ticket to wait for.
+        """
+        if not self._group_ops:
+            # keep other processes out until the group is flushed
+            self._hold_file_lock(exclusive=True)
+        self._group_ops.extend(ops)
+        self._group_ticket += 1
+        if len(self._group_ops) >= self.group_commit_max_batch:
+            self._flushed.notify_all()  # wake the leader early
+        return self._group_ticket
+
+    def _flush_group(self, extra_ops: Iterable[tuple] = ()) -> None:
+        """
+        Write every queued group commit op, plus `extra_ops`, in one commit.
+        Call with self._lock held.
+        """
+        ops = self._group_ops + list(extra_ops)
+        if not ops:
+            return
+        had_group = bool(self._group_ops)
+        first, last = self._durable_ticket + 1, self._group_ticket
+        try:
+            self._append(ops)
+            self._signature = self._current_signature()
+        except BaseException as e:
+            if had_group:
+                self._group_error = (first, last, e)
+            # the cache is ahead of the disk now; re-read it on next access
+            self._data = None
+            self._signature = None
+            raise
+        finally:
+            self._group_ops = []
+            self._durable_ticket = last
+            if had_group:
+                self._release_file_lock()
+            self._flushed.notify_all()
+
+    def _wait_durable(self, ticket: Optional[int]) -> None:
+        """Block until the group commit holding `ticket` is on disk."""
+        if ticket is None:
+            return
+        with self._flushed:
+            while self._durable_ticket < ticket:
+                if self._group_leader:
+                    self._flushed.wait()
+                    continue
+                # nobody is collecting this group yet: lead it
+                self._group_leader = True
+                try:
+                    deadline = time.monotonic() + self.group_commit_ms / 1000
+                    while len(self._group_ops) < self.group_commit_max_batch:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._flushed.wait(remaining)
+                    self._flush_group()
+                except BaseException:
+                    pass  # reported below through _group_error
+                finally:
+                    self._group_leader = False
+            error = self._group_error
+            if error is not None and error[0] <= ticket <= error[1]:
+                raise error[2]
+
+    @contextmanager
+    def batch(self):
+        """
+        Group every put/delete made inside the block into one write: a single
+        file rewrite for the JSON backend, a single append for the log. If the
+        block raises, the staged changes are rolled back and nothing is
+        written. Other threads and processes wait for the batch to finish.
+        With group commit on, the batch's write joins the current group (in
+        one piece), and the batch returns once that group is on disk.
+        """
+        ticket = None
+        with self._locked(exclusive=True):
+            if self._pending is not None:
+                # nested batch: the outer one commits
+                yield self
+                return
+            self.load()
+            self._pending, self._undo = [], {}
+            try:
+                yield self
+            except BaseException:
+                for key, old in self._undo.items():
+                    if old is None:
+                        self._data.pop(key, None)
+                    else:
+                        self._data[key] = old
+                self._order = None
+                self._indexes = {}
+                self._interned = {}
+                raise
+            else:
+                if self.group_commit_ms > 0 and self._pending:
+                    ticket = self._enqueue(self._pending)
+                else:
+                    # queued group commit ops are older than the batch, so
+                    # they go out first, in the same write
+                    self._flush_group(self._pending)
+            finally:
+                self._pending, self._undo = None, {}
+        self._wait_durable(ticket)
+
+    # ---------- hydrated objects ----------
+    def intern(self, key: str, record: dict, build: Callable[[], object], *parents) -> object:
+        """
+        The domain object for `record`, stored under `key`, shared by every
+        caller until it goes stale. build() only runs on a miss. Records are
+        replaced, never mutated, on put, so the object is current as long as
+        it was built from this very record object, with these very `parents`
+        (the already-interned owner of a house, house of a room); a changed
+        parent gives a new parent object and so rebuilds its children too.
+        Interned objects are shared: treat them as read-only.
+        """
+        entry = self._interned.get(key)
+        if entry is not None and entry[0] is record and entry[1] == parents:
+            return entry[2]
+        obj = build()
+        self._interned[key] = (record, parents, obj)
+        return obj
+
+    # ---------- secondary indexes ----------
+    def ensure_index(self, name: str, keyfunc: Optional[Callable[[dict], object]] = None) -> None:
+        """
+        Register a secondary index. By default it indexes the record field
+        called `name`; page() uses it automatically when filtering on that field.
+        """
+        if name not in self._index_keyfuncs:
+            with self._lock:
+                self._index_keyfuncs[name] = keyfunc or (lambda record: record.get(name))
+
+    def attach_index(self, name: str, factory: Callable[[], object]) -> None:
+        """
+        Register a custom index: factory() returns an empty index object with
+        add(key, record) and discard(key, record) methods. It is built from
+        every record on first use and kept current by put/delete, like the
+        keyfunc indexes. Query it with query_index().
+        """
+        if name not in self._index_factories:
+            with self._lock:
+                self._index_factories[name] = factory
+
+    def query_index(self, name: str, query: Callable[[object], T]) -> T:
+        """Run query(index) on the custom index `name`, with writers held off."""
+        with self._lock:
+            self.load()
+            return query(self._index(name))
+
+    def _index(self, name: str) -> dict:
+        index = self._indexes.get(name)
+        if index is None:
+            data = self.load()
+            factory = self._index_factories.get(name)
+            if factory is not None:
+                index = factory()
+                for key, record in data.items():
+                    index.add(key, record)
+            else:
+                keyfunc = self._index_keyfuncs[name]
+                index = {}
+                for key, record in data.items():
+                    index.setdefault(keyfunc(record), []).append(key)
+                for bucket in index.values():
+                    bucket.sort()
+            self._indexes[name] = index
+        return index
+
+    def _reindex(self, key: str, old: Optional[dict], new: Optional[dict]) -> None:
+        for name, index in self._indexes.items():
+            if name in self._index_factories:
+                if old is not None:
+                    index.discard(key, old)
+                if new is not None:
+                    index.add(key, new)
+                continue
+            keyfunc = self._index_keyfuncs[name]
+            if old is not None:
+                bucket = index.get(keyfunc(old))
+                if bucket is not None:
+                    i = bisect.bisect_left(bucket, key)
+                    if i < len(bucket) and bucket[i] == key:
+                        del bucket[i]
+                    if not bucket:
+                        del index[keyfunc(old)]
+            if new is not None:
+                bucket = index.setdefault(keyfunc(new), [])
+                i = bisect.bisect_left(bucket, key)
+                if i == len(bucket) or bucket[i] != key:
+                    bucket.insert(i, key)
+
+    def find(self, name: str, value) -> List[str]:
+        """Keys whose index `name` value equals `value`, in key order."""
+        with self._lock:
+            self.load()
+            return list(self._index(name).get(value, ()))
+
+    def _candidate_keys(self, where: Optional[dict], after: Optional[str], limit: int) -> list:
+        # up to `limit` keys past `after` that can match `where`, in key order:
+        # only the keys of the most selective index when one covers a filtered
+        # field, else all keys. Buckets are kept sorted, so each is cut at the
+        # cursor with a bisect; a record has one value per index, so they
+        # don't overlap.
+        candidates = None
+        for field, wanted in (where or {}).items():
+            if field not in self._index_keyfuncs:
+                continue
+            if not isinstance(wanted, (set, frozenset, list, tuple)):
+                wanted = (wanted,)
+            index = self._index(field)
+            buckets = [index[value] for value in set(wanted) if value in index]
+            if candidates is None or sum(map(len, buckets)) < sum(map(len, candidates)):
+                candidates = buckets
+        if candidates is None:
+            if self._order is None:
+                self._order = sorted(self.load())
+            candidates = [self._order]
+        tails = []
+        for bucket in candidates:
+            start = _start(bucket, after)
+            tails.append(bucket[start:start + limit])
+        if len(tails) == 1:
+            return tails[0]
+        return list(itertools.islice(heapq.merge(*tails), limit))
+
+    def scan(
+        self, where: Optional[dict] = None, after: Optional[str] = None
+    ) -> Iterator[Tuple[str, dict]]:
+        """
+        Lazily yield (key, record) pairs matching `where`, in key order,
+        starting just past key `after`. Filtering runs on the raw records, so
+        nothing is hydrated for entries the caller never sees. Keys are cut
+        from the sorted key list SCAN_CHUNK_SIZE at a time, resuming after the
+        last one seen, so the list is never copied whole and the lock isn't
+        held while the caller consumes a chunk.
+        """
+        return self._walk(where, after, SCAN_CHUNK_SIZE)
+
+    def _walk(
+        self, where: Optional[dict], after: Optional[str], chunk: int
+    ) -> Iterator[Tuple[str, dict]]:
+        while True:
+            with self._lock:
+                data = self.load()
+                keys = self._candidate_keys(where, after, chunk)
+                rows = [(key, data.get(key)) for key in keys]
+            for key, record in rows:
+                if record is not None and matches(record, where):
+                    yield key, record
+            if len(keys) < chunk:
+                return
+            after = keys[-1]
+            chunk = SCAN_CHUNK_SIZE
+
+    def page(
+        self,
+        where: Optional[dict] = None,
+        after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, dict]]:
+        """
+        Up to `limit` results of scan(where, after). The first chunk is just
+        `limit` keys, which is all an indexed or unfiltered page needs.
+        """
+        return list(itertools.islice(self._walk(where, after, limit or SCAN_CHUNK_SIZE), limit))
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._data = None
+            self._signature = None
+
+
+class LogStore(JsonStore):
+    """
+    Append-only store: the JSON file is a snapshot and every mutation since
+    the last compaction lives as one JSON line in "<file>.log".
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.log_path = f"{path}.log"
+        self.log_records = 0
+
+    def _current_signature(self):
+        return (_stat(self.path), _stat(self.log_path))
+
+    def _read(self) -> dict:
+        data = super()._read()
+        self.log_records = 0
+        if not os.path.exists(self.log_path):
+            return data
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        good_bytes = 0
+        for i, line in enumerate(lines):
+            try:
+                entry = codec.loads(line)
+            except ValueError:
+                if i == len(lines) - 1:
+                    # torn final write from a crash: everything before it is
+                    # intact, so cut it off before anything is appended after it
+                    with open(self.log_path, "r+") as f:
+                        f.truncate(good_bytes)
+                    break
+                raise
+            good_bytes += len(line.encode())
+            if not line.endswith("\n"):
+                # the last record landed whole but its newline didn't: end
+                # the line, or the next append would be joined onto it and
+                # the pair would later be cut off as a torn write
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write("\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            if entry["op"] == "put":
+                data[entry["key"]] = entry["value"]
+            else:
+                data.pop(entry["key"], None)
+            self.log_records += 1
+        return data
+
+    def _write(self, data: dict) -> None:
+        # snapshot first, then drop the log; replaying a stale log over the new
+        # snapshot is harmless because every entry is a full put or delete
+        _write_json_atomic(self.path, data)
+        with open(self.log_path, "w"):
+            pass
+        self.log_records = 0
+
+    def _append(self, ops: Iterable[tuple]) -> None:
+        lines = []
+        for op, key, record in ops:
+            entry = {"op": op, "key": key}
+            if op == "put":
+                entry["value"] = record
+            lines.append(codec.dumps(entry) + "\n")
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.log_records += len(lines)
+
+    def compact(self) -> None:
+        """Fold the log into the snapshot."""
+        with self._locked(exclusive=True):
+            self.save(self.load())
+
+
+class IdentityMap:
+    """
+    Hydrated domain objects keyed by (kind, key). Records only reference
+    their parents by id, so when many devices share a room/house/owner the
+    parent is looked up and built once per map instead of once per child.
+    """
+
+    def __init__(self):
+        self._objects: dict = {}
+
+    def get(self, kind: str, key, build):
+        """Return the object for (kind, key), calling build() on a miss."""
+        obj = self._objects.get((kind, key))
+        if obj is None:
+            obj = self._objects[(kind, key)] = build()
+        return obj
+
+
+def paginate(
+    store,
+    where: Optional[dict] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    One page of records from `store` plus the cursor for the next page
+    (None once the last page has been returned).
+    """
+    after = decode_cursor(cursor) if cursor else None
+    rows = store.page(where, after, limit)
+    next_cursor = None
+    if limit is not None and len(rows) == limit:
+        next_cursor = encode_cursor(rows[-1][0])
+    return [record for _, record in rows], next_cursor
+
+
+def _sqlite_store(path: str):
+    # imported lazily so the JSON backends work on Pythons built without sqlite3
+    from sqlite_store import SqliteStore
+    return SqliteStore(path)
+
+BACKENDS = {
+    "json": JsonStore,
+    "log": LogStore,
+    "sqlite": _sqlite_store,
+}
+
+_stores: dict = {}
+_stores_lock = threading.Lock()
+_compactor: Optional[threading.Thread] = None
+
+def get_store(path: str, backend: Optional[str] = None) -> JsonStore:
+    """
+    Return the shared store for `path`, creating it on first use with
+    `backend` (default: SMART_HOME_STORAGE).
+    """
+    store = _stores.get(path)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(path)
+            if store is None:
+                backend = backend or STORAGE_BACKEND
+                if backend not in BACKENDS:
+                    raise ValueError(f"Unknown storage backend: {backend}")
+                store = _stores[path] = BACKENDS[backend](path)
+                if isinstance(store, LogStore):
+                    start_compactor()
+    return store
+
+def clear_cache() -> None:
+    """Drop every cached dict so the next load re-reads from disk."""
+    for store in list(_stores.values()):
+        store.invalidate()
+
+def compact_all(threshold: int = 0) -> None:
+    """Compact every log store holding at least `threshold` log records."""
+    for store in list(_stores.values()):
+        if isinstance(store, LogStore):
+            store.load()
+            if store.log_records and store.log_records >= threshold:
+                store.compact()
+
+def _compactor_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        compact_all(COMPACT_THRESHOLD)
+
+def start_compactor(interval: float = COMPACT_INTERVAL) -> None:
+    """Start the background compactor thread (once per process)."""
+    global _compactor
+    if _compactor is not None:
+        return
+    _compactor = threading.Thread(
+        target=_compactor_loop, args=(interval,), name="store-compactor", daemon=True
+    )
+    _compactor.start()
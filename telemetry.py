@@ -0,0 +1,515 @@
+import math
+import os
+import shutil
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+from device import DeviceType, device_ids_in_houses, device_ids_in_room, get_device_type
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads within one process are serialized
+    fcntl = None
+
+# ========== TELEMETRY ==========
+#
+# Sensors and thermostats send readings continuously, far too often for the
+# JSON stores. Every (device, metric) pair gets its own series: in memory two
+# parallel array('d') columns, timestamps (seconds since the epoch) and
+# values, kept sorted by timestamp, so a time range is two binary searches
+# and two slices. On disk the series is one append-only file of blocks, one
+# block per ingested batch:
+#   <count: uint64> <count timestamps: float64> <count values: float64>
+# in native byte order. Ingesting a batch appends one block; nothing is
+# rewritten. A batch older than the newest stored reading (a late upload)
+# is merged in and the file is rewritten as a single block, atomically.
+# A block cut short by a crash is ignored on load and cut off before the
+# next append. Writers flock() the series file itself (no lock file, so a
+# series holds no file descriptor between calls), and other processes'
+# appends are picked up by reading just the bytes added since the last look.
+
+TELEMETRY_DIR = os.environ.get("SMART_HOME_TELEMETRY_DIR", "telemetry")
+# fsync every appended block (set to 0 to trade the last moments of data on
+# a power loss for throughput)
+TELEMETRY_FSYNC = os.environ.get("SMART_HOME_TELEMETRY_FSYNC", "1") == "1"
+# largest batch one ingest call accepts
+MAX_BATCH_READINGS = int(os.environ.get("SMART_HOME_TELEMETRY_MAX_BATCH", "100000"))
+# the device types that report readings
+TELEMETRY_DEVICE_TYPES = frozenset({DeviceType.SENSOR, DeviceType.THERMOSTAT})
+
+BLOCK_HEADER = struct.Struct("=Q")
+SERIES_SUFFIX = ".series"
+
+# rollup bucket sizes, in seconds, and the statistics kept per bucket
+ROLLUP_BUCKETS = {"1m": 60, "1h": 3600, "1d": 86400}
+PERCENTILES = (50, 90, 99)
+ROLLUP_FIELDS = ("count", "min", "max", "sum") + tuple(f"p{p}" for p in PERCENTILES)
+
+class ValidationError(Exception):
+    pass
+
+def _check_metric(metric: str) -> None:
+    # metrics name files, so keep them to a safe alphabet
+    if not (0 < len(metric) <= 64 and metric.replace("_", "").isalnum() and metric.isascii()):
+        raise ValidationError(f"Invalid metric name: {metric!r}")
+
+def _device_dir(device_id: str) -> str:
+    # quoted so ids with "/" or ".." can't escape the telemetry directory
+    return os.path.join(TELEMETRY_DIR, "device-" + quote(device_id, safe=""))
+
+
+# ========== ROLLUPS ==========
+#
+# A rollup summarizes a series in fixed buckets (1m, 1h, 1d): count, min,
+# max, sum (for the mean) and percentiles per bucket. Buckets are aligned to
+# the epoch, [k * size, (k + 1) * size). Readings arrive in time order, so
+# every bucket before the one holding the newest reading is closed: those
+# are computed once and kept, and each append computes just the buckets it
+# closed. Only the open bucket is computed at query time, so a month of 1h
+# buckets costs the same as a day's. A late batch reopens the buckets from
+# its first reading on. Rollups live in memory and are built from the raw
+# columns the first time a series is rolled up at a bucket size.
+
+def _percentile(ordered: Sequence[float], p: float) -> float:
+    # linear interpolation between closest ranks, like numpy's default
+    pos = p / 100 * (len(ordered) - 1)
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+def _bucket_stats(ts: array, values: array, lo: int, hi: int, size: int) -> Tuple[list, Dict[str, list]]:
+    """Bucket starts and ROLLUP_FIELDS columns for the readings ts[lo:hi] (sorted)."""
+    if hi <= lo:
+        return [], {field: [] for field in ROLLUP_FIELDS}
+    starts, columns = [], {field: [] for field in ROLLUP_FIELDS}
+    i = lo
+    while i < hi:
+        bucket = math.floor(ts[i] / size) * size
+        j = bisect_left(ts, bucket + size, i, hi)
+        ordered = sorted(values[i:j])
+        starts.append(float(bucket))
+        columns["count"].append(float(j - i))
+        columns["min"].append(ordered[0])
+        columns["max"].append(ordered[-1])
+        columns["sum"].append(math.fsum(ordered))
+        for p in PERCENTILES:
+            columns[f"p{p}"].append(_percentile(ordered, p))
+        i = j
+    return starts, columns
+
+
+class Rollup:
+    """The closed buckets of one series at one bucket size."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.clear()
+
+    def clear(self) -> None:
+        self.start = array("d")
+        self.columns = {field: array("d") for field in ROLLUP_FIELDS}
+        # every bucket starting before this is computed (empty ones aren't stored)
+        self.through = -math.inf
+
+    def reopen(self, ts: float) -> None:
+        """Forget the buckets from the one holding `ts` on: a late reading landed there."""
+        bucket = math.floor(ts / self.size) * self.size
+        if bucket >= self.through:
+            return
+        i = bisect_left(self.start, bucket)
+        del self.start[i:]
+        for column in self.columns.values():
+            del column[i:]
+        self.through = bucket
+
+    def extend(self, ts: array, values: array) -> None:
+        """Compute the buckets closed since the last call (all but the newest reading's)."""
+        if not ts:
+            return
+        open_bucket = math.floor(ts[-1] / self.size) * self.size
+        if open_bucket <= self.through:
+            return
+        lo = 0 if self.through == -math.inf else bisect_left(ts, self.through)
+        starts, columns = _bucket_stats(ts, values, lo, bisect_left(ts, open_bucket), self.size)
+        self.start.extend(starts)
+        for field, column in columns.items():
+            self.columns[field].extend(column)
+        self.through = open_bucket
+
+    def query(
+        self, ts: array, values: array, start: Optional[float], end: Optional[float]
+    ) -> Tuple[list, Dict[str, list]]:
+        """Buckets overlapping [start, end): the kept ones, plus the open one computed now."""
+        first = -math.inf if start is None else math.floor(start / self.size) * self.size
+        stop = math.inf if end is None else math.ceil(end / self.size) * self.size
+        i, j = bisect_left(self.start, first), bisect_left(self.start, stop)
+        starts = self.start[i:j].tolist()
+        columns = {field: column[i:j].tolist() for field, column in self.columns.items()}
+        if stop > self.through:
+            lo = bisect_left(ts, max(first, self.through))
+            hi = len(ts) if stop == math.inf else bisect_left(ts, stop)
+            open_starts, open_columns = _bucket_stats(ts, values, lo, hi, self.size)
+            starts += open_starts
+            for field, column in open_columns.items():
+                columns[field] += column
+        return starts, columns
+
+
+class Series:
+    """One metric of one device: sorted timestamp and value columns backed by a block file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ts = array("d")
+        self.values = array("d")
+        self._lock = threading.RLock()
+        # inode of the file the columns were read from, and how many bytes of
+        # it they hold (whole blocks only)
+        self._inode: Optional[int] = None
+        self._offset = 0
+        # bucket size -> Rollup, kept current by every change to the columns
+        self._rollups: Dict[int, Rollup] = {}
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def _reset(self) -> None:
+        self.ts = array("d")
+        self.values = array("d")
+        self._inode = None
+        self._offset = 0
+        for rollup in self._rollups.values():
+            rollup.clear()
+
+    def _roll_forward(self) -> None:
+        for rollup in self._rollups.values():
+            rollup.extend(self.ts, self.values)
+
+    @contextmanager
+    def _open_locked(self, exclusive: bool):
+        """
+        The series file, flock()ed; None if it doesn't exist and we only
+        read. A merge replaces the file, so after waiting for the lock make
+        sure it is still the file at `path`.
+        """
+        while True:
+            try:
+                f = open(self.path, "a+b" if exclusive else "rb")
+            except FileNotFoundError:
+                if exclusive:
+                    raise
+                yield None
+                return
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                current = os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            f.close()
+        try:
+            yield f
+        finally:
+            f.close()  # releases the flock
+
+    def _parse(self, data: memoryview) -> int:
+        """Append every whole block in `data` to the columns; returns the bytes used."""
+        pos = 0
+        while pos + BLOCK_HEADER.size <= len(data):
+            (count,) = BLOCK_HEADER.unpack_from(data, pos)
+            start = pos + BLOCK_HEADER.size
+            end = start + 16 * count
+            if end > len(data):
+                break  # torn by a crash mid-append
+            self.ts.frombytes(data[start:start + 8 * count])
+            self.values.frombytes(data[start + 8 * count:end])
+            pos = end
+        return pos
+
+    def _refresh(self, f) -> None:
+        # call with the thread lock held and `f` from _open_locked()
+        if f is None:
+            self._reset()
+            return
+        st = os.fstat(f.fileno())
+        if st.st_ino == self._inode and st.st_size == self._offset:
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._reset()  # rewritten by a merge: read it all again
+        f.seek(self._offset)
+        self._offset += self._parse(memoryview(f.read()))
+        self._inode = st.st_ino
+        self._roll_forward()
+
+    def append(self, ts: array, values: array) -> None:
+        """Add readings; `ts` must be sorted."""
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self._open_locked(exclusive=True) as f:
+                self._refresh(f)
+                if self.ts and ts[0] < self.ts[-1]:
+                    self._merge(ts, values)
+                    return
+                if os.fstat(f.fileno()).st_size > self._offset:
+                    f.truncate(self._offset)  # drop a torn block first
+                block = BLOCK_HEADER.pack(len(ts)) + ts.tobytes() + values.tobytes()
+                f.write(block)
+                f.flush()
+                if TELEMETRY_FSYNC:
+                    os.fsync(f.fileno())
+                self._offset += len(block)
+                self.ts.extend(ts)
+                self.values.extend(values)
+                self._roll_forward()
+
+    def _merge(self, ts: array, values: array) -> None:
+        # only the readings at or after the batch's first timestamp move
+        lo = bisect_right(self.ts, ts[0])
+        tail_ts = self.ts[lo:] + ts
+        tail_values = self.values[lo:] + values
+        order = sorted(range(len(tail_ts)), key=tail_ts.__getitem__)
+        new_ts = self.ts[:lo] + array("d", [tail_ts[i] for i in order])
+        new_values = self.values[:lo] + array("d", [tail_values[i] for i in order])
+
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(BLOCK_HEADER.pack(len(new_ts)))
+                f.write(new_ts.tobytes())
+                f.write(new_values.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+                inode = os.fstat(f.fileno()).st_ino
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self.ts, self.values = new_ts, new_values
+        self._inode, self._offset = inode, size
+        for rollup in self._rollups.values():
+            rollup.reopen(ts[0])
+        self._roll_forward()
+
+    def range(
+        self, start: Optional[float] = None, end: Optional[float] = None, limit: Optional[int] = None
+    ) -> Tuple[array, array]:
+        """Readings with start <= ts < end (either bound optional), oldest first."""
+        with self._lock:
+            with self._open_locked(exclusive=False) as f:
+                self._refresh(f)
+            lo = 0 if start is None else bisect_left(self.ts, start)
+            hi = len(self.ts) if end is None else bisect_left(self.ts, end)
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            return self.ts[lo:hi], self.values[lo:hi]
+
+    def rollup(
+        self, size: int, start: Optional[float] = None, end: Optional[float] = None
+    ) -> Tuple[list, Dict[str, list]]:
+        """Bucket starts and ROLLUP_FIELDS columns for the buckets overlapping [start, end)."""
+        with self._lock:
+            with self._open_locked(exclusive=False) as f:
+                self._refresh(f)
+            rollup = self._rollups.get(size)
+            if rollup is None:
+                rollup = self._rollups[size] = Rollup(size)
+                rollup.extend(self.ts, self.values)
+            return rollup.query(self.ts, self.values, start, end)
+
+
+# device_id -> {metric: Series}
+_series: Dict[str, Dict[str, Series]] = {}
+_series_lock = threading.Lock()
+
+def _series_for(device_id: str, metric: str, create: bool = False) -> Series:
+    """
+    The shared Series of a device's metric. A read of a metric that has no
+    file gets a throwaway empty Series: only series that exist (or are
+    being created, by ingestion) are cached, so queries for made-up metric
+    names don't grow the cache.
+    """
+    series = _series.get(device_id, {}).get(metric)
+    if series is not None:
+        return series
+    path = os.path.join(_device_dir(device_id), metric + SERIES_SUFFIX)
+    if not create and not os.path.exists(path):
+        return Series(path)
+    with _series_lock:
+        metrics = _series.setdefault(device_id, {})
+        series = metrics.get(metric)
+        if series is None:
+            series = metrics[metric] = Series(path)
+    return series
+
+def _check_device(device_id: str) -> DeviceType:
+    device_type = get_device_type(device_id)
+    if device_type not in TELEMETRY_DEVICE_TYPES:
+        raise ValidationError(f"Device {device_id} is a {device_type.value}, which has no telemetry")
+    return device_type
+
+# ========== INGESTION & QUERIES ==========
+
+def ingest(device_id: str, metric: str, timestamps: Sequence[float], values: Sequence[float]) -> int:
+    """
+    Store one batch of readings of `metric` from a sensor or thermostat, as
+    one appended block. The batch doesn't need to be sorted. Returns the
+    number of readings stored.
+    """
+    _check_metric(metric)
+    if len(timestamps) != len(values):
+        raise ValidationError("ts and values must have the same length")
+    if len(timestamps) > MAX_BATCH_READINGS:
+        raise ValidationError(f"A batch holds at most {MAX_BATCH_READINGS} readings")
+    _check_device(device_id)
+    if not timestamps:
+        return 0
+    try:
+        ts, vals = array("d", timestamps), array("d", values)
+    except TypeError:
+        raise ValidationError("Readings must be numbers")
+    if not (all(map(math.isfinite, ts)) and all(map(math.isfinite, vals))):
+        raise ValidationError("Readings must be finite numbers")
+    if any(a > b for a, b in zip(ts, ts[1:])):
+        order = sorted(range(len(ts)), key=ts.__getitem__)
+        ts = array("d", [ts[i] for i in order])
+        vals = array("d", [vals[i] for i in order])
+    _series_for(device_id, metric, create=True).append(ts, vals)
+    return len(ts)
+
+def get_readings(
+    device_id: str,
+    metric: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    limit: Optional[int] = None,
+) -> Tuple[array, array]:
+    """The (timestamps, values) columns of `metric` with start <= ts < end, oldest first."""
+    _check_metric(metric)
+    _check_device(device_id)
+    return _series_for(device_id, metric).range(start, end, limit)
+
+def _bucket_size(bucket: str) -> int:
+    size = ROLLUP_BUCKETS.get(bucket)
+    if size is None:
+        raise ValidationError(f"Unknown bucket {bucket!r}; use one of {', '.join(ROLLUP_BUCKETS)}")
+    return size
+
+def _rollup_result(starts: list, columns: Dict[str, list], fields: Iterable[str]) -> Dict[str, list]:
+    result = {
+        "start": starts,
+        "count": [int(count) for count in columns["count"]],
+        "min": columns["min"],
+        "max": columns["max"],
+        "mean": [total / count for total, count in zip(columns["sum"], columns["count"])],
+    }
+    for field in fields:
+        result[field] = columns[field]
+    return result
+
+def get_rollup(
+    device_id: str,
+    metric: str,
+    bucket: str = "1h",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> Dict[str, list]:
+    """
+    Per-bucket statistics of a device's `metric` over the buckets that
+    overlap [start, end) and hold readings: parallel lists "start",
+    "count", "min", "max", "mean" and one per percentile ("p50", ...).
+    """
+    _check_metric(metric)
+    size = _bucket_size(bucket)
+    _check_device(device_id)
+    starts, columns = _series_for(device_id, metric).rollup(size, start, end)
+    return _rollup_result(starts, columns, (f"p{p}" for p in PERCENTILES))
+
+def _merge_rollups(parts: List[Tuple[list, Dict[str, list]]]) -> Tuple[list, Dict[str, list]]:
+    # buckets of several devices sharing a start combine: counts and sums
+    # add up, min/max take the min/max. Percentiles don't combine, so the
+    # merged rollup has none.
+    parts = [part for part in parts if part[0]]
+    if not parts:
+        return [], {field: [] for field in ("count", "min", "max", "sum")}
+    merged: Dict[float, list] = {}
+    for starts, columns in parts:
+        rows = zip(starts, columns["count"], columns["min"], columns["max"], columns["sum"])
+        for bucket, count, low, high, total in rows:
+            row = merged.get(bucket)
+            if row is None:
+                merged[bucket] = [count, low, high, total]
+            else:
+                row[0] += count
+                row[1] = min(row[1], low)
+                row[2] = max(row[2], high)
+                row[3] += total
+    ordered = sorted(merged)
+    return ordered, {
+        field: [merged[bucket][i] for bucket in ordered]
+        for i, field in enumerate(("count", "min", "max", "sum"))
+    }
+
+def _group_rollup(
+    device_ids: Iterable[str], metric: str, bucket: str, start: Optional[float], end: Optional[float]
+) -> dict:
+    _check_metric(metric)
+    size = _bucket_size(bucket)
+    device_ids = [d for d in device_ids if get_device_type(d) in TELEMETRY_DEVICE_TYPES]
+    parts = [_series_for(d, metric).rollup(size, start, end) for d in device_ids]
+    starts, columns = _merge_rollups(parts)
+    result = _rollup_result(starts, columns, ())
+    result["devices"] = len(device_ids)
+    return result
+
+def get_house_rollup(
+    house_id: str,
+    metric: str,
+    bucket: str = "1h",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> dict:
+    """
+    get_rollup() over every sensor and thermostat of a house, bucket by
+    bucket (no percentiles), plus "devices": how many were included. Each
+    device contributes its kept rollup, so the cost follows devices x
+    buckets, not the number of readings.
+    """
+    return _group_rollup(device_ids_in_houses([house_id]), metric, bucket, start, end)
+
+def get_room_rollup(
+    house_id: str,
+    room_name: str,
+    metric: str,
+    bucket: str = "1h",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> dict:
+    """get_house_rollup() for the devices of one room."""
+    return _group_rollup(device_ids_in_room(house_id, room_name), metric, bucket, start, end)
+
+def get_metrics(device_id: str) -> List[str]:
+    """The metrics a device has reported, sorted."""
+    _check_device(device_id)
+    try:
+        names = os.listdir(_device_dir(device_id))
+    except FileNotFoundError:
+        return []
+    return sorted(n[:-len(SERIES_SUFFIX)] for n in names if n.endswith(SERIES_SUFFIX))
+
+def delete_telemetry(device_ids: Iterable[str]) -> None:
+    """Drop every series of the given devices."""
+    for device_id in device_ids:
+        with _series_lock:
+            _series.pop(device_id, None)
+        shutil.rmtree(_device_dir(device_id), ignore_errors=True)
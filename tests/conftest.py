@@ -0,0 +1,22 @@
+import pytest
+
+import sqlite_store
+import storage
+import telemetry
+
+@pytest.fixture(autouse=True)
+def fresh_stores(tmp_path):
+    """
+    Every test runs in an empty working directory, with no store, SQLite
+    connection or telemetry series cached by an earlier one, so nothing
+    leaks between tests whichever SMART_HOME_STORAGE backend is in use.
+    """
+    # a patcher of its own, so a test's monkeypatch.undo() leaves this alone
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path)
+        patch.setattr(storage, "_stores", {})
+        patch.setattr(sqlite_store, "_pools", {})
+        patch.setattr(telemetry, "_series", {})
+        yield
+        for pool in sqlite_store._pools.values():
+            pool.close()
@@ -1,21 +1,14 @@
 # test_api.py
+import json
 import os
 import pytest
 from fastapi.testclient import TestClient
 from main import app
+import storage
 
 client = TestClient(app)
 
-@pytest.fixture(autouse=True)
-def cleanup_json_files():
-    """
-    Ensures any leftover JSON files are removed so each test starts fresh.
-    Adjust as needed if you want data to persist between tests.
-    """
-    for filename in ["users.json", "houses.json", "rooms.json", "devices.json"]:
-        if os.path.exists(filename):
-            os.remove(filename)
-    yield
+# every test starts from empty stores (see conftest.py)
 
 # -----------------------------
 # USERS
@@ -443,4 +436,495 @@ def test_delete_device():
 
     # confirm it's gone
     gone_resp = client.get("/devices/del-dev1")
-    assert gone_resp.status_code == 404
\ No newline at end of file
+    assert gone_resp.status_code == 404
+
+# -----------------------------
+# PAGINATION & FILTERS
+# -----------------------------
+def make_user_body(user_id):
+    return {
+        "user_id": user_id,
+        "name": f"User {user_id}",
+        "email": f"{user_id}@example.com",
+        "privilege": "owner"
+    }
+
+def make_user(user_id):
+    user = make_user_body(user_id)
+    client.post("/users", json=user)
+    return user
+
+def make_house(house_id, owner):
+    house = {
+        "house_id": house_id,
+        "address": f"{house_id} Street",
+        "owner": owner,
+        "gps_location": [40.0, -70.0],
+        "num_rooms": 2,
+        "num_baths": 1
+    }
+    client.post("/houses", json=house)
+    return house
+
+def make_room(name, floor, house):
+    room = {"name": name, "floor": floor, "house": house}
+    client.post("/rooms", json=room)
+    return room
+
+def test_users_pagination():
+    for user_id in ["u3", "u1", "u2"]:
+        make_user(user_id)
+
+    first = client.get("/users", params={"limit": 2})
+    assert first.status_code == 200
+    assert [u["user_id"] for u in first.json()] == ["u1", "u2"]
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = client.get("/users", params={"limit": 2, "cursor": cursor})
+    assert [u["user_id"] for u in second.json()] == ["u3"]
+    assert "X-Next-Cursor" not in second.headers
+
+def test_invalid_cursor():
+    resp = client.get("/users", params={"limit": 2, "cursor": "not-a-cursor"})
+    assert resp.status_code == 400
+
+def test_page_size_is_capped():
+    resp = client.get("/devices", params={"limit": 100000})
+    assert resp.status_code == 422
+
+def test_room_filters():
+    owner = make_user("filter-owner")
+    house_a = make_house("house-a", owner)
+    house_b = make_house("house-b", owner)
+    make_room("Attic", 2, house_a)
+    make_room("Hall", 1, house_a)
+    make_room("Garage", 1, house_b)
+
+    resp = client.get("/rooms", params={"house_id": "house-a", "floor": 1})
+    assert [r["name"] for r in resp.json()] == ["Hall"]
+
+def test_device_filters():
+    alice = make_user("alice")
+    bob = make_user("bob")
+    alice_room = make_room("Alice Kitchen", 1, make_house("alice-house", alice))
+    bob_room = make_room("Bob Kitchen", 1, make_house("bob-house", bob))
+    for device_id, dev_type, room in [
+        ("cam1", "camera", alice_room),
+        ("light1", "light", alice_room),
+        ("cam2", "camera", bob_room),
+    ]:
+        client.post("/devices", json={"device_id": device_id, "type": dev_type, "room": room})
+
+    cameras = client.get("/devices", params={"type": "camera"})
+    assert [d["device_id"] for d in cameras.json()] == ["cam1", "cam2"]
+
+    alices = client.get("/devices", params={"owner_id": "alice"})
+    assert [d["device_id"] for d in alices.json()] == ["cam1", "light1"]
+
+    bobs_cameras = client.get("/devices", params={"type": "camera", "house_id": "bob-house"})
+    assert [d["device_id"] for d in bobs_cameras.json()] == ["cam2"]
+
+    by_room = client.get("/devices", params={"room": "Alice Kitchen", "limit": 1})
+    assert [d["device_id"] for d in by_room.json()] == ["cam1"]
+
+    assert client.get("/devices", params={"type": "toaster"}).status_code == 400
+
+def test_device_lookup_endpoints():
+    owner = make_user("lookup-owner")
+    house = make_house("lookup-house", owner)
+    room = make_room("Lookup Room", 1, house)
+    client.post("/devices", json={"device_id": "lk1", "type": "lock", "room": room})
+    client.post("/devices", json={"device_id": "lk2", "type": "light", "room": room})
+
+    by_type = client.get("/devices/by-type/lock")
+    assert [d["device_id"] for d in by_type.json()] == ["lk1"]
+    assert client.get("/devices/by-type/toaster").status_code == 422
+
+    for url in ["/rooms/Lookup Room/devices", "/houses/lookup-house/devices", "/users/lookup-owner/devices"]:
+        resp = client.get(url)
+        assert resp.status_code == 200, url
+        assert [d["device_id"] for d in resp.json()] == ["lk1", "lk2"]
+
+    assert client.get("/houses/ghost/devices").status_code == 404
+    assert client.get("/users/ghost/devices").status_code == 404
+    assert client.get("/rooms/ghost/devices").status_code == 404
+
+# -----------------------------
+# STREAMING
+# -----------------------------
+def test_stream_users_as_ndjson():
+    for user_id in ["s2", "s1", "s3"]:
+        make_user(user_id)
+
+    resp = client.get("/users", params={"stream": "true"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [u["user_id"] for u in lines] == ["s1", "s2", "s3"]
+    assert lines[0] == client.get("/users/s1").json()
+
+def test_stream_devices_with_accept_header():
+    owner = make_user("stream-owner")
+    room = make_room("Stream Room", 1, make_house("stream-house", owner))
+    for device_id, dev_type in [("sd1", "sensor"), ("sd2", "light"), ("sd3", "sensor")]:
+        client.post("/devices", json={"device_id": device_id, "type": dev_type, "room": room})
+
+    resp = client.get(
+        "/devices",
+        params={"type": "sensor", "limit": 1},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [d["device_id"] for d in lines] == ["sd1"]
+    assert lines[0]["room"]["house"]["owner"]["user_id"] == "stream-owner"
+
+    by_house = client.get("/houses/stream-house/devices", params={"stream": "true"})
+    assert len(by_house.text.splitlines()) == 3
+
+def test_stream_empty_list():
+    resp = client.get("/rooms", params={"stream": "true"})
+    assert resp.status_code == 200
+    assert resp.text == ""
+
+# -----------------------------
+# BATCHES
+# -----------------------------
+def test_users_batch_create_update_delete():
+    make_user("b-old")
+    resp = client.post("/users:batch", json={
+        "create": [make_user_body("b1"), make_user_body("b2")],
+        "update": [{**make_user_body("b-old"), "name": "Renamed"}],
+        "delete": ["b2"],
+    })
+    assert resp.status_code == 200
+    assert resp.json() == {"committed": True, "applied": 4, "errors": []}
+    assert client.get("/users/b1").status_code == 200
+    assert client.get("/users/b2").status_code == 404
+    assert client.get("/users/b-old").json()["name"] == "Renamed"
+
+def test_batch_reports_per_item_errors():
+    make_user("dup")
+    resp = client.post("/users:batch", json={
+        "create": [make_user_body("ok"), make_user_body("dup"), {"user_id": "bad"}],
+        "delete": ["missing"],
+    })
+    body = resp.json()
+    assert resp.status_code == 200
+    assert body["committed"] is True
+    assert body["applied"] == 1
+    assert [(e["op"], e["index"], e["id"], e["status"]) for e in body["errors"]] == [
+        ("create", 1, "dup", 409),
+        ("create", 2, "bad", 422),
+        ("delete", 0, "missing", 404),
+    ]
+    assert client.get("/users/ok").status_code == 200
+
+def test_atomic_batch_rolls_back_everything():
+    make_user("dup")
+    resp = client.post("/users:batch", json={
+        "create": [make_user_body("a1"), make_user_body("dup")],
+        "atomic": True,
+    })
+    assert resp.status_code == 409
+    assert resp.json()["committed"] is False
+    assert client.get("/users/a1").status_code == 404
+
+@pytest.mark.skipif(
+    storage.STORAGE_BACKEND == "sqlite", reason="counts writes to the store files"
+)
+def test_devices_batch_writes_once(monkeypatch):
+    import storage
+    owner = make_user("batch-owner")
+    room = make_room("Batch Room", 1, make_house("batch-house", owner))
+    store = storage.get_store("devices.json")
+    appends = []
+    real_append = store._append
+    monkeypatch.setattr(store, "_append", lambda ops: appends.append(len(ops)) or real_append(ops))
+
+    resp = client.post("/devices:batch", json={
+        "create": [{"device_id": f"bd{i}", "type": "light", "room": room} for i in range(20)]
+    })
+    assert resp.json()["applied"] == 20
+    assert appends == [20]
+    assert len(client.get("/rooms/Batch Room/devices").json()) == 20
+
+def test_rooms_batch_rename():
+    owner = make_user("rb-owner")
+    house = make_house("rb-house", owner)
+    resp = client.post("/rooms:batch", json={
+        "create": [{"name": "Den", "floor": 1, "house": house}],
+        "rename": [{"name": "Den", "new_name": "Study"}],
+    })
+    assert resp.json() == {"committed": True, "applied": 2, "errors": []}
+    assert client.get("/rooms/Study").status_code == 200
+    assert client.get("/rooms/Den").status_code == 404
+
+def test_atomic_rooms_batch_rolls_back_device_repointing():
+    owner = make_user("rb-owner")
+    house = make_house("rb-house", owner)
+    room = {"name": "Den", "floor": 1, "house": house}
+    client.post("/rooms", json=room)
+    client.post("/devices", json={"device_id": "d1", "type": "light", "room": room})
+
+    resp = client.post("/rooms:batch", json={
+        "rename": [{"name": "Den", "new_name": "Study"}],
+        "create": [{"name": "Bad", "floor": 1, "house": dict(house, house_id="nope")}],
+        "atomic": True,
+    })
+    assert resp.status_code == 409 and resp.json()["committed"] is False
+    assert client.get("/rooms/Den").status_code == 200
+    device = client.get("/devices/d1")
+    assert device.status_code == 200 and device.json()["room"]["name"] == "Den"
+
+# -----------------------------
+# DIRECT SERIALIZATION
+# -----------------------------
+def test_read_bodies_match_schema_serialization():
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from main import (
+        domain_user_to_pydantic, domain_house_to_pydantic,
+        domain_room_to_pydantic, domain_device_to_pydantic,
+    )
+    from device import get_device, find_devices
+    from room import get_room
+    from house import get_house
+    from user import get_user
+
+    def schema_body(content):
+        return JSONResponse(jsonable_encoder(content)).body
+
+    owner = make_user_body("ser-owner")
+    owner["name"] = "Zoë \"Quotes\" Ünïcode"
+    client.post("/users", json=owner)
+    house = make_house("ser-house", owner)
+    room = make_room("Salle à manger", 2, house)
+    for device_id in ("ser-d1", "ser-d2"):
+        client.post("/devices", json={"device_id": device_id, "type": "camera", "room": room})
+
+    assert client.get("/users/ser-owner").content == schema_body(domain_user_to_pydantic(get_user("ser-owner")))
+    assert client.get("/houses/ser-house").content == schema_body(domain_house_to_pydantic(get_house("ser-house")))
+    assert client.get("/rooms/Salle à manger").content == schema_body(domain_room_to_pydantic(get_room("Salle à manger")))
+    assert client.get("/devices/ser-d1").content == schema_body(domain_device_to_pydantic(get_device("ser-d1")))
+
+    devices, _ = find_devices()
+    listed = client.get("/devices")
+    assert listed.headers["content-type"] == "application/json"
+    assert listed.content == schema_body([domain_device_to_pydantic(d) for d in devices])
+
+def test_direct_serialization_keeps_cursor_header():
+    for user_id in ["c1", "c2", "c3"]:
+        make_user(user_id)
+    resp = client.get("/users", params={"limit": 2})
+    assert [u["user_id"] for u in resp.json()] == ["c1", "c2"]
+    assert "X-Next-Cursor" in resp.headers
+
+def test_geo_endpoints():
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    for house_id, lat, lon in [("common", 42.3551, -71.0656), ("fenway", 42.3467, -71.0972),
+                               ("nyc", 40.7128, -74.0060)]:
+        house = {"house_id": house_id, "address": "1 St", "owner": owner,
+                 "gps_location": [lat, lon], "num_rooms": 1, "num_baths": 1}
+        assert client.post("/houses", json=house).status_code == 201
+
+    near = client.get("/houses/near", params={"lat": 42.3551, "lon": -71.0656, "radius_km": 10}).json()
+    assert [n["house"]["house_id"] for n in near] == ["common", "fenway"]
+    assert near[0]["distance_km"] == 0
+
+    nearest = client.get("/houses/nearest", params={"lat": 40.7, "lon": -74.0, "k": 1}).json()
+    assert [n["house"]["house_id"] for n in nearest] == ["nyc"]
+
+    params = {"south": 40, "west": -75, "north": 43, "east": -71, "limit": 2}
+    resp = client.get("/houses/within", params=params)
+    assert [h["house_id"] for h in resp.json()] == ["common", "fenway"]
+    resp = client.get("/houses/within", params={**params, "cursor": resp.headers["X-Next-Cursor"]})
+    assert [h["house_id"] for h in resp.json()] == ["nyc"]
+
+    assert client.get("/houses/near", params={"lat": 95, "lon": 0, "radius_km": 1}).status_code == 422
+    assert client.get("/houses/within", params={**params, "south": 44}).status_code == 400
+
+def test_house_scoped_rooms():
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    houses = {}
+    for house_id in ("h1", "h2"):
+        houses[house_id] = {"house_id": house_id, "address": "1 St", "owner": owner,
+                            "gps_location": [0, 0], "num_rooms": 2, "num_baths": 1}
+        client.post("/houses", json=houses[house_id])
+        for name, floor in [("Kitchen", 1), ("Loft", 2)]:
+            resp = client.post("/rooms", json={"name": name, "floor": floor, "house": houses[house_id]})
+            assert resp.status_code == 201, resp.text
+    client.post("/devices", json={"device_id": "d1", "type": "light",
+                                  "room": {"name": "Kitchen", "floor": 1, "house": houses["h2"]}})
+
+    assert client.get("/rooms/Kitchen").status_code == 409
+    assert client.get("/houses/h2/rooms/Kitchen").json()["house"]["house_id"] == "h2"
+    assert [r["name"] for r in client.get("/houses/h1/rooms").json()] == ["Kitchen", "Loft"]
+    assert [r["name"] for r in client.get("/houses/h1/rooms", params={"floor": 2}).json()] == ["Loft"]
+    floors = client.get("/houses/h1/floors").json()
+    assert [(f["floor"], [r["name"] for r in f["rooms"]]) for f in floors] == [(1, ["Kitchen"]), (2, ["Loft"])]
+    assert client.get("/houses/h1/rooms/Kitchen/devices").json() == []
+    assert [d["device_id"] for d in client.get("/houses/h2/rooms/Kitchen/devices").json()] == ["d1"]
+
+    resp = client.put("/houses/h2/rooms/Kitchen", json={"name": "Galley", "floor": 1, "house": houses["h2"]})
+    assert resp.status_code == 200 and resp.json()["name"] == "Galley"
+    assert client.get("/devices/d1").json()["room"]["name"] == "Galley"
+    assert client.get("/rooms/Kitchen").json()["house"]["house_id"] == "h1"
+    assert client.delete("/houses/h2/rooms/Loft").status_code == 200
+    assert client.get("/houses/h2/rooms/Loft").status_code == 404
+    assert client.get("/houses/nope/rooms").status_code == 404
+
+def test_delete_modes():
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    house = {"house_id": "h1", "address": "1 St", "owner": owner,
+             "gps_location": [0, 0], "num_rooms": 1, "num_baths": 1}
+    client.post("/houses", json=house)
+    client.post("/rooms", json={"name": "Kitchen", "floor": 1, "house": house})
+    client.post("/devices", json={"device_id": "d1", "type": "light",
+                                  "room": {"name": "Kitchen", "floor": 1, "house": house}})
+
+    assert client.delete("/houses/h1/rooms/Kitchen", params={"on_delete": "restrict"}).status_code == 409
+    assert client.delete("/houses/h1", params={"on_delete": "restrict"}).status_code == 409
+    assert client.delete("/users/u1", params={"on_delete": "restrict"}).status_code == 409
+    assert client.delete("/users/u1", params={"on_delete": "sideways"}).status_code == 422
+    assert client.get("/devices/d1").status_code == 200
+
+    assert client.delete("/users/u1", params={"on_delete": "cascade"}).status_code == 200
+    for path in ("/houses", "/rooms", "/devices"):
+        assert client.get(path).json() == []
+
+def test_device_state():
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    house = {"house_id": "h1", "address": "1 St", "owner": owner,
+             "gps_location": [0, 0], "num_rooms": 1, "num_baths": 1}
+    client.post("/houses", json=house)
+    client.post("/rooms", json={"name": "Hall", "floor": 1, "house": house})
+    client.post("/devices", json={"device_id": "d1", "type": "thermostat",
+                                  "room": {"name": "Hall", "floor": 1, "house": house}})
+
+    resp = client.get("/devices/d1/state")
+    assert resp.json() == {"device_id": "d1", "version": 0, "reported": {}, "desired": {}, "delta": {}}
+
+    resp = client.patch("/devices/d1/state", json={"reported": {"setpoint": 20, "mode": "heat"}})
+    assert resp.json() == {"device_id": "d1", "version": 1, "reported": {"setpoint": 20, "mode": "heat"}}
+    resp = client.patch("/devices/d1/state", json={"desired": {"setpoint": 22}, "reported": {"mode": None}})
+    assert resp.json() == {"device_id": "d1", "version": 2, "reported": {"mode": None}, "desired": {"setpoint": 22}}
+    assert client.get("/devices/d1/state").json()["delta"] == {"setpoint": 22}
+
+    assert client.patch("/devices/d1/state", json={"desired": {"setpoint": 18}, "version": 1}).status_code == 409
+    assert client.patch("/devices/d1/state", json={"reported": {"": 1}}).status_code == 400
+    assert client.patch("/devices/nope/state", json={"reported": {"on": True}}).status_code == 404
+    assert client.get("/devices/nope/state").status_code == 404
+
+def test_rolled_back_device_delete_keeps_its_state():
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    house = {"house_id": "h1", "address": "1 St", "owner": owner,
+             "gps_location": [0, 0], "num_rooms": 1, "num_baths": 1}
+    room = {"name": "Hall", "floor": 1, "house": house}
+    client.post("/houses", json=house)
+    client.post("/rooms", json=room)
+    client.post("/devices", json={"device_id": "d1", "type": "thermostat", "room": room})
+    client.patch("/devices/d1/state", json={"reported": {"setpoint": 20}})
+
+    resp = client.post("/devices:batch", json={
+        "delete": ["d1"], "create": [{"device_id": "d2", "type": "bogus", "room": room}], "atomic": True,
+    })
+    assert resp.status_code == 409
+    state = client.get("/devices/d1/state").json()
+    assert (state["version"], state["reported"]) == (1, {"setpoint": 20})
+
+    resp = client.post("/devices:batch", json={"delete": ["d1"], "atomic": True})
+    assert resp.json()["committed"] is True
+    import device_state
+    assert "d1" not in device_state._state_store()
+
+def test_rolled_back_device_delete_keeps_its_telemetry(tmp_path, monkeypatch):
+    import telemetry
+    monkeypatch.setattr(telemetry, "TELEMETRY_DIR", str(tmp_path / "telemetry"))
+    monkeypatch.setattr(telemetry, "_series", {})
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    house = {"house_id": "h1", "address": "1 St", "owner": owner,
+             "gps_location": [0, 0], "num_rooms": 1, "num_baths": 1}
+    room = {"name": "Hall", "floor": 1, "house": house}
+    client.post("/houses", json=house)
+    client.post("/rooms", json=room)
+    client.post("/devices", json={"device_id": "s1", "type": "sensor", "room": room})
+    client.post("/devices/s1/telemetry", json={"metric": "co2", "ts": [1, 2], "values": [410, 420]})
+
+    resp = client.post("/devices:batch", json={
+        "delete": ["s1"], "create": [{"device_id": "s2", "type": "bogus", "room": room}], "atomic": True,
+    })
+    assert resp.status_code == 409
+    assert client.get("/devices/s1/telemetry", params={"metric": "co2"}).json()["values"] == [410.0, 420.0]
+
+    client.delete("/devices/s1")
+    assert os.listdir(tmp_path / "telemetry") == []
+
+def test_telemetry(tmp_path, monkeypatch):
+    import telemetry
+    monkeypatch.setattr(telemetry, "TELEMETRY_DIR", str(tmp_path))
+    monkeypatch.setattr(telemetry, "_series", {})
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    house = {"house_id": "h1", "address": "1 St", "owner": owner,
+             "gps_location": [0, 0], "num_rooms": 1, "num_baths": 1}
+    client.post("/houses", json=house)
+    client.post("/rooms", json={"name": "Hall", "floor": 1, "house": house})
+    room = {"name": "Hall", "floor": 1, "house": house}
+    client.post("/devices", json={"device_id": "s1", "type": "sensor", "room": room})
+    client.post("/devices", json={"device_id": "l1", "type": "light", "room": room})
+
+    resp = client.post("/devices/s1/telemetry", json={"metric": "co2", "ts": [3, 1, 2], "values": [430, 410, 420]})
+    assert resp.status_code == 201
+    assert resp.json() == {"device_id": "s1", "metric": "co2", "accepted": 3}
+    resp = client.get("/devices/s1/telemetry", params={"metric": "co2", "start": 2})
+    assert resp.json() == {"device_id": "s1", "metric": "co2", "ts": [2.0, 3.0], "values": [420.0, 430.0]}
+    assert client.get("/devices/s1/telemetry/metrics").json() == ["co2"]
+
+    rollup = client.get("/devices/s1/telemetry/rollup", params={"metric": "co2", "bucket": "1m"}).json()
+    assert (rollup["bucket"], rollup["start"], rollup["count"], rollup["mean"]) == ("1m", [0.0], [3], [420.0])
+    assert rollup["p50"] == [420.0]
+    house = client.get("/houses/h1/telemetry/rollup", params={"metric": "co2", "bucket": "1d"}).json()
+    assert (house["devices"], house["count"], house["max"]) == (1, [3], [430.0])
+    room_rollup = client.get("/houses/h1/rooms/Hall/telemetry/rollup", params={"metric": "co2"}).json()
+    assert room_rollup["min"] == [410.0]
+    assert client.get("/devices/s1/telemetry/rollup", params={"bucket": "2w"}).status_code == 400
+    assert client.get("/houses/nope/telemetry/rollup").status_code == 404
+    assert client.get("/houses/h1/rooms/Nope/telemetry/rollup").status_code == 404
+
+    assert client.post("/devices/l1/telemetry", json={"ts": [1], "values": [1]}).status_code == 400
+    assert client.post("/devices/s1/telemetry", json={"ts": [1, 2], "values": [1]}).status_code == 400
+    assert client.post("/devices/nope/telemetry", json={"ts": [1], "values": [1]}).status_code == 404
+    assert client.get("/devices/nope/telemetry").status_code == 404
+
+def test_event_stream_filters_are_checked():
+    # the stream itself never ends, so it's exercised in test_events.py
+    client.post("/users", json=make_user_body("u1"))
+    owner = client.get("/users/u1").json()
+    client.post("/houses", json={"house_id": "h1", "address": "1 St", "owner": owner,
+                                 "gps_location": [0, 0], "num_rooms": 1, "num_baths": 1})
+    assert client.get("/events", params={"room_name": "Hall"}).status_code == 400
+    assert client.get("/events", params={"kinds": "device,toaster"}).status_code == 400
+    assert client.get("/events", params={"house_id": "nope"}).status_code == 404
+    assert client.get("/events", params={"house_id": "h1", "room_name": "Nope"}).status_code == 404
+
+def test_changes_since():
+    client.post("/users", json=make_user_body("u1"))
+    snapshot = client.get("/changes").json()
+    assert snapshot["snapshot"] and [c["key"] for c in snapshot["changes"]] == ["u1"]
+
+    client.post("/users", json=make_user_body("u2"))
+    client.delete("/users/u1")
+    page = client.get("/changes", params={"since": snapshot["seq"]}).json()
+    assert page["snapshot"] is False
+    assert [(c["key"], c["op"], c["data"] is None) for c in page["changes"]] == [
+        ("u2", "put", False), ("u1", "delete", True),
+    ]
+    assert client.get("/changes", params={"since": page["seq"]}).json()["changes"] == []
+    assert client.get("/changes", params={"cursor": "bogus"}).status_code == 400
+    assert client.get("/changes", params={"limit": 0}).status_code == 422
@@ -0,0 +1,58 @@
+import pytest
+
+import storage
+from room import room_key
+from benchmarks.run import BATCH_ITEMS, build_dataset, compare, measure, measure_batches, percentile
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, "_stores", {})
+    return tmp_path
+
+def results(p50, mb=10.0):
+    return {"sizes": {"1000": {"peak_load_mb": mb, "ops": {"get_device": {"p50_ms": p50, "p95_ms": p50}}}}}
+
+def test_build_dataset_fan_out(scratch):
+    counts = build_dataset(200, seed=1)
+    assert sum(counts.values()) >= 200
+    assert counts["users"] <= counts["houses"] <= counts["rooms"] <= counts["devices"]
+
+    devices = storage.get_store("devices.json").load()
+    rooms = storage.get_store("rooms.json").load()
+    assert all(room_key(d["house_id"], d["room_name"]) in rooms for d in devices.values())
+
+def test_build_dataset_is_seeded(scratch):
+    first = build_dataset(100, seed=7)
+    devices = dict(storage.get_store("devices.json").load())
+    storage._stores.clear()
+    assert build_dataset(100, seed=7) == first
+    assert storage.get_store("devices.json").load() == devices
+
+def test_measure_and_percentiles():
+    stats = measure(lambda i: None, 10)
+    assert stats["samples"] == 10
+    assert stats["p50_ms"] <= stats["p95_ms"] <= stats["p99_ms"]
+    assert percentile([1, 2, 3, 4, 5], 50) == 3
+
+def test_compare_flags_only_real_regressions():
+    assert compare(results(1.1), results(1.0), tolerance=0.25) == []
+    assert len(compare(results(2.0), results(1.0), tolerance=0.25)) == 2  # p50 and p95
+    assert compare(results(1.0, mb=20.0), results(1.0), tolerance=0.25) == ["1000 peak_load_mb: 10.0 -> 20.0"]
+    assert compare(results(5.0), {"sizes": {}}, tolerance=0.25) == []
+
+def test_batch_routes_apply_every_item(scratch):
+    from fastapi.testclient import TestClient
+    from main import app
+    build_dataset(50, seed=1)
+    room = next(iter(storage.get_store("rooms.json").load().values()))
+    client = TestClient(app)
+    room_body = client.get(f"/houses/{room['house_id']}/rooms/{room['name']}").json()
+
+    responses = []
+    real_post = client.post
+    client.post = lambda route, json: responses.append(real_post(route, json=json)) or responses[-1]
+    ops = measure_batches(client, room_body, samples=2)
+
+    assert f"POST /rooms:batch rename x{BATCH_ITEMS}" in ops and len(ops) == 12
+    assert all(r.json() == {"committed": True, "applied": BATCH_ITEMS, "errors": []} for r in responses)
@@ -0,0 +1,122 @@
+import pytest
+
+import changes
+import storage
+from changes import get_changes
+from generate import generate_fleet, load_fleet
+from user import User, PrivilegeLevel, OnDelete, create_user, update_user, delete_user, user_batch
+from house import House, create_house
+from room import Room, create_room, update_room
+from device import Device, DeviceType, create_device, delete_device
+
+def _user(user_id, email="someone@example.com"):
+    return User(user_id, "Someone", email, PrivilegeLevel.OWNER)
+
+@pytest.fixture
+def room():
+    owner = create_user(_user("owner123"))
+    house = create_house(House("house456", "123 Pineapple Ave", owner, (40.7128, -74.0060), 3, 2))
+    return create_room(Room("Kitchen", 1, house))
+
+def _summary(page):
+    return [(c["kind"], c["key"], c["op"]) for c in page["changes"]]
+
+def test_changes_since_a_sequence_number(room):
+    since = get_changes(0)["seq"]
+    create_device(Device(DeviceType.LIGHT, "d1", room))
+    create_device(Device(DeviceType.LOCK, "d2", room))
+    update_user(_user("owner123", "new@example.com"))
+    delete_device("d1")
+
+    page = get_changes(since)
+    assert _summary(page) == [
+        ("device", "d2", "put"), ("user", "owner123", "put"), ("device", "d1", "delete"),
+    ]
+    assert page["changes"][1]["data"]["email"] == "new@example.com"  # as it is now
+    assert page["changes"][2]["data"] is None
+    assert (page["snapshot"], page["more"], page["seq"]) == (False, False, since + 4)
+    assert get_changes(page["seq"])["changes"] == []
+
+def test_a_record_is_listed_once_however_often_it_changed(room):
+    since = get_changes(0)["seq"]
+    for n in range(5):
+        update_user(_user("owner123", f"mo{n}@example.com"))
+    page = get_changes(since)
+    assert _summary(page) == [("user", "owner123", "put")]
+    assert page["changes"][0]["data"]["email"] == "mo4@example.com"
+    assert changes._head(changes._changes_store())["count"] == 3  # user, house, room
+
+def test_changes_are_paged(room):
+    since = get_changes(0)["seq"]
+    for n in range(5):
+        create_user(_user(f"u{n}"))
+    first = get_changes(since, limit=3)
+    assert ([c["key"] for c in first["changes"]], first["more"]) == (["u0", "u1", "u2"], True)
+    rest = get_changes(first["seq"], limit=3)
+    assert ([c["key"] for c in rest["changes"]], rest["more"]) == (["u3", "u4"], False)
+
+def test_renamed_room_is_a_tombstone_and_a_new_record(room):
+    since = get_changes(0)["seq"]
+    update_room(room, "Pantry")
+    assert _summary(get_changes(since)) == [
+        ("room", "house456/Kitchen", "delete"), ("room", "house456/Pantry", "put"),
+    ]
+
+def test_only_committed_batches_are_logged(room):
+    since = get_changes(0)["seq"]
+    with pytest.raises(RuntimeError):
+        with user_batch():
+            create_user(_user("u1"))
+            raise RuntimeError("rolled back")
+    with user_batch():
+        create_user(_user("u2"))
+        delete_user("u2")
+    assert _summary(get_changes(since)) == [("user", "u2", "delete")]
+
+def test_no_history_means_a_paged_snapshot(room):
+    create_device(Device(DeviceType.LIGHT, "d1", room))
+    page = get_changes(0, limit=3)
+    assert page["snapshot"] and page["more"]
+    assert _summary(page) == [
+        ("user", "owner123", "put"), ("house", "house456", "put"), ("room", "house456/Kitchen", "put"),
+    ]
+    seq = page["seq"]
+    create_user(_user("late"))  # while the snapshot is paged
+    rest = get_changes(0, limit=3, cursor=page["cursor"])
+    assert (_summary(rest), rest["more"], rest["seq"]) == ([("device", "d1", "put")], False, seq)
+    assert _summary(get_changes(rest["seq"])) == [("user", "late", "put")]
+
+    with pytest.raises(storage.CursorError):
+        get_changes(0, cursor="nonsense")
+
+def test_trimmed_history_falls_back_to_a_snapshot(room, monkeypatch):
+    monkeypatch.setattr(changes, "MAX_HISTORY", 3)
+    since = get_changes(0)["seq"]
+    for n in range(5):
+        create_user(_user(f"u{n}"))
+    head = changes._head(changes._changes_store())
+    assert (head["count"], head["floor"]) == (3, since + 2)
+    assert get_changes(since)["snapshot"]
+    assert _summary(get_changes(since + 2)) == [("user", f"u{n}", "put") for n in (2, 3, 4)]
+    assert get_changes(head["seq"] + 10)["snapshot"]  # a number this log never handed out
+
+def test_bulk_loads_reset_the_history(room):
+    since = get_changes(0)["seq"]
+    load_fleet(generate_fleet(users=2, seed=1))
+    page = get_changes(since)
+    assert page["snapshot"] and page["seq"] == since + 1
+    assert get_changes(page["seq"])["changes"] == []
+
+def test_a_cascade_is_logged_in_one_write(room, monkeypatch):
+    for n in range(5):
+        create_device(Device(DeviceType.LIGHT, f"d{n}", room))
+    since = get_changes(0)["seq"]
+    writes = []
+    real_record = changes.record
+    monkeypatch.setattr(changes, "record", lambda changed: writes.append(1) or real_record(changed))
+
+    delete_user("owner123", on_delete=OnDelete.CASCADE)
+    assert len(writes) == 1
+    assert [kind for kind, _, _ in _summary(get_changes(since))] == (
+        ["device"] * 5 + ["room", "house", "user"]
+    )
@@ -0,0 +1,56 @@
+import importlib
+import io
+import json
+
+import pytest
+
+import codec
+from starlette.responses import JSONResponse
+
+RECORD = {"name": "Café", "floor": 2, "gps": [42.36, -71.06], "tags": None, "on": True}
+
+@pytest.fixture
+def stdlib_codec(monkeypatch):
+    monkeypatch.setenv("SMART_HOME_JSON_CODEC", "stdlib")
+    yield importlib.reload(codec)
+    monkeypatch.undo()
+    importlib.reload(codec)
+
+def test_round_trip():
+    assert codec.loads(codec.dumps(RECORD)) == RECORD
+    assert codec.loads(codec.dumps_bytes(RECORD)) == RECORD
+
+def test_files_are_compact_by_default():
+    f = io.BytesIO()
+    codec.dump_file(RECORD, f)
+    assert b"\n" not in f.getvalue()
+    assert codec.load_file(io.BytesIO(f.getvalue())) == RECORD
+
+def test_reads_pretty_files_written_before():
+    f = io.BytesIO(json.dumps(RECORD, indent=2).encode())
+    assert codec.load_file(f) == RECORD
+
+def test_pretty_option(monkeypatch):
+    monkeypatch.setattr(codec, "PRETTY", True)
+    f = io.BytesIO()
+    codec.dump_file(RECORD, f)
+    assert json.loads(f.getvalue()) == RECORD
+    assert b'\n  "name"' in f.getvalue()
+
+def test_stdlib_fallback_matches_json_response(stdlib_codec):
+    assert stdlib_codec.NAME == "stdlib"
+    assert stdlib_codec.orjson is None
+    assert stdlib_codec.dumps_bytes(RECORD) == JSONResponse(RECORD).body
+
+def test_unknown_codec_is_rejected(monkeypatch):
+    monkeypatch.setenv("SMART_HOME_JSON_CODEC", "yaml")
+    with pytest.raises(ValueError):
+        importlib.reload(codec)
+    monkeypatch.undo()
+    importlib.reload(codec)
+
+def test_orjson_output_is_plain_json():
+    pytest.importorskip("orjson")
+    if codec.NAME != "orjson":
+        pytest.skip("SMART_HOME_JSON_CODEC=stdlib")
+    assert json.loads(codec.dumps_bytes(RECORD)) == RECORD
@@ -1,17 +1,30 @@
 import pytest
-from user import User, PrivilegeLevel
-from house import House
-from room import Room
-from device import Device, DeviceType, create_device, get_device, update_device, delete_device
+from user import User, PrivilegeLevel, OnDelete, create_user, delete_user
+from user import ConflictError as UserConflictError
+from house import House, create_house, delete_house, get_house_ids_by_owner
+from house import ConflictError as HouseConflictError
+from room import Room, create_room, update_room, delete_room, find_rooms
+from room import ConflictError as RoomConflictError
+from device import Device, DeviceType, create_device, get_device, update_device, delete_device, find_devices
 from device import DeviceNotFoundError, ValidationError, ConflictError
 
-import os
+import storage
 
-@pytest.fixture(autouse=True)
-def clean_devices_json():
-    if os.path.exists("devices.json"):
-        os.remove("devices.json")
-    yield
+# SQLite commits a batch as one transaction; these count file writes
+file_backends_only = pytest.mark.skipif(
+    storage.STORAGE_BACKEND == "sqlite", reason="counts writes to the store files"
+)
+
+def _count_writes(monkeypatch):
+    # the path of every store commit that reaches disk, on either file backend
+    writes = []
+    for cls in (storage.JsonStore, storage.LogStore):
+        real_append = cls.__dict__["_append"]
+        monkeypatch.setattr(
+            cls, "_append",
+            lambda self, ops, real_append=real_append: writes.append(self.path) or real_append(self, ops),
+        )
+    return writes
 
 @pytest.fixture
 def valid_room():
@@ -24,7 +37,12 @@ def valid_room():
         num_rooms=3,
         num_baths=2
     )
-    return Room("Living Room", 1, house)
+    room = Room("Living Room", 1, house)
+    # devices reference their room by name, so the whole chain must exist
+    create_user(owner)
+    create_house(house)
+    create_room(room)
+    return room
 
 @pytest.fixture
 def valid_device(valid_room):
@@ -38,6 +56,125 @@ def test_valid_device_creation(valid_device):
     created = create_device(valid_device)
     assert created == valid_device
 
+def test_device_record_references_room(valid_device):
+    create_device(valid_device)
+    record = storage.get_store("devices.json").get("d1")
+    assert record == {"device_id": "d1", "type": "light", "room_name": "Living Room", "house_id": "house456"}
+    assert get_device("d1") == valid_device
+
+def test_renamed_room_keeps_its_devices(valid_device):
+    create_device(valid_device)
+    update_room(valid_device.room, "Den")
+    assert get_device("d1").room.name == "Den"
+
+@file_backends_only
+def test_renaming_a_room_rewrites_devices_once(valid_device, valid_room, monkeypatch):
+    create_device(valid_device)
+    create_device(Device(DeviceType.CAMERA, "d2", valid_room))
+
+    writes = _count_writes(monkeypatch)
+    update_room(valid_room, "Den")
+    assert writes.count("devices.json") == 1
+    assert {d.room.name for d in find_devices()[0]} == {"Den"}
+
+def _second_house(valid_room):
+    # a neighbour with a room of the same name, which deletes must leave alone
+    other = House("house789", "9 Elm St", valid_room.house.owner, (40.7, -74.0), 1, 1)
+    create_house(other)
+    create_room(Room("Living Room", 1, other))
+    create_device(Device(DeviceType.LIGHT, "d9", Room("Living Room", 1, other)))
+    return other
+
+def test_a_failed_room_rename_renames_nothing(valid_device, valid_room, monkeypatch):
+    import device
+    from room import room_exists
+    _second_house(valid_room)
+    create_device(valid_device)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("crashed while re-pointing devices")
+
+    monkeypatch.setattr(device, "_publish_device", fail)
+    with pytest.raises(RuntimeError):
+        update_room(valid_room, "Den")
+    monkeypatch.undo()
+
+    assert room_exists("Living Room", "house456") and not room_exists("Den", "house456")
+    assert get_device(valid_device.device_id).room.name == "Living Room"
+    update_room(valid_room, "Den")
+    assert get_device(valid_device.device_id).room.name == "Den"
+    assert get_device("d9").room.name == "Living Room"  # the other house's room kept its name
+
+def test_restrict_refuses_while_dependents_exist(valid_device, valid_room):
+    create_device(valid_device)
+    with pytest.raises(RoomConflictError):
+        delete_room("Living Room", "house456", OnDelete.RESTRICT)
+    with pytest.raises(HouseConflictError):
+        delete_house("house456", OnDelete.RESTRICT)
+    with pytest.raises(UserConflictError):
+        delete_user("owner123", OnDelete.RESTRICT)
+    assert get_device("d1") == valid_device
+
+    delete_device("d1")
+    delete_room("Living Room", "house456", OnDelete.RESTRICT)
+    delete_house("house456", OnDelete.RESTRICT)
+
+def test_cascade_deletes_only_the_dependents(valid_device, valid_room):
+    create_device(valid_device)
+    _second_house(valid_room)
+
+    delete_room("Living Room", "house456", OnDelete.CASCADE)
+    with pytest.raises(DeviceNotFoundError):
+        get_device("d1")
+    assert get_device("d9").room.house.house_id == "house789"
+
+    create_room(valid_room)
+    create_device(valid_device)
+    delete_house("house456", OnDelete.CASCADE)
+    assert [r.house.house_id for r in find_rooms()[0]] == ["house789"]
+    assert [d.device_id for d in find_devices()[0]] == ["d9"]
+
+    delete_user("owner123", OnDelete.CASCADE)
+    assert get_house_ids_by_owner("owner123") == []
+    assert find_rooms()[0] == [] and find_devices()[0] == []
+    for filename in ["houses.json", "rooms.json", "devices.json"]:
+        assert storage.get_store(filename).load() == {}
+
+@file_backends_only
+def test_cascade_writes_once_per_store(valid_device, valid_room, monkeypatch):
+    create_device(valid_device)
+    create_device(Device(DeviceType.CAMERA, "d2", valid_room))
+    _second_house(valid_room)
+
+    writes = _count_writes(monkeypatch)
+    delete_user("owner123", OnDelete.CASCADE)
+    writes = [path for path in writes if path != "changes.json"]
+    assert sorted(writes) == sorted(["devices.json", "rooms.json", "houses.json", "users.json"])
+
+def test_indexes_follow_updates_and_deletes(valid_device, valid_room):
+    create_device(valid_device)
+    create_device(Device(DeviceType.CAMERA, "d2", valid_room))
+
+    def ids(**filters):
+        return [d.device_id for d in find_devices(**filters)[0]]
+
+    assert ids(house_id="house456") == ["d1", "d2"]
+    assert ids(owner_id="owner123") == ["d1", "d2"]
+    assert ids(type=DeviceType.CAMERA) == ["d2"]
+
+    update_device(Device(DeviceType.CAMERA, "d1", valid_room))
+    assert ids(type=DeviceType.CAMERA) == ["d1", "d2"]
+    assert ids(type=DeviceType.LIGHT) == []
+
+    delete_device("d2")
+    assert ids(room_name="Living Room") == ["d1"]
+    assert ids(owner_id="someone-else") == []
+
+def test_create_device_in_unknown_room(valid_room):
+    ghost_room = Room("Ghost Room", 1, valid_room.house)
+    with pytest.raises(ValidationError):
+        create_device(Device(DeviceType.LIGHT, "d9", ghost_room))
+
 def test_invalid_device_type(valid_room):
     with pytest.raises(ValidationError):
         Device("invalid_type", "d2", valid_room)
@@ -78,4 +215,47 @@ def test_nonexistent_operations():
     with pytest.raises(DeviceNotFoundError):
         get_device("ghost-device")
     with pytest.raises(DeviceNotFoundError):
-        delete_device("ghost-device")
\ No newline at end of file
+        delete_device("ghost-device")
+def test_devices_find_their_own_houses_room(valid_device):
+    create_device(valid_device)
+    other = House("house789", "9 Elm St", valid_device.room.house.owner, (42.0, -71.0), 1, 1)
+    create_house(other)
+    create_room(Room("Living Room", 2, other))
+    create_device(Device(DeviceType.LOCK, "d2", Room("Living Room", 2, other)))
+
+    assert get_device("d1").room.house.house_id == "house456"
+    assert get_device("d2").room.floor == 2
+
+    # renaming one house's room leaves the other house's devices alone
+    update_room(valid_device.room, "Den")
+    assert get_device("d1").room.name == "Den"
+    assert get_device("d2").room.name == "Living Room"
+
+def test_create_device_in_another_houses_room(valid_room):
+    other = House("house789", "9 Elm St", valid_room.house.owner, (42.0, -71.0), 1, 1)
+    create_house(other)
+    with pytest.raises(ValidationError):
+        create_device(Device(DeviceType.LOCK, "d2", Room("Living Room", 1, other)))
+
+def test_parents_are_built_once_across_listings(valid_room, monkeypatch):
+    import user
+    for i in range(5):
+        create_device(Device(DeviceType.SENSOR, f"s{i}", valid_room))
+    first, _ = find_devices()
+
+    built = []
+    real_init = user.User.__init__
+    monkeypatch.setattr(user.User, "__init__", lambda self, *a, **k: built.append(1) or real_init(self, *a, **k))
+    second, _ = find_devices()
+
+    assert built == []  # the owner was neither rebuilt nor re-validated
+    assert len({id(d.room) for d in first + second}) == 1
+    assert second[0].room.house.owner is first[0].room.house.owner
+
+def test_update_room_leaves_shared_room_alone(valid_device):
+    create_device(valid_device)
+    shared_room = get_device("d1").room
+    renamed = update_room(shared_room, "Den")
+    assert renamed is not shared_room
+    assert shared_room.name == "Living Room"
+    assert get_device("d1").room.name == "Den"
@@ -0,0 +1,96 @@
+import pytest
+from user import User, PrivilegeLevel, create_user
+from house import House, create_house
+from room import Room, create_room
+from device import Device, DeviceType, DeviceNotFoundError, create_device, delete_device
+import device_state
+from storage import get_store
+from device_state import DeviceState, get_state, update_state, ValidationError, ConflictError
+
+@pytest.fixture
+def light():
+    owner = User("owner123", "Mo Salad", "mosalad@example.com", PrivilegeLevel.OWNER)
+    house = House("house456", "123 Pineapple Ave", owner, (40.7128, -74.0060), 3, 2)
+    room = Room("Living Room", 1, house)
+    create_user(owner)
+    create_house(house)
+    create_room(room)
+    return create_device(Device(DeviceType.LIGHT, "d1", room))
+
+def test_new_device_has_empty_state(light):
+    assert get_state("d1") == DeviceState("d1", 0, {}, {})
+    with pytest.raises(DeviceNotFoundError):
+        get_state("ghost")
+    with pytest.raises(DeviceNotFoundError):
+        update_state("ghost", reported={"on": True})
+
+def test_updates_return_only_what_changed(light):
+    state, changes = update_state("d1", reported={"on": False, "brightness": 80, "color": {"r": 1, "g": 2}})
+    assert state.version == 1
+    assert changes == {"reported": {"on": False, "brightness": 80, "color": {"r": 1, "g": 2}}}
+
+    state, changes = update_state("d1", reported={"on": True, "brightness": 80, "color": {"g": 2, "b": 3}})
+    assert state.version == 2
+    assert changes == {"reported": {"on": True, "color": {"b": 3}}}
+    assert state.reported == {"on": True, "brightness": 80, "color": {"r": 1, "g": 2, "b": 3}}
+
+    state, changes = update_state("d1", reported={"brightness": None, "missing": None})
+    assert changes == {"reported": {"brightness": None}}
+    assert "brightness" not in state.reported
+
+def test_noop_update_keeps_the_version_and_writes_nothing(light):
+    update_state("d1", reported={"on": True})
+    log = device_state._state_store().log_path
+    with open(log) as f:
+        lines = f.readlines()
+
+    state, changes = update_state("d1", reported={"on": True})
+    assert (state.version, changes) == (1, {})
+    with open(log) as f:
+        assert f.readlines() == lines
+
+    # true and 1 compare equal in Python but are different states
+    assert update_state("d1", reported={"on": 1})[1] == {"reported": {"on": 1}}
+
+def test_delta_is_desired_minus_reported(light):
+    update_state("d1", reported={"on": False, "brightness": 80})
+    state, changes = update_state("d1", desired={"on": True, "brightness": 80})
+    assert changes == {"desired": {"on": True, "brightness": 80}}
+    assert state.delta == {"on": True}
+
+    state, _ = update_state("d1", reported={"on": True})
+    assert state.delta == {}
+
+def test_expected_version_guards_against_lost_updates(light):
+    update_state("d1", desired={"on": True})
+    with pytest.raises(ConflictError):
+        update_state("d1", desired={"on": False}, expected_version=0)
+    assert get_state("d1").desired == {"on": True}
+    assert update_state("d1", desired={"on": False}, expected_version=1)[0].version == 2
+
+def test_invalid_patches_are_rejected(light, monkeypatch):
+    with pytest.raises(ValidationError):
+        update_state("d1", reported=["on"])
+    with pytest.raises(ValidationError):
+        update_state("d1", reported={"": 1})
+    monkeypatch.setattr(device_state, "MAX_STATE_BYTES", 64)
+    with pytest.raises(ValidationError):
+        update_state("d1", reported={"blob": "x" * 100})
+    assert get_state("d1").version == 0
+
+def test_state_never_touches_the_device_registry(light, monkeypatch):
+    registry = get_store("devices.json")
+
+    def no_writes(*args, **kwargs):
+        raise AssertionError("state updates must not write the device registry")
+
+    for method in ("put", "update", "delete", "batch"):
+        monkeypatch.setattr(registry, method, no_writes)
+    for level in range(20):
+        update_state("d1", reported={"brightness": level})
+    assert get_state("d1").version == 20
+
+def test_deleting_a_device_drops_its_state(light):
+    update_state("d1", reported={"on": True})
+    delete_device("d1")
+    assert "d1" not in device_state._state_store()
@@ -0,0 +1,167 @@
+import asyncio
+import json
+
+import pytest
+from user import User, PrivilegeLevel, OnDelete, create_user, update_user, delete_user, user_batch
+from house import House, create_house
+from room import Room, create_room, update_room
+from device import Device, DeviceType, create_device, update_device
+from device_state import update_state
+import events
+
+@pytest.fixture(autouse=True)
+def no_leftover_subscribers():
+    yield
+    assert events._subscribers == {}
+
+@pytest.fixture
+def owner():
+    return create_user(User("owner123", "Mo Salad", "mosalad@example.com", PrivilegeLevel.OWNER))
+
+def _house(owner, house_id="house456"):
+    return create_house(House(house_id, "123 Pineapple Ave", owner, (40.7128, -74.0060), 3, 2))
+
+def _parse(chunk):
+    frames = []
+    for block in chunk.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in fields:
+            frames.append((fields["event"], json.loads(fields["data"])))
+    return frames
+
+async def _read(stream, timeout=1.0):
+    return _parse(await asyncio.wait_for(stream.__anext__(), timeout))
+
+def _feed(scenario, **filters):
+    """Run `scenario()` against an open stream; return the frames it produced."""
+    async def run():
+        stream = events.stream(**filters)
+        await stream.__anext__()  # subscribed
+        try:
+            scenario()
+            frames = []
+            while True:
+                try:
+                    frames += await _read(stream, timeout=0.05)
+                except asyncio.TimeoutError:
+                    return frames
+        finally:
+            await stream.aclose()
+    return asyncio.run(run())
+
+def test_crud_functions_publish_events(owner):
+    def scenario():
+        house = _house(owner)
+        room = create_room(Room("Kitchen", 1, house))
+        create_device(Device(DeviceType.LIGHT, "d1", room))
+        update_state("d1", reported={"on": True})
+        update_user(User("owner123", "Mo Salad", "mo@example.com", PrivilegeLevel.OWNER))
+        delete_user("owner123", on_delete=OnDelete.CASCADE)
+
+    frames = _feed(scenario)
+    assert [name for name, _ in frames] == [
+        "house.create", "room.create", "device.create", "device_state.update",
+        "user.update", "device.delete", "room.delete", "house.delete", "user.delete",
+    ]
+    ids = [data["id"] for _, data in frames]
+    assert ids == sorted(ids)
+    device = frames[2][1]
+    assert (device["key"], device["house_id"], device["room_name"]) == ("d1", "house456", "Kitchen")
+    assert device["data"]["type"] == "light"
+    assert frames[3][1]["data"] == {"version": 1, "reported": {"on": True}}
+    assert device["seq"] + 1 == frames[4][1]["seq"] and frames[3][1]["seq"] is None
+    assert frames[-1][1]["data"] is None
+
+def test_room_filter_follows_devices_out_of_the_room(owner):
+    house, other = _house(owner), _house(owner, "house789")
+    kitchen = create_room(Room("Kitchen", 1, house))
+    den = create_room(Room("Den", 1, house))
+
+    def scenario():
+        create_device(Device(DeviceType.LIGHT, "d1", kitchen))
+        create_device(Device(DeviceType.LIGHT, "d2", den))
+        create_device(Device(DeviceType.LIGHT, "d3", create_room(Room("Kitchen", 1, other))))
+        update_state("d1", reported={"on": True})
+        update_device(Device(DeviceType.LIGHT, "d1", den))  # moves out of the kitchen
+
+    in_kitchen = _feed(scenario, house_id="house456", room_name="Kitchen")
+    assert [(name, data["key"]) for name, data in in_kitchen] == [
+        ("device.create", "d1"), ("device_state.update", "d1"), ("device.update", "d1"),
+    ]
+    assert in_kitchen[-1][1]["room_name"] == "Den"
+
+def test_filters_by_house_and_kind(owner):
+    house = _house(owner)
+
+    def scenario():
+        create_room(Room("Kitchen", 1, house))
+        create_room(Room("Attic", 3, _house(owner, "house789")))
+        update_user(User("owner123", "Mo Salad", "mo@example.com", PrivilegeLevel.OWNER))
+
+    frames = _feed(scenario, house_id="house456")
+    assert [(name, data["key"]) for name, data in frames] == [("room.create", "house456/Kitchen")]
+
+    frames = _feed(lambda: delete_user("owner123"), kinds=events.parse_kinds("user,device"))
+    assert [name for name, _ in frames] == ["user.delete"]
+    with pytest.raises(events.ValidationError):
+        events.parse_kinds("device,toaster")
+
+def test_renaming_a_room_is_a_delete_and_a_create(owner):
+    room = create_room(Room("Kitchen", 1, _house(owner)))
+    create_device(Device(DeviceType.LIGHT, "d1", room))
+
+    frames = _feed(lambda: update_room(room, "Pantry"))
+    assert [(name, data["key"]) for name, data in frames] == [
+        ("room.delete", "house456/Kitchen"), ("room.create", "house456/Pantry"),
+        ("device.update", "d1"),
+    ]
+
+def test_batches_publish_only_what_commits(owner):
+    def scenario():
+        with pytest.raises(RuntimeError):
+            with user_batch():
+                create_user(User("u1", "One", "one@example.com", PrivilegeLevel.RESIDENT))
+                raise RuntimeError("rolled back")
+        with user_batch():
+            create_user(User("u2", "Two", "two@example.com", PrivilegeLevel.RESIDENT))
+            create_user(User("u3", "Three", "three@example.com", PrivilegeLevel.RESIDENT))
+
+    frames = _feed(scenario)
+    assert [(name, data["key"]) for name, data in frames] == [("user.create", "u2"), ("user.create", "u3")]
+
+def test_slow_subscriber_is_dropped_to_a_resync(owner, monkeypatch):
+    monkeypatch.setattr(events, "QUEUE_SIZE", 3)
+
+    def scenario():
+        for n in range(5):
+            create_user(User(f"u{n}", "Someone", "someone@example.com", PrivilegeLevel.RESIDENT))
+
+    async def run():
+        slow = events.stream()
+        await slow.__anext__()
+        try:
+            scenario()  # nothing is read while these are published
+            assert await _read(slow) == [("resync", {})]
+            create_user(User("u9", "Someone", "someone@example.com", PrivilegeLevel.RESIDENT))
+            assert [name for name, _ in await _read(slow)] == ["user.create"]
+        finally:
+            await slow.aclose()
+    asyncio.run(run())
+
+def test_reconnect_opens_with_a_resync(owner, monkeypatch):
+    monkeypatch.setattr(events, "HEARTBEAT", 0.01)
+
+    async def run():
+        stream = events.stream(resync=True)
+        try:
+            first = await stream.__anext__()
+            assert first.startswith("retry: ") and _parse(first) == [("resync", {})]
+            assert await stream.__anext__() == events.KEEPALIVE_FRAME
+            assert len(events._subscribers[None]) == 1
+        finally:
+            await stream.aclose()
+    asyncio.run(run())
+
+def test_publishing_without_subscribers_is_a_no_op(owner):
+    events.publish("user", "update", "owner123", {})
+    assert events._subscribers == {}
@@ -0,0 +1,75 @@
+import argparse
+import itertools
+
+import pytest
+
+import storage
+from generate import generate_fleet, load_fleet, parse_mix, parse_range, main
+from user import User, get_user
+from house import House, get_house
+from room import Room, get_room
+from device import Device, DeviceType, get_all_devices, find_devices
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, "_stores", {})
+    return tmp_path
+
+def test_fleet_is_deterministic():
+    first = list(generate_fleet(users=5, seed=3))
+    assert first == list(generate_fleet(users=5, seed=3))
+    assert first != list(generate_fleet(users=5, seed=4))
+
+def test_fleet_shape():
+    entities = list(generate_fleet(
+        users=4, houses_per_user=(2, 2), floors=(2, 2), rooms_per_floor=(1, 1),
+        devices_per_room=(3, 3), mix={DeviceType.LOCK: 1},
+    ))
+    by_kind = {kind: [e for e in entities if type(e) is kind] for kind in (User, House, Room, Device)}
+    assert [len(by_kind[k]) for k in (User, House, Room, Device)] == [4, 8, 16, 48]
+    assert all(h.num_rooms == 2 for h in by_kind[House])
+    assert {d.type for d in by_kind[Device]} == {DeviceType.LOCK}
+    assert all(-90 <= h.gps_location[0] <= 90 for h in by_kind[House])
+
+def test_load_fleet_round_trips(scratch):
+    entities = list(generate_fleet(users=3, seed=1))
+    counts = load_fleet(iter(entities))
+    assert sum(counts.values()) == len(entities)
+
+    user = next(e for e in entities if isinstance(e, User))
+    house = next(e for e in entities if isinstance(e, House))
+    room = next(e for e in entities if isinstance(e, Room))
+    assert get_user(user.user_id) == user
+    assert get_house(house.house_id) == house
+    assert get_room(room.name) == room
+    assert len(get_all_devices()) == counts["devices.json"]
+
+def test_load_fleet_prefix_is_consistent(scratch):
+    load_fleet(itertools.islice(generate_fleet(users=10, seed=2), 50))
+    # every device's room and house exist, so nothing is skipped as an orphan
+    devices, _ = find_devices()
+    assert len(devices) == len(storage.get_store("devices.json").load())
+
+def test_bulk_load_replaces_indexes(scratch):
+    store = storage.get_store("things.json", "json")
+    store.ensure_index("color")
+    store.put("a", {"color": "red"})
+    assert store.bulk_load(iter([("b", {"color": "red"}), ("a", {"color": "blue"})])) == 2
+    assert store.find("color", "red") == ["b"]
+    assert storage.JsonStore("things.json").load() == {"a": {"color": "blue"}, "b": {"color": "red"}}
+
+def test_cli(scratch, capsys, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "json")
+    assert main(["--users", "2", "--devices-per-room", "1", "--dir", str(scratch / "out")]) == 0
+    assert (scratch / "out" / "devices.json").exists()
+    assert "entities in" in capsys.readouterr().out
+
+def test_argument_parsers():
+    assert parse_range("3") == (3, 3)
+    assert parse_range("2-6") == (2, 6)
+    assert parse_mix("light=1,lock=3") == {DeviceType.LIGHT: 1.0, DeviceType.LOCK: 3.0}
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_range("6-2")
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_mix("toaster=1")
@@ -1,23 +1,22 @@
 import pytest
-from user import User, PrivilegeLevel
+from user import User, PrivilegeLevel, create_user, update_user
 from house import House, create_house, get_house, update_house, delete_house
 from house import HouseNotFoundError, ValidationError, ConflictError
-import os
-
-@pytest.fixture(autouse=True)
-def clean_houses_file():
-    if os.path.exists("houses.json"):
-        os.remove("houses.json")
-    yield
+from house import GeoIndex, _distances_km, find_houses_in_box, find_houses_near, find_nearest_houses
+from storage import get_store
+import random
 
 @pytest.fixture
 def sample_owner():
-    return User(
+    owner = User(
         user_id="owner123",
         name="Mo Salad",
         email="mosalad@example.com",
         privilege=PrivilegeLevel.OWNER
     )
+    # houses reference their owner by id, so the owner has to exist
+    create_user(owner)
+    return owner
 
 @pytest.fixture
 def valid_house(sample_owner):
@@ -35,6 +34,23 @@ def test_create_and_get_house(valid_house):
     retrieved = get_house("house456")
     assert retrieved == valid_house
 
+def test_house_record_references_owner(valid_house):
+    create_house(valid_house)
+    record = get_store("houses.json").get("house456")
+    assert record["owner_id"] == "owner123"
+    assert "owner" not in record
+
+def test_owner_update_is_seen_by_house(valid_house, sample_owner):
+    create_house(valid_house)
+    update_user(User(sample_owner.user_id, "Mo Salad", "new@example.com", PrivilegeLevel.OWNER))
+    assert get_house("house456").owner.email == "new@example.com"
+
+def test_create_house_with_unknown_owner(valid_house):
+    stranger = User("nobody", "No Body", "nobody@example.com", PrivilegeLevel.OWNER)
+    house = House("house789", "1 Nowhere", stranger, (0, 0), 1, 1)
+    with pytest.raises(ValidationError):
+        create_house(house)
+
 def test_invalid_gps(valid_house):
     with pytest.raises(ValidationError):
         House(
@@ -100,4 +116,92 @@ def test_update_nonexistent_house(sample_owner):
 
 def test_delete_nonexistent_house():
     with pytest.raises(HouseNotFoundError):
-        delete_house("non-existent-id")
\ No newline at end of file
+        delete_house("non-existent-id")
+
+
+def test_reads_share_one_object_until_it_changes(valid_house):
+    create_house(valid_house)
+    assert get_house("house456") is get_house("house456")
+
+    before = get_house("house456")
+    update_house(House("house456", "9 New Rd", valid_house.owner, (1.0, 2.0), 4, 2))
+    after = get_house("house456")
+    assert after is not before
+    assert after.address == "9 New Rd"
+    assert before.address == "123 Pineapple Ave"
+
+# ---------- geo queries ----------
+
+def _house_at(owner, house_id, lat, lon):
+    return create_house(House(house_id, f"{house_id} St", owner, (lat, lon), 1, 1))
+
+@pytest.fixture
+def boston(sample_owner):
+    _house_at(sample_owner, "common", 42.3551, -71.0656)
+    _house_at(sample_owner, "fenway", 42.3467, -71.0972)
+    _house_at(sample_owner, "cambridge", 42.3736, -71.1097)
+    _house_at(sample_owner, "nyc", 40.7128, -74.0060)
+    return sample_owner
+
+def test_houses_near_a_point_nearest_first(boston):
+    found = find_houses_near(42.3551, -71.0656, radius_km=5)
+    assert [h.house_id for h, _ in found] == ["common", "fenway", "cambridge"]
+    assert found[0][1] == 0
+    assert 2.5 < found[1][1] < 3.0
+
+def test_houses_in_box(boston):
+    houses, _ = find_houses_in_box(42.30, -71.10, 42.36, -71.0)
+    assert [h.house_id for h in houses] == ["common", "fenway"]
+
+def test_box_pages(boston):
+    page, cursor = find_houses_in_box(40, -75, 43, -71, limit=2)
+    assert [h.house_id for h in page] == ["cambridge", "common"]
+    page, _ = find_houses_in_box(40, -75, 43, -71, limit=2, cursor=cursor)
+    assert [h.house_id for h in page] == ["fenway", "nyc"]
+
+def test_nearest_houses(boston):
+    found = find_nearest_houses(40.0, -74.0, k=2)
+    assert [h.house_id for h, _ in found] == ["nyc", "fenway"]
+
+def test_box_across_the_antimeridian(sample_owner):
+    _house_at(sample_owner, "fiji", -17.7, 178.0)
+    _house_at(sample_owner, "samoa", -13.8, -172.1)
+    _house_at(sample_owner, "sydney", -33.9, 151.2)
+    houses, _ = find_houses_in_box(-20, 170, -10, -170)
+    assert [h.house_id for h in houses] == ["fiji", "samoa"]
+
+def test_geo_index_follows_updates_and_deletes(boston):
+    update_house(House("nyc", "moved", boston, (42.3601, -71.0589), 1, 1))
+    delete_house("fenway")
+    found = find_houses_near(42.3551, -71.0656, radius_km=5)
+    assert [h.house_id for h, _ in found] == ["common", "nyc", "cambridge"]
+
+def test_geo_queries_validate_input(boston):
+    with pytest.raises(ValidationError):
+        find_houses_near(91, 0, radius_km=1)
+    with pytest.raises(ValidationError):
+        find_houses_in_box(10, 0, 5, 1)
+    with pytest.raises(ValidationError):
+        find_nearest_houses(0, 0, k=0)
+
+def test_geo_index_matches_brute_force():
+    rng = random.Random(7)
+    index, points = GeoIndex(cell_degrees=1.0), {}
+    for i in range(2000):
+        # crowd some points around the antimeridian and the south pole
+        lat = rng.uniform(-90, -80) if i % 3 == 0 else rng.uniform(-90, 90)
+        lon = rng.choice([-179.9, 179.9]) if i % 3 == 1 else rng.uniform(-180, 180)
+        points[f"h{i:04d}"] = (lat, lon)
+        index.add(f"h{i:04d}", {"gps_location": [lat, lon]})
+    for i in range(0, 2000, 5):
+        index.discard(f"h{i:04d}")
+        del points[f"h{i:04d}"]
+
+    keys = list(points)
+    for _ in range(50):
+        lat, lon = rng.uniform(-90, 90), rng.choice([rng.uniform(-180, 180), 179.95])
+        distances = _distances_km(lat, lon, [points[k][0] for k in keys], [points[k][1] for k in keys])
+        by_distance = sorted(zip(distances, keys))
+        radius = rng.choice([50, 500, 5000])
+        assert [k for k, _ in index.within(lat, lon, radius)] == [k for d, k in by_distance if d <= radius]
+        assert [k for k, _ in index.nearest(lat, lon, 7)] == [k for _, k in by_distance[:7]]
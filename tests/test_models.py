@@ -0,0 +1,71 @@
+import tracemalloc
+
+import pytest
+
+from user import User, PrivilegeLevel
+from house import House
+from room import Room
+from device import Device, DeviceType
+
+# an instance with slots is a GC header plus one pointer per field; leave some
+# slack for the allocator, but nowhere near what a per-instance __dict__ costs
+MAX_BYTES_PER_ENTITY = 120
+SCALE = 20_000
+
+@pytest.fixture
+def owner():
+    return User("u1", "Mo Salad", "mosalad@example.com", PrivilegeLevel.OWNER)
+
+@pytest.fixture
+def room(owner):
+    return Room("Kitchen", 1, House("h1", "1 Main St", owner, (40.0, -70.0), 3, 2))
+
+def bytes_per_entity(build):
+    ids = [f"id-{i}" for i in range(SCALE)]  # allocated up front, not counted
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        entities = [build(i) for i in ids]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    list_bytes = 8 * len(entities)
+    return (after - before - list_bytes) / SCALE
+
+def test_models_have_no_instance_dict(owner, room):
+    device = Device(DeviceType.LIGHT, "d1", room)
+    for entity in (owner, room.house, room, device):
+        assert not hasattr(entity, "__dict__")
+        with pytest.raises(AttributeError):
+            entity.nickname = "x"
+
+def test_device_bytes_per_entity(room):
+    assert bytes_per_entity(lambda i: Device._trusted(DeviceType.LIGHT, i, room)) <= MAX_BYTES_PER_ENTITY
+
+def test_user_bytes_per_entity():
+    assert bytes_per_entity(
+        lambda i: User._trusted(i, "Name", "a@b.com", PrivilegeLevel.OWNER)
+    ) <= MAX_BYTES_PER_ENTITY
+
+def test_house_and_room_bytes_per_entity(owner):
+    location = (40.0, -70.0)
+    house = House._trusted("h1", "1 Main St", owner, location, 3, 2)
+    assert bytes_per_entity(lambda i: House._trusted(i, "1 Main St", owner, location, 3, 2)) <= MAX_BYTES_PER_ENTITY
+    assert bytes_per_entity(lambda i: Room._trusted(i, 1, house)) <= MAX_BYTES_PER_ENTITY
+
+def test_hash_by_primary_key(owner, room):
+    renamed = User("u1", "Someone Else", "else@example.com", PrivilegeLevel.ADMIN)
+    assert hash(renamed) == hash(owner)
+    assert renamed != owner
+    assert {owner, User("u1", "Mo Salad", "mosalad@example.com", PrivilegeLevel.OWNER)} == {owner}
+
+    devices = {Device(DeviceType.LIGHT, "d1", room), Device(DeviceType.LIGHT, "d1", room)}
+    assert len(devices) == 1
+    assert owner != "u1"
+
+def test_trusted_matches_validated(owner, room):
+    assert User._trusted("u1", "Mo Salad", "mosalad@example.com", PrivilegeLevel.OWNER) == owner
+    house = room.house
+    assert House._trusted(house.house_id, house.address, owner, house.gps_location, 3, 2) == house
+    assert Room._trusted("Kitchen", 1, house) == room
+    assert Device._trusted(DeviceType.LIGHT, "d1", room) == Device(DeviceType.LIGHT, "d1", room)
@@ -1,7 +1,11 @@
+import os
+
 import pytest
-from user import User, PrivilegeLevel
-from house import House
+from user import User, PrivilegeLevel, create_user
+from house import House, create_house
+import storage
 from room import Room, create_room, get_room, update_room, delete_room
+from room import find_rooms, get_rooms_by_floor, load_rooms_from_json, room_exists, save_rooms_to_json
 from room import RoomNotFoundError, ValidationError, ConflictError
 
 @pytest.fixture
@@ -16,6 +20,13 @@ def valid_house():
         num_baths=2
     )
 
+@pytest.fixture(autouse=True)
+def stored_house(valid_house):
+    # rooms reference their house by id, so the house (and its owner) must exist
+    create_user(valid_house.owner)
+    create_house(valid_house)
+    yield
+
 @pytest.fixture
 def valid_room(valid_house):
     return Room(
@@ -45,9 +56,9 @@ def test_invalid_house_type():
         Room("Test", 1, "not-a-house")  # Invalid house type
 
 def test_duplicate_room_name(valid_room):
-    # create_room(valid_room)
-    ## on purpose to test ConflictError, 
-    ## commented out for passing github action tests
+    # each test starts from empty stores now, so the room has to be created
+    # here rather than left behind by an earlier test
+    create_room(valid_room)
     with pytest.raises(ConflictError):
         create_room(valid_room)
 
@@ -62,4 +73,69 @@ def test_nonexistent_operations():
     with pytest.raises(RoomNotFoundError):
         get_room("Ghost Room")
     with pytest.raises(RoomNotFoundError):
-        delete_room("Ghost Room")
\ No newline at end of file
+        delete_room("Ghost Room")
+
+
+# ---------- rooms keyed by house ----------
+
+@pytest.fixture
+def two_houses(valid_house):
+    for filename in ["rooms.json", "devices.json"]:
+        if os.path.exists(filename):
+            os.remove(filename)
+    other = House("house789", "9 Elm St", valid_house.owner, (42.0, -71.0), 2, 1)
+    create_house(other)
+    for house in (valid_house, other):
+        create_room(Room("Kitchen", 1, house))
+        create_room(Room("Attic", 3, house))
+    create_room(Room("Den", 1, valid_house))
+    return valid_house, other
+
+def test_same_name_in_two_houses(two_houses):
+    first, second = two_houses
+    assert get_room("Kitchen", house_id="house456").house == first
+    assert get_room("Kitchen", house_id="house789").house == second
+    assert get_room("Den").house == first  # unique names still resolve alone
+    with pytest.raises(ConflictError):
+        get_room("Kitchen")
+    with pytest.raises(ConflictError):
+        create_room(Room("Kitchen", 2, second))
+    assert load_rooms_from_json().keys() == {
+        "house456/Kitchen", "house456/Attic", "house456/Den", "house789/Kitchen", "house789/Attic",
+    }
+
+@pytest.mark.skipif(storage.STORAGE_BACKEND == "sqlite", reason="SQLite filters in the query")
+def test_house_listing_only_visits_that_house(two_houses, monkeypatch):
+    checked = []
+    real_matches = storage.matches
+    monkeypatch.setattr(storage, "matches", lambda r, w: checked.append(r) or real_matches(r, w))
+    rooms, _ = find_rooms(house_id="house789")
+    assert [r.name for r in rooms] == ["Attic", "Kitchen"]
+    assert len(checked) == 2
+
+def test_rooms_by_floor(two_houses):
+    floors = get_rooms_by_floor("house456")
+    assert list(floors) == [1, 3]
+    assert sorted(r.name for r in floors[1]) == ["Den", "Kitchen"]
+
+def test_rename_moves_the_record_within_its_house(two_houses):
+    first, _ = two_houses
+    renamed = update_room(get_room("Kitchen", house_id="house456"), "Galley")
+    assert renamed.name == "Galley" and renamed.floor == 1
+    assert [r.name for r in find_rooms(house_id="house456")[0]] == ["Attic", "Den", "Galley"]
+    assert get_room("Kitchen").house.house_id == "house789"  # no longer ambiguous
+    with pytest.raises(ConflictError):
+        update_room(renamed, "Den")
+
+def test_delete_by_house(two_houses):
+    delete_room("Kitchen", house_id="house789")
+    with pytest.raises(RoomNotFoundError):
+        get_room("Kitchen", house_id="house789")
+    assert get_room("Kitchen").house.house_id == "house456"
+
+def test_name_keyed_files_still_work(two_houses):
+    # rooms.json as written before rooms were keyed by house
+    save_rooms_to_json({"Pantry": {"name": "Pantry", "floor": 0, "house_id": "house456"}})
+    assert get_room("Pantry", house_id="house456").floor == 0
+    assert room_exists("Pantry", "house456")
+    assert not room_exists("Pantry", "house789")
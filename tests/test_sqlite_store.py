@@ -0,0 +1,269 @@
+import pytest
+
+import storage
+import sqlite_store
+from sqlite_store import SqliteStore, ConnectionPool
+from user import User, PrivilegeLevel, create_user, get_user, get_all_users, delete_user, NotFoundError
+from house import House, create_house, get_house
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "smart_home.db")
+    monkeypatch.setattr(sqlite_store, "SQLITE_PATH", path)
+    monkeypatch.setattr(sqlite_store, "_pools", {})
+    return path
+
+@pytest.fixture
+def sqlite_backend(db_path, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(storage, "_stores", {})
+    return db_path
+
+@pytest.fixture
+def owner():
+    return User("u1", "Mo Salad", "mosalad@example.com", PrivilegeLevel.OWNER)
+
+def test_put_get_delete(db_path):
+    store = SqliteStore("users.json")
+    record = {"user_id": "u1", "name": "A", "email": "a@b.com", "privilege": "owner"}
+    store.put("u1", record)
+
+    assert "u1" in store
+    assert store.get("u1") == record
+    assert store.load() == {"u1": record}
+
+    store.delete("u1")
+    assert store.get("u1") is None
+    assert store.load() == {}
+
+def test_update_keeps_insertion_order(db_path):
+    store = SqliteStore("users.json")
+    for uid in ("a", "b", "c"):
+        store.put(uid, {"user_id": uid, "name": uid, "email": "x@y.com", "privilege": "owner"})
+    store.put("a", {"user_id": "a", "name": "new", "email": "x@y.com", "privilege": "admin"})
+    assert list(store.load()) == ["a", "b", "c"]
+
+def test_save_replaces_table(db_path):
+    store = SqliteStore("users.json")
+    store.put("old", {"user_id": "old", "name": "o", "email": "o@o.com", "privilege": "owner"})
+    new = {"user_id": "new", "name": "n", "email": "n@n.com", "privilege": "owner"}
+    store.save({"new": new})
+    assert store.load() == {"new": new}
+
+def test_schema_has_foreign_keys_and_indexes(db_path):
+    SqliteStore("devices.json")
+    with sqlite_store.get_pool().connection() as conn:
+        fks = {row[2] for row in conn.execute("PRAGMA foreign_key_list(devices)")}
+        room_fks = {row[2] for row in conn.execute("PRAGMA foreign_key_list(rooms)")}
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(devices)")}
+        journal = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    # room names are only unique per house, so devices can't reference one
+    assert fks == {"houses"}
+    assert room_fks == {"houses"}
+    assert {"idx_devices_type", "idx_devices_house_id", "idx_devices_room_name"} <= indexes
+    assert journal == "wal"
+
+def test_old_name_keyed_rooms_are_migrated(db_path, sqlite_backend, owner):
+    import sqlite3
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE rooms (name TEXT PRIMARY KEY, house_id TEXT REFERENCES houses(house_id),
+                            floor INTEGER, record TEXT NOT NULL);
+        CREATE INDEX idx_rooms_house_id ON rooms(house_id);
+        CREATE TABLE devices (device_id TEXT PRIMARY KEY, room_name TEXT REFERENCES rooms(name),
+                              house_id TEXT REFERENCES houses(house_id), type TEXT, record TEXT NOT NULL);
+        INSERT INTO rooms VALUES ('Kitchen', 'h1', 1, '{"name": "Kitchen", "floor": 1, "house_id": "h1"}');
+        INSERT INTO devices VALUES ('d1', 'Kitchen', 'h1', 'light',
+                                    '{"device_id": "d1", "type": "light", "room_name": "Kitchen", "house_id": "h1"}');
+    """)
+    conn.commit()
+    conn.close()
+
+    from room import get_room
+    from device import get_device
+    create_user(owner)
+    create_house(House("h1", "1 Main St", owner, (0.0, 0.0), 1, 1))
+    assert SqliteStore("rooms.json").load().keys() == {"h1/Kitchen"}
+    assert get_room("Kitchen", house_id="h1").floor == 1
+    assert get_device("d1").room.name == "Kitchen"
+
+def test_pool_never_exceeds_size(db_path):
+    pool = ConnectionPool(db_path, size=2)
+    with pool.connection() as a, pool.connection() as b:
+        assert a is not b
+    with pool.connection() as c:
+        assert c in (a, b)
+    assert pool._created == 2
+
+def test_pool_times_out_instead_of_hanging(db_path):
+    pool = ConnectionPool(db_path, size=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(sqlite_store.PoolTimeoutError):
+            with pool.connection():
+                pass
+
+def test_scans_release_their_connection_between_chunks(db_path, monkeypatch):
+    monkeypatch.setattr(sqlite_store, "SCAN_CHUNK_SIZE", 2)
+    pool = sqlite_store._pools[db_path] = ConnectionPool(db_path, size=2, timeout=1)
+    store = SqliteStore("users.json")
+    for uid in ("a", "b", "c", "d", "e"):
+        store.put(uid, {"user_id": uid, "name": uid, "email": "x@y.com", "privilege": "owner"})
+
+    # two scans in flight at once, each looking rows up as it goes, on a
+    # pool of two: a scan that held its connection would starve the lookups
+    first, second = store.scan(), store.scan(after="b")
+    seen = []
+    for (key, _), (other, _) in zip(first, second):
+        seen.append((key, store.get(key)["name"], other, store.get(other)["name"]))
+    assert seen == [("a", "a", "c", "c"), ("b", "b", "d", "d"), ("c", "c", "e", "e")]
+    assert pool._created == 1
+
+def test_crud_functions_run_on_sqlite(sqlite_backend, owner):
+    create_user(owner)
+    assert get_user("u1") == owner
+    assert get_all_users() == [owner]
+
+    house = House("h1", "1 Main St", owner, (40.0, -74.0), 3, 2)
+    create_house(house)
+    assert get_house("h1") == house
+
+    delete_user("u1")
+    with pytest.raises(NotFoundError):
+        get_user("u1")
+
+def test_page_uses_indexed_columns(db_path):
+    store = SqliteStore("devices.json")
+    for device_id, dev_type, house_id in [("d3", "light", "h1"), ("d1", "camera", "h1"), ("d2", "camera", "h2")]:
+        store.put(device_id, {"device_id": device_id, "type": dev_type, "room_name": "r", "house_id": house_id})
+
+    assert [k for k, _ in store.page({"type": "camera"})] == ["d1", "d2"]
+    assert [k for k, _ in store.page({"house_id": {"h1"}}, after="d1", limit=5)] == ["d3"]
+    with pytest.raises(ValueError):
+        store.page({"color": "red"})
+
+def test_custom_index_is_rebuilt_when_the_database_changes(db_path):
+    class KeySet(set):
+        def add(self, key, record):
+            super().add(key)
+
+        def discard(self, key, record):
+            super().discard(key)
+
+    store = SqliteStore("users.json")
+    store.attach_index("keys", KeySet)
+    record = {"user_id": "u1", "name": "A", "email": "a@b.com", "privilege": "owner"}
+    store.put("u1", record)
+    assert store.query_index("keys", sorted) == ["u1"]
+    index = store.query_index("keys", lambda index: index)
+    assert store.query_index("keys", lambda index: index) is index
+
+    # another store on the same database stands in for another worker
+    SqliteStore("users.json").put("u2", dict(record, user_id="u2"))
+    assert store.query_index("keys", sorted) == ["u1", "u2"]
+
+def test_custom_index_follows_this_processes_writes(db_path):
+    builds = []
+
+    class KeySet(set):
+        def __init__(self):
+            builds.append(self)
+
+        def add(self, key, record):
+            super().add(key)
+
+        def discard(self, key, record):
+            super().discard(key)
+
+    store = SqliteStore("users.json")
+    store.attach_index("keys", KeySet)
+    record = {"user_id": "u1", "name": "A", "email": "a@b.com", "privilege": "owner"}
+    store.put("u1", record)
+    assert store.query_index("keys", sorted) == ["u1"]
+
+    store.put("u2", dict(record, user_id="u2"))
+    store.put_if_absent("u3", dict(record, user_id="u3"))
+    store.delete("u1")
+    store.update("u2", lambda old: dict(old, name="B"))
+    with store.batch():
+        store.put("u4", dict(record, user_id="u4"))
+        store.delete("u3")
+    assert store.query_index("keys", sorted) == ["u2", "u4"]
+    assert len(builds) == 1  # no full scan for our own writes
+
+    SqliteStore("users.json").delete("u4")  # another worker
+    assert store.query_index("keys", sorted) == ["u2"]
+    assert len(builds) == 2
+
+def test_batch_is_one_transaction(db_path):
+    store = SqliteStore("users.json")
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            store.put("u1", {"user_id": "u1", "name": "A", "email": "a@b.com", "privilege": "owner"})
+            assert "u1" in store
+            raise RuntimeError("boom")
+    assert store.load() == {}
+
+    with store.batch():
+        store.put("u1", {"user_id": "u1", "name": "A", "email": "a@b.com", "privilege": "owner"})
+        store.put("u2", {"user_id": "u2", "name": "B", "email": "b@b.com", "privilege": "owner"})
+        store.delete("u1")
+    assert list(store.load()) == ["u2"]
+
+def test_reads_inside_a_batch_see_its_writes(db_path):
+    store = SqliteStore("devices.json")
+    for device_id, dev_type in [("d1", "camera"), ("d2", "light"), ("d3", "camera")]:
+        store.put(device_id, {"device_id": device_id, "type": dev_type, "room_name": "r", "house_id": "h1"})
+
+    with store.batch():
+        store.put("d0", {"device_id": "d0", "type": "camera", "room_name": "r", "house_id": "h1"})
+        store.put("d2", {"device_id": "d2", "type": "camera", "room_name": "r", "house_id": "h1"})
+        store.delete("d3")
+        assert store.find("type", "camera") == ["d0", "d1", "d2"]
+        assert [k for k, _ in store.page({"type": "camera"}, limit=2)] == ["d0", "d1"]
+        assert [k for k, _ in store.scan({"house_id": "h1"}, after="d0")] == ["d1", "d2"]
+
+    assert store.find("type", "camera") == ["d0", "d1", "d2"]
+
+def test_bulk_load_streams_rows(db_path):
+    store = SqliteStore("users.json")
+    rows = (
+        (f"u{i}", {"user_id": f"u{i}", "name": "N", "email": "n@n.com", "privilege": "owner"})
+        for i in range(25)
+    )
+    assert store.bulk_load(rows) == 25
+    assert len(store.load()) == 25
+
+def test_update_reads_and_writes_in_one_transaction(db_path):
+    import threading
+    store = SqliteStore("device_state.json")
+    bump = lambda record: {"version": (record or {"version": 0})["version"] + 1}
+
+    threads = [threading.Thread(target=lambda: [store.update("d1", bump) for _ in range(20)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.get("d1") == {"version": 80}
+
+    assert store.update("d1", lambda record: None) is None
+    with store.batch():
+        store.update("d1", bump)
+        assert store.get("d1") == {"version": 81}
+    assert store.get("d1") == {"version": 81}
+
+def test_put_if_absent_never_overwrites(db_path):
+    import sqlite3
+    store = SqliteStore("users.json")
+    first = {"user_id": "u1", "name": "A", "email": "a@b.com", "privilege": "owner"}
+    second = dict(first, name="B")
+    assert store.put_if_absent("u1", first)
+    assert not store.put_if_absent("u1", second)
+    assert store.get("u1") == first
+
+    # inside a batch the insert is checked again when the batch commits
+    with pytest.raises(sqlite3.IntegrityError):
+        with store.batch():
+            store.put_if_absent("u2", first)
+            with store.pool.connection() as conn, conn:  # another writer gets in first
+                conn.execute(store._upsert_sql(), store._row("u2", second))
+    assert store.get("u2") == second
@@ -0,0 +1,448 @@
+import json
+import os
+
+import pytest
+
+import codec
+import storage
+from storage import JsonStore, LogStore, get_store, clear_cache
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "things.json")
+
+def test_missing_file_loads_empty(store_path):
+    assert JsonStore(store_path).load() == {}
+
+def test_save_writes_through(store_path):
+    store = JsonStore(store_path)
+    store.save({"a": {"id": "a"}})
+    with open(store_path) as f:
+        assert json.load(f) == {"a": {"id": "a"}}
+    assert store.load() == {"a": {"id": "a"}}
+
+def test_reads_are_served_from_cache(store_path, monkeypatch):
+    store = JsonStore(store_path)
+    store.save({"a": 1})
+
+    def fail(*args, **kwargs):
+        raise AssertionError("file should not be re-parsed")
+
+    monkeypatch.setattr(codec, "load_file", fail)
+    assert store.load() == {"a": 1}
+    assert store.load() is store.load()
+
+def test_external_change_is_detected(store_path):
+    store = JsonStore(store_path)
+    store.save({"a": 1})
+
+    # another worker rewrites the file behind our back
+    with open(store_path, "w") as f:
+        json.dump({"a": 1, "b": 2}, f)
+    assert store.load() == {"a": 1, "b": 2}
+
+    os.remove(store_path)
+    assert store.load() == {}
+
+def test_get_store_is_shared(store_path):
+    assert get_store(store_path, "json") is get_store(store_path, "json")
+
+def test_clear_cache_forces_reload(store_path):
+    store = get_store(store_path, "json")
+    store.save({"a": 1})
+    cached = store.load()
+    clear_cache()
+    assert store.load() is not cached
+    assert store.load() == {"a": 1}
+
+# ---------- log-structured backend ----------
+
+def test_log_store_appends_one_record_per_mutation(store_path):
+    store = LogStore(store_path)
+    store.put("a", {"id": "a"})
+    store.put("b", {"id": "b"})
+    store.delete("a")
+
+    with open(store.log_path) as f:
+        assert len(f.readlines()) == 3
+    assert not os.path.exists(store_path)  # no snapshot until compaction
+
+def test_log_store_replays_on_startup(store_path):
+    store = LogStore(store_path)
+    store.put("a", {"id": "a"})
+    store.put("b", {"id": "b"})
+    store.delete("a")
+
+    restarted = LogStore(store_path)
+    assert restarted.load() == {"b": {"id": "b"}}
+    assert restarted.log_records == 3
+
+def test_log_store_ignores_torn_final_record(store_path):
+    store = LogStore(store_path)
+    store.put("a", {"id": "a"})
+    with open(store.log_path, "a") as f:
+        f.write('{"op": "put", "key": "b", "val')
+
+    restarted = LogStore(store_path)
+    assert restarted.load() == {"a": {"id": "a"}}
+
+    # the torn tail is cut off so later appends stay readable
+    restarted.put("c", {"id": "c"})
+    assert LogStore(store_path).load() == {"a": {"id": "a"}, "c": {"id": "c"}}
+
+def test_log_store_keeps_a_last_record_missing_its_newline(store_path):
+    store = LogStore(store_path)
+    store.put("a", {"id": "a"})
+    store.put("b", {"id": "b"})
+    with open(store.log_path, "rb+") as f:
+        f.truncate(os.path.getsize(store.log_path) - 1)  # crash before the "\n"
+
+    reopened = LogStore(store_path)
+    assert reopened.load() == {"a": {"id": "a"}, "b": {"id": "b"}}
+    reopened.put("c", {"id": "c"})
+    restarted = LogStore(store_path)
+    assert restarted.load() == {"a": {"id": "a"}, "b": {"id": "b"}, "c": {"id": "c"}}
+    assert restarted.log_records == 3
+
+def test_compact_folds_log_into_snapshot(store_path):
+    store = LogStore(store_path)
+    store.put("a", {"id": "a"})
+    store.put("b", {"id": "b"})
+    store.compact()
+
+    assert os.path.getsize(store.log_path) == 0
+    with open(store_path) as f:
+        assert json.load(f) == {"a": {"id": "a"}, "b": {"id": "b"}}
+    assert LogStore(store_path).load() == {"a": {"id": "a"}, "b": {"id": "b"}}
+
+def test_backend_is_selected_by_config(store_path, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "log")
+    monkeypatch.setattr(storage, "start_compactor", lambda: None)
+    assert isinstance(get_store(store_path), LogStore)
+
+# ---------- pagination ----------
+
+def test_page_filters_in_key_order(store_path):
+    store = JsonStore(store_path)
+    for key, color in [("c", "red"), ("a", "red"), ("b", "blue"), ("d", "red")]:
+        store.put(key, {"color": color})
+
+    assert [k for k, _ in store.page({"color": "red"})] == ["a", "c", "d"]
+    assert [k for k, _ in store.page({"color": "red"}, after="a", limit=1)] == ["c"]
+    assert [k for k, _ in store.page({"color": {"red", "blue"}}, limit=2)] == ["a", "b"]
+
+    store.delete("c")
+    store.put("e", {"color": "red"})
+    assert [k for k, _ in store.page({"color": "red"}, after="a")] == ["d", "e"]
+
+def test_paginate_walks_every_page(store_path):
+    store = JsonStore(store_path)
+    for i in range(5):
+        store.put(f"k{i}", {"i": i})
+
+    seen, cursor = [], None
+    while True:
+        records, cursor = storage.paginate(store, limit=2, cursor=cursor)
+        seen += [r["i"] for r in records]
+        if cursor is None:
+            break
+    assert seen == [0, 1, 2, 3, 4]
+
+def test_scan_walks_the_key_list_a_chunk_at_a_time(store_path, monkeypatch):
+    monkeypatch.setattr(storage, "SCAN_CHUNK_SIZE", 2)
+    store = JsonStore(store_path)
+    for key in ("a", "c", "e", "g"):
+        store.put(key, {"id": key})
+
+    seen = []
+    for key, _ in store.scan():
+        seen.append(key)
+        if key == "a":
+            # the scan resumes after the last key it saw, so it picks up
+            # writes ahead of it instead of a copy taken when it started
+            store.put("f", {"id": "f"})
+            store.delete("g")
+    assert seen == ["a", "c", "e", "f"]
+    assert [k for k, _ in store.page(after="c", limit=1)] == ["e"]
+
+def test_bad_cursor_is_rejected(store_path):
+    with pytest.raises(storage.CursorError):
+        storage.paginate(JsonStore(store_path), limit=2, cursor="garbage")
+
+# ---------- secondary indexes ----------
+
+def test_index_is_maintained_by_put_and_delete(store_path):
+    store = JsonStore(store_path)
+    store.ensure_index("color")
+    store.put("a", {"color": "red"})
+    store.put("b", {"color": "red"})
+    assert store.find("color", "red") == ["a", "b"]
+
+    store.put("a", {"color": "blue"})
+    store.delete("b")
+    store.put("c", {"color": "red"})
+    assert store.find("color", "red") == ["c"]
+    assert store.find("color", "blue") == ["a"]
+    assert store.find("color", "green") == []
+
+def test_index_is_rebuilt_after_external_change(store_path):
+    store = JsonStore(store_path)
+    store.ensure_index("color")
+    store.put("a", {"color": "red"})
+    assert store.find("color", "red") == ["a"]
+
+    with open(store_path, "w") as f:
+        json.dump({"a": {"color": "blue"}, "b": {"color": "red"}}, f)
+    assert store.find("color", "red") == ["b"]
+
+def test_page_uses_index_without_scanning(store_path, monkeypatch):
+    store = JsonStore(store_path)
+    store.ensure_index("color")
+    for i in range(50):
+        store.put(f"k{i:02}", {"color": "red" if i % 10 == 0 else "blue"})
+
+    checked = []
+    real_matches = storage.matches
+    monkeypatch.setattr(storage, "matches", lambda r, w: checked.append(r) or real_matches(r, w))
+    assert [k for k, _ in store.page({"color": "red"})] == ["k00", "k10", "k20", "k30", "k40"]
+    assert len(checked) == 5
+
+def test_index_buckets_stay_sorted_so_pages_never_sort(store_path, monkeypatch):
+    store = JsonStore(store_path)
+    store.ensure_index("color")
+    for key in ("e", "b", "d", "a", "c", "f"):
+        store.put(key, {"color": "red" if key in "ace" else "blue"})
+    store.page({"color": "red"})  # builds the index
+
+    def fail(*args, **kwargs):
+        raise AssertionError("index buckets should not be re-sorted")
+
+    monkeypatch.setattr(storage, "sorted", fail, raising=False)
+    store.put("bb", {"color": "red"})
+    store.delete("c")
+    assert store.find("color", "red") == ["a", "bb", "e"]
+    assert [k for k, _ in store.page({"color": "red"}, after="a", limit=2)] == ["bb", "e"]
+    assert [k for k, _ in store.page({"color": ["red", "blue"]}, after="b")] == ["bb", "d", "e", "f"]
+
+class KeySet:
+    # the smallest custom index: every key it was told about
+    def __init__(self):
+        self.keys = set()
+
+    def add(self, key, record):
+        self.keys.add(key)
+
+    def discard(self, key, record):
+        self.keys.discard(key)
+
+def test_custom_index_follows_writes_reloads_and_rollbacks(store_path):
+    store = JsonStore(store_path)
+    store.put("a", {"id": "a"})
+    store.attach_index("keys", KeySet)
+    assert store.query_index("keys", lambda index: sorted(index.keys)) == ["a"]
+
+    store.put("b", {"id": "b"})
+    store.delete("a")
+    assert store.query_index("keys", lambda index: sorted(index.keys)) == ["b"]
+
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            store.put("c", {"id": "c"})
+            raise RuntimeError("boom")
+    assert store.query_index("keys", lambda index: sorted(index.keys)) == ["b"]
+
+    with open(store_path, "w") as f:
+        json.dump({"x": {"id": "x"}}, f)
+    assert store.query_index("keys", lambda index: sorted(index.keys)) == ["x"]
+
+def test_update_is_an_atomic_read_modify_write(store_path):
+    import threading
+    store = LogStore(store_path)
+    store.ensure_index("version")
+    bump = lambda record: {"version": (record or {"version": 0})["version"] + 1}
+
+    threads = [threading.Thread(target=lambda: [store.update("a", bump) for _ in range(25)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert LogStore(store_path).load() == {"a": {"version": 100}}
+    assert store.find("version", 100) == ["a"]
+
+    assert store.update("a", lambda record: None) is None
+    with open(store.log_path) as f:
+        assert len(f.readlines()) == 100  # declining to change writes nothing
+
+# ---------- batches ----------
+
+def test_batch_commits_once(store_path):
+    store = LogStore(store_path)
+    with store.batch():
+        store.put("a", {"id": "a"})
+        store.put("b", {"id": "b"})
+        store.delete("a")
+        assert store.get("b") == {"id": "b"}
+        assert not os.path.exists(store.log_path)  # nothing written yet
+
+    with open(store.log_path) as f:
+        assert len(f.readlines()) == 3
+    assert LogStore(store_path).load() == {"b": {"id": "b"}}
+
+def test_batch_rolls_back_on_error(store_path):
+    store = JsonStore(store_path)
+    store.ensure_index("color")
+    store.put("a", {"color": "red"})
+
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            store.put("b", {"color": "red"})
+            store.delete("a")
+            raise RuntimeError("boom")
+
+    assert store.load() == {"a": {"color": "red"}}
+    assert store.find("color", "red") == ["a"]
+    assert JsonStore(store_path).load() == {"a": {"color": "red"}}
+
+# ---------- concurrent writers ----------
+
+def _put_many(path, prefix, count):
+    store = JsonStore(path)
+    for i in range(count):
+        store.put(f"{prefix}{i}", {"i": i})
+
+def test_concurrent_threads_lose_no_writes(store_path):
+    import threading
+    store = JsonStore(store_path)
+    threads = [
+        threading.Thread(target=lambda p=p: [store.put(f"{p}{i}", {"i": i}) for i in range(25)])
+        for p in "abcd"
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(JsonStore(store_path).load()) == 100
+
+@pytest.mark.skipif(storage.fcntl is None, reason="needs flock()")
+def test_concurrent_processes_lose_no_writes(store_path):
+    import multiprocessing
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_put_many, args=(store_path, p, 20)) for p in "abc"]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert all(p.exitcode == 0 for p in procs)
+    assert len(JsonStore(store_path).load()) == 60
+
+def test_failed_write_leaves_file_intact(store_path, monkeypatch):
+    store = JsonStore(store_path)
+    store.put("a", {"id": "a"})
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(codec, "dump_file", fail)
+    with pytest.raises(OSError):
+        store.save({"b": {"id": "b"}})
+    monkeypatch.undo()
+
+    assert JsonStore(store_path).load() == {"a": {"id": "a"}}
+    leftovers = [n for n in os.listdir(os.path.dirname(store_path)) if n.endswith(".tmp")]
+    assert leftovers == []
+
+# ---------- group commit ----------
+
+def _put_concurrently(store, keys):
+    import threading
+    threads = [threading.Thread(target=store.put, args=(k, {"id": k})) for k in keys]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def _count_appends(store, monkeypatch):
+    appends = []
+    real_append = store._append
+    monkeypatch.setattr(store, "_append", lambda ops: appends.append(len(ops)) or real_append(ops))
+    return appends
+
+def test_group_commit_coalesces_concurrent_writes(store_path, monkeypatch):
+    store = LogStore(store_path)
+    store.group_commit_ms = 200
+    appends = _count_appends(store, monkeypatch)
+
+    _put_concurrently(store, [f"k{i}" for i in range(8)])
+
+    assert sum(appends) == 8
+    assert len(appends) < 8
+    # every writer returned only after its record was on disk
+    assert len(LogStore(store_path).load()) == 8
+
+def test_group_commit_flushes_when_batch_is_full(store_path, monkeypatch):
+    import time
+    store = LogStore(store_path)
+    store.group_commit_ms = 10_000
+    store.group_commit_max_batch = 4
+    appends = _count_appends(store, monkeypatch)
+
+    start = time.monotonic()
+    _put_concurrently(store, ["a", "b", "c", "d"])
+    assert time.monotonic() - start < 5
+    assert appends == [4]
+
+def test_batches_join_the_group_commit(store_path, monkeypatch):
+    import threading
+    import time
+    store = LogStore(store_path)
+    store.group_commit_ms = 10_000
+    store.group_commit_max_batch = 8
+    appends = _count_appends(store, monkeypatch)
+
+    def write_pair(n):
+        with store.batch():
+            store.put(f"a{n}", {"id": n})
+            store.put(f"b{n}", {"id": n})
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=write_pair, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.monotonic() - start < 5
+    assert appends == [8]
+    assert len(LogStore(store_path).load()) == 8
+
+def test_group_commit_reports_failed_flush(store_path, monkeypatch):
+    store = JsonStore(store_path)
+    store.group_commit_ms = 1
+
+    def fail(ops):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "_append", fail)
+    with pytest.raises(OSError):
+        store.put("a", {"id": "a"})
+    monkeypatch.undo()
+
+    # the failed write is not served from the cache either
+    assert store.load() == {}
+    store.put("b", {"id": "b"})
+    assert JsonStore(store_path).load() == {"b": {"id": "b"}}
+
+# ---------- interning ----------
+
+def test_intern_reuses_object_until_record_or_parent_changes(store_path):
+    store = JsonStore(store_path)
+    store.put("a", {"v": 1})
+    build = lambda: object()
+    parent = object()
+
+    first = store.intern("a", store.get("a"), build, parent)
+    assert store.intern("a", store.get("a"), build, parent) is first
+    assert store.intern("a", store.get("a"), build, object()) is not first
+
+    current = store.intern("a", store.get("a"), build, parent)
+    store.put("a", {"v": 1})  # equal content, new record
+    assert store.intern("a", store.get("a"), build, parent) is not current
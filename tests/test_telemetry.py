@@ -0,0 +1,153 @@
+import os
+
+import pytest
+from user import User, PrivilegeLevel, create_user
+from house import House, create_house
+from room import Room, create_room
+from device import Device, DeviceType, DeviceNotFoundError, create_device, delete_device
+import telemetry
+from telemetry import Series, ingest, get_readings, get_metrics, ValidationError
+from telemetry import get_rollup, get_house_rollup, get_room_rollup
+
+@pytest.fixture(autouse=True)
+def telemetry_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(telemetry, "TELEMETRY_DIR", str(tmp_path / "telemetry"))
+    return str(tmp_path / "telemetry")
+
+@pytest.fixture
+def room():
+    owner = User("owner123", "Mo Salad", "mosalad@example.com", PrivilegeLevel.OWNER)
+    house = House("house456", "123 Pineapple Ave", owner, (40.7128, -74.0060), 3, 2)
+    room = Room("Living Room", 1, house)
+    create_user(owner)
+    create_house(house)
+    create_room(room)
+    create_device(Device(DeviceType.THERMOSTAT, "t1", room))
+    return room
+
+def _reopened(series):
+    # a second process's view of the same file
+    return Series(series.path)
+
+def test_ingest_and_query_a_time_range(room):
+    assert ingest("t1", "temperature", [10, 20, 30], [20.5, 21.0, 21.5]) == 3
+    assert ingest("t1", "temperature", [40, 50], [22.0, 22.5]) == 2
+
+    ts, values = get_readings("t1", "temperature", start=20, end=50)
+    assert (ts.tolist(), values.tolist()) == ([20, 30, 40], [21.0, 21.5, 22.0])
+    assert get_readings("t1", "temperature", start=35)[0].tolist() == [40, 50]
+    assert get_readings("t1", "temperature", limit=2)[0].tolist() == [10, 20]
+    assert get_readings("t1", "humidity")[0].tolist() == []
+    assert get_metrics("t1") == ["temperature"]
+
+def test_each_batch_is_one_appended_block(room):
+    ingest("t1", "temperature", [1, 2], [1.0, 2.0])
+    series = telemetry._series_for("t1", "temperature")
+    size = os.path.getsize(series.path)
+    ingest("t1", "temperature", [3, 4, 5], [3.0, 4.0, 5.0])
+    assert os.path.getsize(series.path) == size + telemetry.BLOCK_HEADER.size + 16 * 3
+
+    other = _reopened(series)
+    assert other.range()[1].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0]
+    ingest("t1", "temperature", [6], [6.0])
+    assert other.range(start=5)[0].tolist() == [5, 6]  # picks up the new block only
+
+def test_unsorted_and_late_batches_are_merged_in_order(room):
+    ingest("t1", "temperature", [30, 10, 20], [3.0, 1.0, 2.0])
+    ingest("t1", "temperature", [40, 50], [4.0, 5.0])
+    ingest("t1", "temperature", [45, 15], [4.5, 1.5])
+
+    expected = ([10, 15, 20, 30, 40, 45, 50], [1.0, 1.5, 2.0, 3.0, 4.0, 4.5, 5.0])
+    ts, values = get_readings("t1", "temperature")
+    assert (ts.tolist(), values.tolist()) == expected
+    series = _reopened(telemetry._series_for("t1", "temperature"))
+    assert series.range()[0].tolist() == expected[0]
+
+def test_torn_block_is_ignored_and_cut_off(room):
+    ingest("t1", "temperature", [1, 2], [1.0, 2.0])
+    series = telemetry._series_for("t1", "temperature")
+    with open(series.path, "ab") as f:
+        f.write(telemetry.BLOCK_HEADER.pack(5) + b"\0" * 12)
+
+    fresh = _reopened(series)
+    assert fresh.range()[0].tolist() == [1, 2]
+    fresh.append(telemetry.array("d", [3]), telemetry.array("d", [3.0]))
+    assert _reopened(series).range()[1].tolist() == [1.0, 2.0, 3.0]
+
+def test_bad_batches_are_rejected(room):
+    create_device(Device(DeviceType.LIGHT, "l1", room))
+    with pytest.raises(DeviceNotFoundError):
+        ingest("ghost", "temperature", [1], [1.0])
+    with pytest.raises(ValidationError):
+        ingest("l1", "temperature", [1], [1.0])
+    with pytest.raises(ValidationError):
+        ingest("t1", "../etc", [1], [1.0])
+    with pytest.raises(ValidationError):
+        ingest("t1", "temperature", [1, 2], [1.0])
+    with pytest.raises(ValidationError):
+        ingest("t1", "temperature", [1], [float("nan")])
+    assert get_readings("t1", "temperature")[0].tolist() == []
+
+def test_rollup_buckets(room):
+    ingest("t1", "temperature", [0, 10, 20, 30, 60, 130], [4.0, 1.0, 3.0, 2.0, 5.0, 7.0])
+    rollup = get_rollup("t1", "temperature", "1m")
+    assert rollup["start"] == [0, 60, 120]
+    assert rollup["count"] == [4, 1, 1]
+    assert rollup["min"] == [1.0, 5.0, 7.0]
+    assert rollup["max"] == [4.0, 5.0, 7.0]
+    assert rollup["mean"] == [2.5, 5.0, 7.0]
+    assert rollup["p50"] == [2.5, 5.0, 7.0]
+    assert rollup["p90"][0] == pytest.approx(3.7)
+
+    assert get_rollup("t1", "temperature", "1m", start=70, end=121)["start"] == [60, 120]
+    assert get_rollup("t1", "temperature", "1h")["count"] == [6]
+    with pytest.raises(ValidationError):
+        get_rollup("t1", "temperature", "5m")
+
+def test_closed_buckets_are_kept_and_reopened_by_late_data(room):
+    ingest("t1", "temperature", [0, 30, 60], [1.0, 2.0, 3.0])
+    series = telemetry._series_for("t1", "temperature")
+    get_rollup("t1", "temperature", "1m")
+    kept = series._rollups[60]
+    assert (kept.start.tolist(), kept.through) == ([0], 60)  # the open bucket isn't kept
+
+    ingest("t1", "temperature", [90, 150], [4.0, 5.0])
+    assert (kept.start.tolist(), kept.through) == ([0, 60], 120)  # maintained on append
+    assert get_rollup("t1", "temperature", "1m")["count"] == [2, 2, 1]
+
+    ingest("t1", "temperature", [45], [9.0])  # late
+    assert get_rollup("t1", "temperature", "1m")["max"] == [9.0, 4.0, 5.0]
+    assert _reopened(series).rollup(60)[1]["max"] == [9.0, 4.0, 5.0]
+
+def test_house_and_room_rollups_combine_devices(room):
+    other = Room("Den", 1, room.house)
+    create_room(other)
+    create_device(Device(DeviceType.SENSOR, "s1", room))
+    create_device(Device(DeviceType.SENSOR, "s2", other))
+    create_device(Device(DeviceType.LIGHT, "l1", room))
+    ingest("t1", "temperature", [0, 10, 70], [20.0, 22.0, 30.0])
+    ingest("s1", "temperature", [5, 65], [18.0, 24.0])
+    ingest("s2", "temperature", [15], [10.0])
+
+    house = get_house_rollup("house456", "temperature", "1m")
+    assert house["devices"] == 3
+    assert (house["start"], house["count"]) == ([0, 60], [4, 2])
+    assert (house["min"], house["max"]) == ([10.0, 24.0], [22.0, 30.0])
+    assert house["mean"] == [17.5, 27.0]
+    assert "p50" not in house
+
+    living = get_room_rollup("house456", "Living Room", "temperature", "1m")
+    assert (living["devices"], living["count"], living["min"]) == (2, [3, 2], [18.0, 24.0])
+
+def test_deleting_a_device_drops_its_telemetry(room, telemetry_dir):
+    ingest("t1", "temperature", [1], [1.0])
+    delete_device("t1")
+    assert os.listdir(telemetry_dir) == []
+
+def test_reads_of_unknown_metrics_are_not_cached(room):
+    for n in range(3):
+        assert get_readings("t1", f"made_up_{n}")[0].tolist() == []
+        assert get_rollup("t1", f"made_up_{n}", "1m")["count"] == []
+    assert telemetry._series.get("t1", {}) == {}
+    ingest("t1", "temperature", [1], [1.0])
+    assert list(telemetry._series["t1"]) == ["temperature"]
@@ -1,13 +1,5 @@
-import os
-
 import pytest
 
-@pytest.fixture(autouse=True)
-def clean_users_file():
-    if os.path.exists("users.json"):
-        os.remove("users.json")
-    yield
-
 from user import (
     User, PrivilegeLevel, 
     create_user, get_user, update_user, delete_user,
@@ -80,4 +72,46 @@ def test_create_user_duplicate_id():
     create_user(user)
     
     with pytest.raises(ConflictError):
-        create_user(user)
\ No newline at end of file
+        create_user(user)
+
+
+def test_reads_skip_revalidation(valid_user, monkeypatch):
+    import user
+    create_user(valid_user)
+
+    def no_regex(*args, **kwargs):
+        raise AssertionError("stored users are not re-validated on read")
+
+    monkeypatch.setattr(user.re, "match", no_regex)
+    user.get_store(user.USERS_JSON_FILE)._interned = {}
+    assert get_user("u1") == valid_user
+    assert user.get_all_users() == [valid_user]
+
+    # writes are still validated
+    with pytest.raises(AssertionError):
+        create_user(User("u2", "Name", "x@y.com", PrivilegeLevel.OWNER))
+
+def test_concurrent_creates_of_one_id_have_one_winner():
+    import threading
+    import user
+
+    for trial in range(20):
+        barrier = threading.Barrier(8)
+        created, conflicts = [], []
+
+        def create(n):
+            attempt = User(f"race{trial}", f"Racer {n}", "race@example.com", PrivilegeLevel.OWNER)
+            barrier.wait()
+            try:
+                created.append(create_user(attempt))
+            except ConflictError:
+                conflicts.append(n)
+
+        threads = [threading.Thread(target=create, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert (len(created), len(conflicts)) == (1, 7)
+        user.get_store(user.USERS_JSON_FILE)._interned = {}
+        assert get_user(f"race{trial}").name == created[0].name
@@ -1,25 +1,31 @@
-import json
-import os
 from enum import Enum
 import re
+from typing import Iterator, Optional, Tuple
+from events import batch_with_events, deferred, publish
+from storage import decode_cursor, get_store, paginate
 
 USERS_JSON_FILE = "users.json"
 
 def load_users_from_json() -> dict:
-    if not os.path.exists(USERS_JSON_FILE):
-        return {}
-    with open(USERS_JSON_FILE, "r") as f:
-        return json.load(f)
+    return get_store(USERS_JSON_FILE).load()
 
 def save_users_to_json(users_data: dict) -> None:
-    with open(USERS_JSON_FILE, "w") as f:
-        json.dump(users_data, f, indent=2)
+    get_store(USERS_JSON_FILE).save(users_data)
 
 class PrivilegeLevel(Enum):
     OWNER = "owner"
     ADMIN = "admin"
     RESIDENT = "resident"
 
+# value -> member, for hydration (cheaper than PrivilegeLevel(value))
+PRIVILEGE_LEVELS = {p.value: p for p in PrivilegeLevel}
+
+class OnDelete(Enum):
+    """What deleting a user, house or room does to the records that point at it."""
+    ORPHAN = "orphan"      # leave them; readers skip records whose parent is gone
+    RESTRICT = "restrict"  # refuse with a ConflictError while any exist
+    CASCADE = "cascade"    # delete them too
+
 class APIError(Exception):
     """Base class for API exceptions"""
     pass
@@ -34,6 +40,9 @@ class ConflictError(APIError):
     pass
 
 class User:
+    # no per-instance __dict__: a cached fleet holds a lot of these
+    __slots__ = ("user_id", "name", "email", "privilege")
+
     def __init__(self, user_id: str, name: str, email: str, privilege: PrivilegeLevel):
         if len(name) < 1 or len(name) > 50:
             raise ValidationError("Name must be 1-50 characters")
@@ -49,7 +58,19 @@ class User:
         self.email = email
         self.privilege = privilege
 
+    @classmethod
+    def _trusted(cls, user_id: str, name: str, email: str, privilege: PrivilegeLevel) -> "User":
+        """Build a User from already-validated data, skipping __init__'s checks."""
+        user = object.__new__(cls)
+        user.user_id = user_id
+        user.name = name
+        user.email = email
+        user.privilege = privilege
+        return user
+
     def __eq__(self, other):
+        if not isinstance(other, User):
+            return NotImplemented
         return (
             self.user_id == other.user_id and 
             self.name == other.name and 
@@ -57,6 +78,9 @@ class User:
             self.privilege == other.privilege
         )
 
+    def __hash__(self):
+        return hash(self.user_id)
+
 # input validation helper functions
 def validate_email(email: str):
     if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
@@ -67,36 +91,52 @@ def validate_privilege(privilege: PrivilegeLevel):
         raise ValidationError(f"Invalid privilege level: {privilege}")
 
 
-# ========== CRUD OPERATIONS ==========
-
-# C
-def create_user(user: User) -> User:
-    users_data = load_users_from_json()
-    if user.user_id in users_data:
-        raise ConflictError(f"User ID {user.user_id} exists")
-    
-    users_data[user.user_id] = {
+def user_to_dict(user: User) -> dict:
+    return {
         "user_id": user.user_id,
         "name": user.name,
         "email": user.email,
         "privilege": user.privilege.value
     }
-    save_users_to_json(users_data)
+
+def user_from_dict(data: dict) -> User:
+    return User(
+        user_id=data["user_id"],
+        name=data["name"],
+        email=data["email"],
+        privilege=PrivilegeLevel(data["privilege"])
+    )
+
+def _load_user(record: dict) -> User:
+    # a record read from the store: it was validated when it was written, so
+    # it is built without re-validation, and shared by every reader until it
+    # changes
+    return get_store(USERS_JSON_FILE).intern(
+        record["user_id"], record,
+        lambda: User._trusted(
+            record["user_id"], record["name"], record["email"],
+            PRIVILEGE_LEVELS[record["privilege"]]
+        ),
+    )
+
+# ========== CRUD OPERATIONS ==========
+
+# C
+def create_user(user: User) -> User:
+    store = get_store(USERS_JSON_FILE)
+    record = user_to_dict(user)
+    # checked and written under one lock: of two creates of an id, one wins
+    if not store.put_if_absent(user.user_id, record):
+        raise ConflictError(f"User ID {user.user_id} exists")
+    publish("user", "create", user.user_id, record)
     return user
 
 # R
 def get_user(user_id: str) -> User:
-    users_data = load_users_from_json()
-    if user_id not in users_data:
+    user_dict = get_store(USERS_JSON_FILE).get(user_id)
+    if user_dict is None:
         raise NotFoundError(f"User {user_id} not found")
-
-    user_dict = users_data[user_id]
-    return User(
-        user_id=user_dict["user_id"],
-        name=user_dict["name"],
-        email=user_dict["email"],
-        privilege=PrivilegeLevel(user_dict["privilege"])
-    )
+    return _load_user(user_dict)
 
 def get_all_users() -> list[User]:
     """
@@ -105,38 +145,59 @@ def get_all_users() -> list[User]:
     users_data = load_users_from_json()
     user_list = []
     for user_id, user_dict in users_data.items():
-        user_obj = User(
-            user_id=user_dict["user_id"],
-            name=user_dict["name"],
-            email=user_dict["email"],
-            privilege=PrivilegeLevel(user_dict["privilege"])
-        )
-        user_list.append(user_obj)
+        user_list.append(_load_user(user_dict))
     return user_list
 
+def find_users(
+    limit: Optional[int] = None, cursor: Optional[str] = None
+) -> Tuple[list[User], Optional[str]]:
+    """
+    One page of users in user_id order, plus the cursor for the next page.
+    """
+    records, next_cursor = paginate(get_store(USERS_JSON_FILE), None, limit, cursor)
+    return [_load_user(r) for r in records], next_cursor
+
+def iter_users(cursor: Optional[str] = None) -> Iterator[User]:
+    """
+    Lazily yield users in user_id order, one record decoded at a time.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    return (_load_user(r) for _, r in get_store(USERS_JSON_FILE).scan(None, after))
+
+def user_batch():
+    """
+    Context manager grouping the create_user/update_user/delete_user calls made
+    inside it into a single write. If the block raises, none of them land.
+    """
+    return batch_with_events(get_store(USERS_JSON_FILE))
+
 # U
 def update_user(updated_user: User) -> User:
-    users_data = load_users_from_json()
-    if updated_user.user_id not in users_data:
+    store = get_store(USERS_JSON_FILE)
+    if updated_user.user_id not in store:
         raise NotFoundError(f"User {updated_user.user_id} not found")
     
     validate_email(updated_user.email)
     validate_privilege(updated_user.privilege)
 
-    users_data[updated_user.user_id] = {
-        "user_id": updated_user.user_id,
-        "name": updated_user.name,
-        "email": updated_user.email,
-        "privilege": updated_user.privilege.value
-    }
-    save_users_to_json(users_data)
+    record = user_to_dict(updated_user)
+    store.put(updated_user.user_id, record)
+    publish("user", "update", updated_user.user_id, record)
     return updated_user
 
 # D
-def delete_user(user_id: str) -> None:
-    users_data = load_users_from_json()
-    if user_id not in users_data:
+def delete_user(user_id: str, on_delete: OnDelete = OnDelete.ORPHAN) -> None:
+    from house import get_house_ids_by_owner, purge_houses  # avoid circular import
+    store = get_store(USERS_JSON_FILE)
+    if user_id not in store:
         raise NotFoundError(f"User {user_id} not found")
-    
-    del users_data[user_id]
-    save_users_to_json(users_data)
\ No newline at end of file
+    # the whole cascade is numbered in the change log in one write
+    with deferred():
+        if on_delete is not OnDelete.ORPHAN:
+            house_ids = get_house_ids_by_owner(user_id)
+            if house_ids and on_delete is OnDelete.RESTRICT:
+                raise ConflictError(f"User {user_id} still owns {len(house_ids)} house(s)")
+            purge_houses(house_ids)
+
+        store.delete(user_id)
+        publish("user", "delete", user_id)